@@ -190,6 +190,10 @@ class NB_UL_collection(UIList):
             row.operator('nb.attach_neurons',
                          icon='CURVE_PATH',
                          text="").data_path = item.path_from_id()
+        if bpy.context.scene.nb.objecttype == 'tracts':
+            row.operator('nb.filter_tract',
+                         icon='FILTER',
+                         text="").data_path = item.path_from_id()
         if bpy.context.scene.nb.objecttype == 'surfaces':
             row.operator("nb.unwrap_surface",
                          icon='GROUP_UVS',
@@ -615,6 +619,10 @@ class NB_OT_collection(Operator):
         for sg in tract.scalargroups:
             self.remove_tracts_scalargroups(sg, ob)
 
+        proxy = bpy.data.objects.get(tract.lod_proxy)
+        if proxy is not None:
+            bpy.data.objects.remove(proxy)
+
     def remove_surfaces_overlays(self, surface, ob):
         """Remove surface scalars, labels and borders."""
 
@@ -636,12 +644,15 @@ class NB_OT_collection(Operator):
     def remove_tracts_scalargroups(self, scalargroup, ob):
         """Remove scalar overlay from tract."""
 
-        for scalar in scalargroup.scalars:
-            for i, _ in enumerate(ob.data.splines):
-                splformat = '{}.' + scalargroup.spline_postfix
-                splname = splformat.format(scalar.name, i)
-                self.remove_material(ob, splname)
-                self.remove_image(ob, splname)
+        splformat = '{}.'.format(scalargroup.name) + \
+            scalargroup.spline_postfix
+        for i, _ in enumerate(ob.data.splines):
+            self.remove_material(ob, splformat.format(i))
+
+        self.remove_image(ob, '{}.atlas'.format(scalargroup.name))
+        for groupname in ('TractOvAtlas', 'TractOvGroup'):
+            self.remove_data(bpy.data.node_groups,
+                             '{}.{}'.format(groupname, scalargroup.name))
 
     def remove_tracts_labelgroups(self, labelgroup, ob):
         """Remove label group."""
@@ -1000,6 +1011,9 @@ def register():
     handlers = bpy.app.handlers.load_post
     handlers.append(nb_pr.init_settings_handler)
 
+    handlers = bpy.app.handlers.scene_update_post
+    handlers.append(nb_pr.spatial_index_handler)
+
     bpy.types.Scene.nb = PointerProperty(type=nb_pr.NeuroBlenderProperties)
     # FIXME: errors on reloading addons using F8 hotkey
 
@@ -1018,6 +1032,9 @@ def unregister():
     handlers = bpy.app.handlers.load_post
     handlers.remove(nb_pr.init_settings_handler)
 
+    handlers = bpy.app.handlers.scene_update_post
+    handlers.remove(nb_pr.spatial_index_handler)
+
     bpy.utils.unregister_module(__name__)
 
     print("Unregistered NeuroBlender")
@@ -1137,7 +1137,8 @@ class NB_OT_campath_add(Operator):
 
         try:
             nb_ob = bpy.data.objects[self.anim_tract]
-            spline = nb_ob.data.splines[self.spline_index]
+            index = nb_ut.get_spatial_index(nb_ob)
+            streamline = index.streamlines[self.spline_index]
         except KeyError:
             ob = None
             infostring = 'tract "%s:spline[%s]" not found'
@@ -1150,7 +1151,6 @@ class NB_OT_campath_add(Operator):
             ob = bpy.data.objects.new(name, curve)
             scn.objects.link(ob)
 
-            streamline = [point.co[0:3] for point in spline.points]
             nb_ut.make_polyline(curve, streamline)
             ob.matrix_world = nb_ob.matrix_world
             ob.select = True
@@ -1233,6 +1233,54 @@ class NB_OT_campath_add(Operator):
         return ob
 
 
+class NB_OT_pick_streamline(Operator):
+    bl_idname = "nb.pick_streamline"
+    bl_label = "Pick streamline"
+    bl_description = "Select the streamline nearest to the 3D cursor"
+    bl_options = {"REGISTER", "UNDO"}
+
+    index_animations = IntProperty(
+        name="index animations",
+        description="Specify animation index",
+        default=-1)
+
+    def execute(self, context):
+
+        scn = context.scene
+        nb = scn.nb
+
+        anim = nb.animations[self.index_animations]
+
+        try:
+            ob = bpy.data.objects[anim.anim_tract]
+        except KeyError:
+            infostring = 'tract "%s" not found'
+            self.report({'WARNING'}, infostring % anim.anim_tract)
+            return {"CANCELLED"}
+
+        cursor = ob.matrix_world.inverted() * scn.cursor_location
+        index = nb_ut.get_spatial_index(ob)
+        spline_index, _, distance = index.nearest_streamline(cursor)
+        if spline_index < 0:
+            infostring = 'tract "%s" has no streamlines'
+            self.report({'WARNING'}, infostring % anim.anim_tract)
+            return {"CANCELLED"}
+
+        anim.spline_index = spline_index
+
+        infostring = 'picked streamline %d of "%s" at distance %.2f'
+        info = infostring % (spline_index, anim.anim_tract, distance)
+        self.report({'INFO'}, info)
+
+        return {"FINISHED"}
+
+    def invoke(self, context, event):
+
+        self.index_animations = context.scene.nb.index_animations
+
+        return self.execute(context)
+
+
 class NB_OT_campath_remove(Operator):
     bl_idname = "nb.campath_remove"
     bl_label = "Delete camera path"
@@ -1652,13 +1700,18 @@ class NB_OT_switch_direction(Operator):
         return context.window_manager.invoke_props_dialog(self)
 
     def switch_direction(self, tractob, idx=0, axis=0, co=0.):
-        """Switch direction of splines."""
-
-        for spl in tractob.data.splines:
-            for point in spl.points:
-                point.select = spl.points[idx].co[axis] > co
-
-        bpy.ops.object.mode_set(mode='EDIT')
-        bpy.ops.curve.switch_direction()
-        bpy.ops.object.mode_set(mode='OBJECT')
+        """Switch direction of splines.
+
+        The splines with their reference point beyond the coordinate
+        are reversed.
+        """
+
+        streamlines = nb_ut.curve_to_streamlines(tractob.data,
+                                                 with_data=True)
+        refpoints = streamlines.offsets + np.minimum(idx,
+                                                     streamlines.lengths - 1)
+        mask = streamlines.points[refpoints, axis] > co
+        streamlines = streamlines.reverse(mask)
+        nb_ut.streamlines_to_curve(tractob.data, streamlines)
+        nb_ut.invalidate_spatial_index(tractob.name)
 
@@ -0,0 +1,312 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# <pep8 compliant>
+
+
+"""The NeuroBlender clustering module.
+
+NeuroBlender is a Blender add-on to create artwork from neuroscientific data.
+This module implements QuickBundles clustering of packed streamlines
+(independent of Blender and dipy).
+"""
+
+
+import numpy as np
+
+from . import streamlines as nb_sl
+
+
+class Cluster(object):
+    """A cluster of streamlines (cf. dipy's ClusterCentroid)."""
+
+    def __init__(self, id, indices, centroid):
+
+        self.id = id
+        self.indices = indices
+        self.centroid = centroid
+
+    def __len__(self):
+
+        return len(self.indices)
+
+
+def streamline_features(streamlines, npoints=12):
+    """Return the streamlines resampled to npoints as [N x npoints x 3].
+
+    The streamlines are resampled at equidistant points along their arc
+    (as dipy's ResampleFeature); single points are repeated.
+    """
+
+    sl = nb_sl.resample_arclength(streamlines.pack(), npoints=npoints)
+    if not len(sl):
+        return np.zeros((0, npoints, 3), dtype='float32')
+
+    rows = sl.offsets[:, None] + np.minimum(np.arange(npoints),
+                                            sl.lengths[:, None] - 1)
+
+    return np.asarray(sl.points[rows], dtype='float32')
+
+
+def quickbundles(features, threshold, parents=None,
+                 blocksize=10000, maxpairs=4000000):
+    """Cluster streamline features with QuickBundles.
+
+    The distance is the minimum average direct-flip (MDF) distance
+    between a streamline and a centroid, as dipy's QuickBundles with
+    the AveragePointwiseEuclideanMetric on resampled streamlines:
+    the average pointwise Euclidean distance, with the streamline in
+    the orientation that is closest to the centroid. A streamline is
+    added to its centroid in that orientation.
+    The streamlines are processed in blocks: all streamlines of a block
+    are compared against the centroids at once and assigned to the
+    nearest within the threshold; lower bounds on the distance
+    (see candidate_distances) restrict the evaluation to candidate
+    pairs. The remaining streamlines of a block found new clusters in
+    order, and the centroids are updated after every block.
+    With 'parents' (labels of a coarser clustering), streamlines only
+    join clusters within their parent cluster.
+
+    Returns the cluster label of every streamline and the centroids.
+    """
+
+    features = np.asarray(features, dtype='float32')
+    nsl, npoints = features.shape[:2]
+    flat = features.reshape(nsl, -1)
+    flipped = features[:, ::-1].reshape(nsl, -1)
+    segments = SegmentMeans(npoints)
+    means = segments(features), segments(features[:, ::-1])
+    if parents is None:
+        parents = np.zeros(nsl, dtype='int64')
+
+    labels = np.full(nsl, -1, dtype='int64')
+    flips = np.zeros(nsl, dtype='bool')
+    centroids = np.zeros((0, npoints * 3), dtype='float32')
+    c_means = segments(np.zeros((0, npoints, 3)))
+    c_parents = np.zeros(0, dtype='int64')
+    counts = np.zeros(0, dtype='int64')
+
+    start = 0
+    while start < nsl:
+
+        nblock = int(np.clip(maxpairs // max(len(centroids), 1),
+                             1, blocksize))
+        block = np.arange(start, min(start + nblock, nsl))
+        start = block[-1] + 1
+
+        # compare the block against the current centroids
+        b, k, dist, flip = candidate_distances(
+            (flat, flipped), means, parents, block,
+            centroids, c_means, c_parents, threshold, maxpairs)
+        if len(b):
+            order = np.lexsort((dist, b))
+            b, k, flip = b[order], k[order], flip[order]
+            first = np.append(True, b[1:] != b[:-1])
+            labels[block[b[first]]] = k[first]
+            flips[block[b[first]]] = flip[first]
+
+        # the remaining streamlines form new clusters
+        unassigned = block[labels[block] < 0]
+        nclusters = len(centroids)
+        new, newflips = new_clusters((flat, flipped), parents, unassigned,
+                                     threshold, npoints)
+        labels[unassigned] = new + nclusters
+        flips[unassigned] = newflips
+        nnew = new.max() + 1 if len(new) else 0
+
+        # update the centroids with the (oriented) streamlines of the block
+        block_labels = labels[block]
+        oriented = np.where(flips[block][:, None],
+                            flipped[block], flat[block])
+        nk = nclusters + nnew
+        block_counts = np.bincount(block_labels, minlength=nk)
+        sums = np.zeros((nk, npoints * 3), dtype='float64')
+        for col in range(npoints * 3):
+            sums[:, col] = np.bincount(block_labels, minlength=nk,
+                                       weights=oriented[:, col])
+        counts = np.append(counts, np.zeros(nnew, dtype='int64'))
+        total = np.maximum(counts + block_counts, 1)[:, None]
+        old = np.append(centroids, np.zeros((nnew, npoints * 3)), axis=0)
+        centroids = ((old * counts[:, None] + sums) /
+                     total).astype('float32')
+        counts = counts + block_counts
+
+        c_means = segments(centroids.reshape(nk, npoints, 3))
+        _, first = np.unique(new, return_index=True)
+        c_parents = np.append(c_parents, parents[unassigned[first]])
+
+    return labels, centroids.reshape(-1, npoints, 3)
+
+
+class SegmentMeans(object):
+    """The mean points of the segments of streamline features.
+
+    The distance between (size-weighted) segment means is a lower bound
+    on the average pointwise distance; so is the distance between the
+    overall mean points.
+    """
+
+    def __init__(self, npoints, nsegments=3):
+
+        nsegments = min(nsegments, npoints)
+        self.bounds = np.linspace(0, npoints, nsegments + 1).astype('int64')
+        self.sizes = np.diff(self.bounds)
+        self.weights = self.sizes / npoints
+
+    def __call__(self, features):
+        """Return the segment means [N x nsegments x 3] of features."""
+
+        features = np.asarray(features, dtype='float64')
+        if not len(features):
+            return np.zeros((0, len(self.sizes), 3))
+
+        sums = np.add.reduceat(features, self.bounds[:-1], axis=1)
+
+        return sums / self.sizes[None, :, None]
+
+    def mean(self, means):
+        """Return the overall mean points from the segment means."""
+
+        return np.einsum('nsi,s->ni', means, self.weights)
+
+    def lower_bound(self, means, c_means):
+        """Return the lower bound for pairs of segment means."""
+
+        dist = np.sqrt(np.sum((means - c_means) ** 2, axis=2))
+
+        return np.dot(dist, self.weights)
+
+
+def candidate_distances(flats, means, parents, block,
+                        centroids, c_means, c_parents,
+                        threshold, maxpairs=4000000):
+    """Return the streamline-centroid pairs within the threshold.
+
+    'flats' and 'means' hold the features and segment means of the
+    streamlines in both orientations (direct, flipped).
+    The pairs are pruned with the distance between the mean points
+    (for all pairs at once; independent of the orientation) and between
+    the segment means, before the MDF distance is evaluated.
+    Returns the pairs (block row, centroid), their distances and
+    whether the flipped orientation is the closest.
+    """
+
+    empty = np.zeros(0, dtype='int64')
+    if not len(centroids):
+        return empty, empty, np.zeros(0), np.zeros(0, dtype='bool')
+
+    npoints = flats[0].shape[1] // 3
+    segments = SegmentMeans(npoints, means[0].shape[1])
+
+    # squared distances between the mean points
+    a = segments.mean(means[0][block])
+    c = segments.mean(c_means)
+    sqdist = np.sum(a ** 2, axis=1)[:, None] + np.sum(c ** 2, axis=1) - \
+        2 * np.dot(a, c.T)
+    candidates = sqdist < threshold ** 2 * (1 + 1e-6) + 1e-9
+    candidates &= parents[block][:, None] == c_parents[None, :]
+    b, k = np.nonzero(candidates)
+
+    dist = np.full((2, len(b)), np.inf)
+    step = max(maxpairs // npoints, 1)
+    for i in range(0, len(b), step):
+        rows, ks = block[b[i:i + step]], k[i:i + step]
+        for j, (flat, m) in enumerate(zip(flats, means)):
+            lower = segments.lower_bound(m[rows], c_means[ks])
+            keep = np.flatnonzero(lower < threshold)
+            diff = flat[rows[keep]] - centroids[ks[keep]]
+            diff = diff.reshape(-1, npoints, 3)
+            dist[j, i + keep] = np.sqrt(np.sum(diff ** 2,
+                                               axis=2)).mean(axis=1)
+
+    flip = dist[1] < dist[0]
+    dist = np.min(dist, axis=0)
+    within = dist < threshold
+
+    return b[within], k[within], dist[within], flip[within]
+
+
+def new_clusters(flats, parents, idxs, threshold, npoints):
+    """Cluster streamlines in order against their own running centroids.
+
+    Returns the (new) cluster label of every streamline and whether it
+    joined its cluster in the flipped orientation.
+    """
+
+    labels = np.zeros(len(idxs), dtype='int64')
+    flips = np.zeros(len(idxs), dtype='bool')
+    centroids = np.zeros((len(idxs), flats[0].shape[1]), dtype='float64')
+    c_parents = np.zeros(len(idxs), dtype='int64')
+    counts = np.zeros(len(idxs), dtype='int64')
+
+    nk = 0
+    for i, idx in enumerate(idxs):
+        if nk:
+            dist = []
+            for flat in flats:
+                diff = (centroids[:nk] - flat[idx]).reshape(nk, npoints, 3)
+                dist.append(np.sqrt(np.sum(diff ** 2, axis=2)).mean(axis=1))
+            flip = dist[1] < dist[0]
+            dist = np.minimum(dist[0], dist[1])
+            dist[c_parents[:nk] != parents[idx]] = np.inf
+            k = np.argmin(dist)
+            if dist[k] < threshold:
+                feature = flats[int(flip[k])][idx]
+                counts[k] += 1
+                centroids[k] += (feature - centroids[k]) / counts[k]
+                labels[i] = k
+                flips[i] = flip[k]
+                continue
+        centroids[nk] = flats[0][idx]
+        c_parents[nk] = parents[idx]
+        counts[nk] = 1
+        labels[i] = nk
+        nk += 1
+
+    return labels, flips
+
+
+def quickbundles_hierarchy(features, thresholds, **kwargs):
+    """Cluster streamline features at multiple thresholds.
+
+    The thresholds are processed from coarse to fine; every level is
+    clustered within the clusters of the previous level, yielding nested
+    clusterings. Returns a list of (threshold, labels, centroids).
+    """
+
+    levels = []
+    parents = None
+    for threshold in sorted(thresholds, reverse=True):
+        labels, centroids = quickbundles(features, threshold, parents,
+                                         **kwargs)
+        levels.append((threshold, labels, centroids))
+        parents = labels
+
+    return levels
+
+
+def labels_to_clusters(labels, centroids):
+    """Return a list of Clusters from cluster labels and centroids."""
+
+    order = np.argsort(labels, kind='mergesort')
+    counts = np.bincount(labels, minlength=len(centroids))
+    indices = np.split(order, np.cumsum(counts)[:-1])
+
+    return [Cluster(i, idxs, centroid)
+            for i, (idxs, centroid) in enumerate(zip(indices, centroids))
+            if len(idxs)]
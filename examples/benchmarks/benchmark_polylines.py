@@ -0,0 +1,118 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# <pep8 compliant>
+
+
+"""The NeuroBlender polyline benchmark.
+
+NeuroBlender is a Blender add-on to create artwork from neuroscientific data.
+This script compares building tract splines point by point (make_polyline)
+with the bulk foreach_set path (make_polylines), e.g.:
+blender -b -P benchmark_polylines.py -- --nstreamlines 10000 --npoints 100
+"""
+
+
+import sys
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+
+import bpy
+
+from NeuroBlender import streamlines as nb_sl
+from NeuroBlender import utils as nb_ut
+
+
+def random_streamlines(nstreamlines, npoints, seed=0):
+    """Generate a packed set of random-walk streamlines with radii."""
+
+    rng = np.random.RandomState(seed)
+    steps = rng.normal(size=(nstreamlines, npoints, 3))
+    points = np.cumsum(steps, axis=1).reshape(-1, 3).astype('float32')
+    lengths = np.full(nstreamlines, npoints, dtype='int64')
+    offsets = np.arange(nstreamlines, dtype='int64') * npoints
+    data = {'radius': rng.uniform(0.1, 0.3, len(points)).astype('float32')}
+
+    return nb_sl.Streamlines(points, offsets, lengths, data)
+
+
+def time_loop(streamlines):
+    """Build the splines with the per-point make_polyline loop."""
+
+    curve = bpy.data.curves.new(name="bench_loop", type='CURVE')
+    curve.dimensions = '3D'
+    # the per-point loop takes the radius from a fourth column
+    points = np.column_stack((streamlines.points,
+                              streamlines.data['radius']))
+
+    t0 = time.time()
+    for start, length in zip(streamlines.offsets, streamlines.lengths):
+        nb_ut.make_polyline(curve, points[start:start + length])
+    t1 = time.time()
+
+    bpy.data.curves.remove(curve)
+
+    return t1 - t0
+
+
+def time_bulk(streamlines):
+    """Build the splines with the bulk make_polylines function."""
+
+    curve = bpy.data.curves.new(name="bench_bulk", type='CURVE')
+    curve.dimensions = '3D'
+
+    t0 = time.time()
+    nb_ut.make_polylines(curve, streamlines)
+    t1 = time.time()
+
+    bpy.data.curves.remove(curve)
+
+    return t1 - t0
+
+
+def run_benchmark(argv):
+    """Time both spline builders on the same random streamlines."""
+
+    if "--" not in argv:
+        argv = []  # as if no args are passed
+    else:
+        argv = argv[argv.index("--") + 1:]  # get all args after "--"
+
+    parser = ArgumentParser(description='NeuroBlender polyline benchmark.')
+    parser.add_argument('--nstreamlines', type=int, default=10000,
+                        help='the number of streamlines')
+    parser.add_argument('--npoints', type=int, default=100,
+                        help='the number of points per streamline')
+    args = parser.parse_args(argv)
+
+    streamlines = random_streamlines(args.nstreamlines, args.npoints)
+
+    t_loop = time_loop(streamlines)
+    t_bulk = time_bulk(streamlines)
+
+    infostring = "{:d} streamlines x {:d} points: "
+    infostring += "make_polyline {:.2f}s; make_polylines {:.2f}s; "
+    infostring += "speedup {:.1f}x"
+    print(infostring.format(args.nstreamlines, args.npoints,
+                            t_loop, t_bulk, t_loop / max(t_bulk, 1e-9)))
+
+
+if __name__ == "__main__":
+    run_benchmark(sys.argv)
@@ -0,0 +1,277 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# <pep8 compliant>
+
+"""The NeuroBlender imports (cache) module.
+
+NeuroBlender is a Blender add-on to create artwork from neuroscientific data.
+This module implements an on-disk cache of parsed streamlines
+(independent of Blender).
+Every cache entry is a directory holding the packed points, offsets,
+lengths and data columns as .npy files that are memory-mapped on loading.
+"""
+
+
+import os
+import json
+import shutil
+import hashlib
+
+import numpy as np
+
+from .. import streamlines as nb_sl
+
+
+CACHE_VERSION = 1
+NPY_HEADER_SIZE = 128
+
+
+def cache_dir(projectdir):
+    """Return the streamline cache directory of a project."""
+
+    return os.path.join(projectdir, '.nb_cache', 'streamlines')
+
+
+def file_hash(fpath, blocksize=16777216):
+    """Return the SHA-1 hash of the content of a file."""
+
+    sha1 = hashlib.sha1()
+    with open(fpath, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            sha1.update(block)
+
+    return sha1.hexdigest()
+
+
+def options_hash(options=None):
+    """Return a stable hash of a dict of reader options."""
+
+    optstring = json.dumps(options or {}, sort_keys=True, default=repr)
+
+    return hashlib.sha1(optstring.encode("utf-8")).hexdigest()
+
+
+def reader_name(read_fun):
+    """Return the (qualified) name of a reader function."""
+
+    read_fun = getattr(read_fun, 'func', read_fun)  # functools.partial
+
+    return '{}.{}'.format(getattr(read_fun, '__module__', ''),
+                          getattr(read_fun, '__qualname__', repr(read_fun)))
+
+
+def cache_key(fpath, use_hash=False, reader='', options=None):
+    """Return the cache key of a file.
+
+    The key is derived from the absolute path, size and modification time
+    of the file, the name and options of the reader
+    and (optionally) from a hash of its content.
+    """
+
+    stat = os.stat(fpath)
+    fields = [os.path.abspath(fpath), stat.st_size, repr(stat.st_mtime),
+              CACHE_VERSION, reader, options_hash(options)]
+    if use_hash:
+        fields.append(file_hash(fpath))
+    keystring = '|'.join(str(field) for field in fields)
+
+    return hashlib.sha1(keystring.encode("utf-8")).hexdigest()
+
+
+def read_streamlines_cached(fpath, read_fun, cachedir,
+                            maxsize=10 * 1024 ** 3, use_hash=False,
+                            options=None):
+    """Return the streamlines of a file through the cache.
+
+    On a cache miss, the file is read with read_fun(fpath) and the
+    streamlines are written to the cache (evicting the least recently
+    used entries beyond 'maxsize' bytes). If the cache cannot be written,
+    the streamlines are returned as read.
+    'options' are the reader options that read_fun applies
+    (e.g. {'radius_factor_soma': 0.5}); they are part of the cache key.
+    """
+
+    key = cache_key(fpath, use_hash, reader_name(read_fun), options)
+    entrydir = os.path.join(cachedir, key)
+
+    streamlines = load_entry(entrydir)
+    if streamlines is not None:
+        return streamlines
+
+    streamlines = read_fun(fpath)
+    try:
+        save_entry(entrydir, streamlines, fpath)
+    except (IOError, OSError):
+        shutil.rmtree(entrydir + '.tmp', ignore_errors=True)
+        return streamlines
+
+    evict(cachedir, maxsize, keep=[key])
+
+    cached = load_entry(entrydir)
+
+    return streamlines if cached is None else cached
+
+
+def load_entry(entrydir):
+    """Load (memory-map) the streamlines of a cache entry (or None)."""
+
+    try:
+        with open(os.path.join(entrydir, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta['version'] != CACHE_VERSION:
+            return None
+        points = np.load(os.path.join(entrydir, 'points.npy'), mmap_mode='r')
+        offsets = np.load(os.path.join(entrydir, 'offsets.npy'))
+        lengths = np.load(os.path.join(entrydir, 'lengths.npy'))
+        data = {name: np.load(os.path.join(entrydir, fname), mmap_mode='r')
+                for name, fname in meta['columns'].items()}
+    except (IOError, OSError, ValueError, KeyError):
+        return None
+
+    # mark the entry as recently used
+    os.utime(os.path.join(entrydir, 'meta.json'), None)
+
+    return nb_sl.Streamlines(points, offsets, lengths, data)
+
+
+def save_entry(entrydir, streamlines, fpath=''):
+    """Write streamlines to a cache entry, chunk by chunk.
+
+    The entry is written to a temporary directory and moved in place
+    when complete, such that partial entries are never loaded.
+    """
+
+    tmpdir = entrydir + '.tmp'
+    shutil.rmtree(tmpdir, ignore_errors=True)
+    os.makedirs(tmpdir)
+
+    writers = {}
+    lengths = []
+    try:
+        for chunk in streamlines.chunks():
+            lengths.append(chunk.lengths)
+            columns = [('points', chunk.points)] + sorted(chunk.data.items())
+            for name, values in columns:
+                if name not in writers:
+                    fname = 'data{:02d}.npy'.format(len(writers) - 1)
+                    if name == 'points':
+                        fname = 'points.npy'
+                    writers[name] = NpyWriter(os.path.join(tmpdir, fname),
+                                              values)
+                writers[name].write(values)
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+    if 'points' not in writers:
+        np.save(os.path.join(tmpdir, 'points.npy'),
+                np.zeros((0, 3), dtype='float32'))
+
+    lengths = np.concatenate(lengths) if lengths else np.zeros(0, 'int64')
+    offsets = np.append(0, np.cumsum(lengths)[:-1])[:len(lengths)]
+    np.save(os.path.join(tmpdir, 'offsets.npy'), offsets.astype('int64'))
+    np.save(os.path.join(tmpdir, 'lengths.npy'), lengths.astype('int64'))
+
+    meta = {'version': CACHE_VERSION,
+            'source': os.path.abspath(fpath) if fpath else '',
+            'columns': {name: os.path.basename(writer.fpath)
+                        for name, writer in writers.items()
+                        if name != 'points'}}
+    with open(os.path.join(tmpdir, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+    shutil.rmtree(entrydir, ignore_errors=True)
+    os.rename(tmpdir, entrydir)
+
+
+class NpyWriter(object):
+    """Append rows to a .npy file of unknown final length.
+
+    A fixed-size header is reserved and rewritten with the final shape
+    when the writer is closed.
+    """
+
+    def __init__(self, fpath, template):
+
+        self.fpath = fpath
+        self.dtype = np.dtype(template.dtype).newbyteorder('<')
+        if template.dtype.kind == 'f':
+            self.dtype = np.dtype('<f4')
+        self.rowshape = template.shape[1:]
+        self.nrows = 0
+        self.f = open(fpath, 'wb')
+        self.f.write(b'\x00' * NPY_HEADER_SIZE)
+
+    def write(self, values):
+        """Append the rows in values."""
+
+        values = np.ascontiguousarray(values, dtype=self.dtype)
+        self.f.write(values.tobytes())
+        self.nrows += len(values)
+
+    def close(self):
+        """Write the header and close the file."""
+
+        if self.f.closed:
+            return
+
+        shape = (self.nrows,) + tuple(self.rowshape)
+        header = "{{'descr': '{}', 'fortran_order': False, 'shape': {}, }}"
+        header = header.format(self.dtype.str, shape)
+        header = header.ljust(NPY_HEADER_SIZE - 10 - 1) + '\n'
+        self.f.seek(0)
+        self.f.write(b'\x93NUMPY\x01\x00')
+        self.f.write(np.array(len(header), dtype='<u2').tobytes())
+        self.f.write(header.encode('latin1'))
+        self.f.close()
+
+
+def entry_size(entrydir):
+    """Return the size in bytes of a cache entry."""
+
+    return sum(os.path.getsize(os.path.join(entrydir, fname))
+               for fname in os.listdir(entrydir))
+
+
+def evict(cachedir, maxsize, keep=[]):
+    """Remove the least recently used entries beyond maxsize bytes."""
+
+    entries = []
+    for key in os.listdir(cachedir):
+        entrydir = os.path.join(cachedir, key)
+        metafile = os.path.join(entrydir, 'meta.json')
+        if not os.path.isfile(metafile):
+            continue
+        entries.append((os.path.getmtime(metafile), key,
+                        entry_size(entrydir)))
+
+    total = sum(entry[2] for entry in entries)
+    for _, key, size in sorted(entries):
+        if total <= maxsize:
+            break
+        if key in keep:
+            continue
+        shutil.rmtree(os.path.join(cachedir, key), ignore_errors=True)
+        total -= size
+
+
+def clear(cachedir):
+    """Remove all entries from the cache."""
+
+    shutil.rmtree(cachedir, ignore_errors=True)
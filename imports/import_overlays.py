@@ -40,12 +40,14 @@ from bpy.props import (BoolProperty,
                        StringProperty,
                        CollectionProperty,
                        EnumProperty,
+                       FloatVectorProperty,
                        IntVectorProperty)
 from bpy_extras.io_utils import ImportHelper
 
 from .. import (materials as nb_ma,
                 properties as nb_pr,
                 utils as nb_ut)
+from . import readers as nb_rd
 
 
 class NB_OT_import_overlays(Operator, ImportHelper):
@@ -83,6 +85,14 @@ class NB_OT_import_overlays(Operator, ImportHelper):
         name="Spline postfix",
         description="Specify an re for the streamline naming",
         default='spl{:08d}')
+    scalar_percentiles = FloatVectorProperty(
+        name="Percentiles",
+        description="""Clip the tract scalars to a percentile range
+            (robust normalization; [0, 100] uses the full range)""",
+        default=[0., 100.],
+        min=0.,
+        max=100.,
+        size=2)
     overlaytype = EnumProperty(
         name="overlay type",
         description="switch between overlay types",
@@ -144,6 +154,9 @@ class NB_OT_import_overlays(Operator, ImportHelper):
             if obinfo['type'] == 'tracts':
                 row = layout.row()
                 row.prop(self, "spline_postfix")
+                if self.overlaytype in ('scalargroups'):
+                    row = layout.row()
+                    row.prop(self, "scalar_percentiles")
 
             expr = '{0}'
             if self.prefix_parentname:
@@ -157,7 +170,7 @@ class NB_OT_import_overlays(Operator, ImportHelper):
             row.label(text='Timepoint name: {}'.format(tpname))
 
             if obinfo['type'] == 'tracts':
-                splname = '{}.{}'.format(tpname, self.spline_postfix)
+                splname = '{}.{}'.format(ovname, self.spline_postfix)
                 row = layout.row()
                 row.label(text='Spline name: {}'.format(splname))
 
@@ -198,6 +211,8 @@ class NB_OT_import_overlays(Operator, ImportHelper):
             elif self.overlaytype == 'bordergroups':
                 fun = self.import_surfaces_bordergroups
         group = fun(context, name, fpath, parent, parent_ob)
+        if group is None:
+            return 'failed'
 
         context.scene.objects.active = parent_ob
         parent_ob.select = True
@@ -218,23 +233,60 @@ class NB_OT_import_overlays(Operator, ImportHelper):
         # load the data
         sg_data = self.read_tractscalar(fpath, self.timeseries_slice)
 
+        argdict = {"prefix_parentname": self.prefix_parentname,
+                   "timepoint_postfix": self.timepoint_postfix,
+                   "spline_postfix": self.spline_postfix,
+                   "percentiles": tuple(self.scalar_percentiles)}
+
+        group = self.tracts_scalargroup_to_nb(context, name, fpath, sg_data,
+                                              parent, ob, argdict)
+        if group is None:
+            info = "import failed: {} has {} streamlines; {} has {} splines"
+            info = info.format(fpath, len(sg_data[0]),
+                               parent.name, len(ob.data.splines))
+            self.report({'ERROR'}, info)
+
+        return group
+
+    @staticmethod
+    def tracts_scalargroup_to_nb(context, name, fpath, sg_data, parent, ob,
+                                 argdict={"prefix_parentname": True,
+                                          "timepoint_postfix": 'vol{:04d}',
+                                          "spline_postfix": 'spl{:08d}',
+                                          "percentiles": (0., 100.)}):
+        """Add scalar overlay data to a tract object.
+
+        'sg_data' is a list of timepoints,
+        each holding a list of per-point scalars for every streamline.
+        Returns None if the number of streamlines does not match the
+        number of splines of the tract (e.g. a weeded tract).
+        """
+
+        cls = NB_OT_import_overlays
+
+        if len(sg_data[0]) != len(ob.data.splines):
+            return None
+
         # normalize between 0  and 1
-        datadict = self.normalize_data(sg_data)
+        percentiles = argdict.get('percentiles', (0., 100.))
+        datadict = cls.normalize_data(sg_data, percentiles)
 
         # unique names for the group and items
-        _, ovc, oic = self.get_all_nb_collections(context)
+        _, ovc, oic = cls.get_all_nb_collections(context)
         coll_groupname = ovc
         coll_itemnames = oic
 
         ca = [coll_groupname, coll_itemnames]
-        funs = [self.fun_groupname, self.fun_itemnames_scalargroups]
-        argdict = {k: datadict[k] for k in ['nscalars', 'nstreamlines']}
+        funs = [cls.fun_groupname, cls.fun_itemnames_scalargroups]
+        argdict = dict(argdict)
+        argdict.update({k: datadict[k] for k in ['nscalars', 'nstreamlines']})
         groupnames, itemnames = nb_ut.compare_names(name, ca, funs, argdict)
 
         # create the group
         props = {"name": groupnames[0],
                  "filepath": fpath,
-                 "prefix_parentname": self.prefix_parentname,
+                 "prefix_parentname": argdict['prefix_parentname'],
+                 "spline_postfix": argdict['spline_postfix'],
                  "range": datadict['scalargroup_range']}
         group = nb_ut.add_item(parent, "scalargroups", props)
         if datadict['nscalars'] == 1:
@@ -246,29 +298,35 @@ class NB_OT_import_overlays(Operator, ImportHelper):
         nodegroup = nb_ma.make_cr_matgroup_tract_sg(diffcol, 0.04, group)
 
         # add the items
-        for _ in range(1, len(ob.data.materials)):
-            ob.data.materials.pop(1)
-
         for itemname, scalardict in zip(itemnames, datadict['scalars']):
 
             props = {"name": itemname,
                      "filepath": fpath,
                      "range": scalardict['range']}
-            item = nb_ut.add_item(group, "scalars", props)
+            nb_ut.add_item(group, "scalars", props)
+
+        # pack all timepoints into one atlas with a material per streamline
+        atlasname = '{}.atlas'.format(group.name)
+        img, layout = cls.create_overlay_tract_atlas(atlasname,
+                                                     datadict['scalars'],
+                                                     datadict['lengths'])
+        atlasgroup = nb_ma.make_cr_atlasgroup_tract_sg(
+            img, layout['layerrows'], group)
 
-            it = zip(ob.data.splines, scalardict['data'])
-            for j, (spl, sl) in enumerate(it):
+        for _ in range(1, len(ob.data.materials)):
+            ob.data.materials.pop(1)
 
-                expr = '{}.{}'.format('{}', self.spline_postfix)
-                splname = expr.format(item.name, j)
-                # FIXME: crazy to make a material/image per streamline!
-                # FIXME: ensure name end in splinenumber identifier
-                img = self.create_overlay_tract_img(splname, sl)
-                mat = nb_ma.make_cr_mat_tract_sg(splname, img, nodegroup)
-                mat.use_fake_user = True
-                if itemname == itemnames[0]:
-                    ob.data.materials.append(mat)
-                    spl.material_index = len(ob.data.materials) - 1
+        expr = '{}.{}'.format(group.name, argdict['spline_postfix'])
+        it = zip(layout['offset'], layout['row'], layout['scale'])
+        for j, (offset, row, scale) in enumerate(it):
+            # FIXME: ensure name end in splinenumber identifier
+            mat = nb_ma.make_cr_mat_tract_sg(expr.format(j), nodegroup,
+                                             atlasgroup, offset, row, scale)
+            mat.use_fake_user = True
+            ob.data.materials.append(mat)
+
+        mat_idxs = np.arange(1, len(ob.data.splines) + 1, dtype='int32')
+        ob.data.splines.foreach_set('material_index', mat_idxs)
 
         return group
 
@@ -282,24 +340,9 @@ class NB_OT_import_overlays(Operator, ImportHelper):
             scalar = np.load(fpath)
             scalars = [scalar]
 
-        elif ext in ('.npz'):
-            npzfile = np.load(fpath)
-            for k in npzfile:
-                scalar.append(npzfile[k])
-            scalars = [scalar]
-
-        elif ext in ('.asc'):
+        elif ext in ('.npz', '.asc', '.tsf'):
             # mrtrix convention assumed (1 streamline per line)
-            scalar = []
-            with open(fpath) as f:
-                for line in f:
-                    tokens = line.rstrip("\n").split(' ')
-                    points = []
-                    for token in tokens:
-                        if token:
-                            points.append(float(token))
-                    scalar.append(points)
-            scalars = [scalar]
+            scalars = [nb_rd.read_tract_scalars(fpath)]
 
         elif ext in ('.pickle'):
             with open(fpath, 'rb') as f:
@@ -312,66 +355,115 @@ class NB_OT_import_overlays(Operator, ImportHelper):
         return scalars
 
     @staticmethod
-    def normalize_data(nn_groupdata):
-        """"Normalize the data in the scalargroup between 0 and 1."""
+    def normalize_data(nn_groupdata, percentiles=(0., 100.)):
+        """"Normalize the data in the scalargroup between 0 and 1.
+
+        The scalars of every timepoint are packed into one float32 array
+        and scaled in place to the range of the scalargroup.
+        With percentiles other than [0, 100], the range of a timepoint is
+        the (histogram-based) percentile range and the data are clipped.
+        """
+
+        lengths = np.array([len(sl) for sl in nn_groupdata[0]],
+                           dtype='int64')
+        clip = tuple(percentiles) != (0., 100.)
 
         # get ranges of timepoints
         dranges = []
+        packed = []
         for nn_data in nn_groupdata:
-            dmin = float('Inf')
-            dmax = -float('Inf')
-            for streamline in nn_data:
-                dmin = min(dmin, min(streamline))
-                dmax = max(dmax, max(streamline))
-            dranges.append([dmin, dmax])
+            data = np.concatenate(nn_data).astype('float32', copy=False)
+            drange = [float(np.amin(data)), float(np.amax(data))]
+            if clip:
+                drange = nb_ut.histogram_percentiles(data, percentiles,
+                                                     drange=drange)
+            dranges.append(drange)
+            packed.append(data)
 
         # overlay range
         gmin = np.amin(np.array(dranges))
         gmax = np.amax(np.array(dranges))
-        gdiff = gmax - gmin
+        gdiff = (gmax - gmin) or 1.
 
         datadict = {}
         datadict['scalars'] = []
-        for drange, nn_data in zip(dranges, nn_groupdata):
+        for drange, data in zip(dranges, packed):
+            data -= gmin
+            data *= 1. / gdiff
+            if clip:
+                np.clip(data, 0., 1., out=data)
             scalardict = {}
             scalardict['range'] = drange
-            scalardict['data'] = [(np.array(streamline) - gmin) / gdiff
-                                  for streamline in nn_data]
+            scalardict['data'] = data
             datadict['scalars'].append(scalardict)
 
         datadict['scalargroup_range'] = (gmin, gmax)
         datadict['nscalars'] = len(datadict['scalars'])
-        datadict['nstreamlines'] = len(datadict['scalars'][0]['data'])
+        datadict['nstreamlines'] = len(lengths)
+        datadict['lengths'] = lengths
 
         return datadict
 
     @staticmethod
-    def create_overlay_tract_img(name, scalar):
-        """Create an Nx1 image from a streamline's scalar data."""
+    def create_overlay_tract_atlas(name, scalars, lengths, maxsize=8192):
+        """Create a float image atlas from the scalars of all streamlines.
+
+        The packed scalars of a timepoint are written contiguously and
+        wrapped across the rows of the image (at most 'maxsize' wide);
+        the layers of the timepoints are stacked vertically.
+        Returns the image and the layout in pixels: the column and row
+        of the first scalar of every streamline, its number of scalars
+        minus one (the scale along the streamline),
+        and the number of rows of a layer.
+        """
+
+        data = [scalardict['data'] for scalardict in scalars]
+        npoints, nlayers = int(np.sum(lengths)), len(data)
+        offsets = np.append(0, np.cumsum(lengths)[:-1])
+
+        width = int(np.ceil(np.sqrt(max(npoints * nlayers, 1))))
+        width = int(np.clip(width, 1, maxsize))
+        layerrows = max(-(-npoints // width), 1)
+        shape = (nlayers * layerrows, width)
 
-        # TODO: use numpy here?
-        # FIXME: pack images?
-        vals = [[val, val, val, 1.0] for val in scalar]
-        pixels = [chan for px in vals for chan in px]
+        pixels = np.ones((nlayers, layerrows * width, 4), dtype='float32')
+        for layer, packed in enumerate(data):
+            pixels[layer, :npoints, :3] = packed[:, None]
 
-        img = bpy.data.images.new(name, len(scalar), 1)
-        img.pixels = pixels
+        img = bpy.data.images.new(name, shape[1], shape[0], float_buffer=True)
+        img.pixels = pixels.ravel()
         img.source = 'GENERATED'
         img.use_fake_user = True
 
-        return img
+        row, offset = np.divmod(offsets, width)
+        layout = {'offset': offset,
+                  'row': row,
+                  'scale': np.maximum(np.asarray(lengths) - 1, 0),
+                  'layerrows': layerrows}
+
+        return img, layout
 
     def import_tracts_labelgroups(self, context, name, fpath, parent, ob):
         """Import a label overlay onto a tract object."""
 
         # load the data (one value per spline) and flatten
         lg_data = self.read_tractscalar(fpath)
-        lg_data = [int(val)
-                   for list1 in lg_data
-                   for list2 in list1
-                   for val in list2]
-
-        labelvalues = sorted(set(lg_data))
+        lg_data = np.concatenate([np.ravel(tp)
+                                  if isinstance(tp, np.ndarray) and
+                                  tp.dtype != object
+                                  else np.concatenate(tp)
+                                  for tp in lg_data]).astype('int64')
+
+        # the label of every spline as an index into the labelvalues
+        labelvalues, lab_idxs = np.unique(lg_data, return_inverse=True)
+        if len(lab_idxs) != len(ob.data.splines):
+            info = "import failed: {} has {} streamlines; {} has {} splines"
+            info = info.format(fpath, len(lab_idxs),
+                               parent.name, len(ob.data.splines))
+            self.report({'ERROR'}, info)
+            return None
+
+        labelvalues = [int(labelvalue) for labelvalue in labelvalues]
         itemnames = ['label{:05d}'.format(labelvalue)
                      for labelvalue in labelvalues]
 
@@ -409,11 +501,16 @@ class NB_OT_import_overlays(Operator, ImportHelper):
                      "colour_custom": diffcol}
             nb_ut.add_item(group, "labels", props)
 
-        # set the material indices
-        for spl, labelval in zip(ob.data.splines, lg_data):
-            itemname = '{}.label{:05d}'.format(name, labelval)
-            mat_idx = ob.material_slots.find(itemname)
-            spl.material_index = mat_idx
+        # set the material indices (label i is in material slot i+1)
+        mat_idxs = (lab_idxs + 1).astype('int32')
+        ob.data.splines.foreach_set('material_index', mat_idxs)
+
+        # store the splines of every label
+        order = np.argsort(lab_idxs, kind='mergesort')
+        counts = np.bincount(lab_idxs, minlength=len(labelvalues))
+        splidxs = np.split(order, np.cumsum(counts)[:-1])
+        for label, idxs in zip(group.labels, splidxs):
+            nb_ut.set_label_splines(label, idxs)
 
         return group
 
@@ -447,7 +544,9 @@ class NB_OT_import_overlays(Operator, ImportHelper):
 
         ca = [coll_groupname, coll_itemnames]
         funs = [self.fun_groupname, self.fun_itemnames_scalargroups]
-        argdict = {'nscalars': len(timeseries)}
+        argdict = {'nscalars': len(timeseries),
+                   'prefix_parentname': self.prefix_parentname,
+                   'timepoint_postfix': self.timepoint_postfix}
         groupnames, itemnames = nb_ut.compare_names(name, ca, funs, argdict)
 
         # create the group
@@ -914,18 +1013,20 @@ class NB_OT_import_overlays(Operator, ImportHelper):
 
         return obc, ovc, oic
 
-    def fun_groupname(self, name, argdict):
+    @staticmethod
+    def fun_groupname(name, argdict):
         """Generate overlay group names."""
 
         names = [name]
 
         return names
 
-    def fun_itemnames_scalargroups(self, name, argdict):
+    @staticmethod
+    def fun_itemnames_scalargroups(name, argdict):
         """Generate overlay scalar (timepoint/volume) names."""
 
-        expr = self.timepoint_postfix
-        if self.prefix_parentname:
+        expr = argdict['timepoint_postfix']
+        if argdict['prefix_parentname']:
             expr = '{}.{}'.format(name, expr)
         names = [expr.format(i, name)
                  for i in range(argdict['nscalars'])]
@@ -959,9 +1060,7 @@ class NB_OT_import_overlays(Operator, ImportHelper):
     def fun_splinenames(self, name, argdict):
         """Generate tract scalargroup spline names."""
 
-        expr = '{}.{}'.format('{}', self.spline_postfix)
-        names = [expr.format(tpname, j)
-                 for tpname in self.fun_itemnames_scalargroups(name, argdict)
-                 for j in range(argdict['nstreamlines'])]
+        expr = '{}.{}'.format(name, argdict['spline_postfix'])
+        names = [expr.format(j) for j in range(argdict['nstreamlines'])]
 
         return names
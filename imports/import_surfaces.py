@@ -43,6 +43,7 @@ from bpy_extras.io_utils import ImportHelper
 
 from .. import (materials as nb_ma,
                 utils as nb_ut)
+from . import readers as nb_rd
 
 
 class NB_OT_import_surfaces(Operator, ImportHelper):
@@ -60,7 +61,7 @@ class NB_OT_import_surfaces(Operator, ImportHelper):
         default="*.obj;*.stl;" +
                 "*.gii;" +
                 "*.white;*.pial;*.inflated;*.sphere;*.orig;" +
-                "*.vtk;" + "*.blend;")
+                "*.vtk;*.vtp;" + "*.blend;")
 
     name = StringProperty(
         name="Name",
@@ -148,6 +149,8 @@ class NB_OT_import_surfaces(Operator, ImportHelper):
         - .white/.pial/.inflated/.sphere/.orig (FreeSurfer)
         - .obj
         - .stl
+        - .vtk (vtk polydata (ASCII/BINARY))
+        - .vtp (vtk XML polydata)
         - .blend
 
         'sformfile' sets matrix_world to affine transformation.
@@ -364,57 +367,42 @@ class NB_OT_import_surfaces(Operator, ImportHelper):
     def read_surfaces_vtk(self, fpath, name, sformfile=""):
         """Return a surface in a .vtk polygon file."""
 
-        verts, faces = self.import_vtk_polygons(fpath)
-
-        verts = [tuple(vert) for vert in verts]
-        faces = [tuple(face) for face in faces]
+        polydata = nb_rd.read_vtk_polydata(fpath)
+        lengths, connectivity = polydata['polys']
         affine = Matrix()
 
-        me = bpy.data.meshes.new(name)
-        me.from_pydata(verts, [], faces)
+        me = self.polygons_to_mesh(name, polydata['points'],
+                                   lengths, connectivity)
         ob = bpy.data.objects.new(name, me)
         bpy.context.scene.objects.link(ob)
 
         return [(ob, affine, sformfile)]
 
+    def read_surfaces_vtp(self, fpath, name, sformfile=""):
+        """Return a surface in a VTK XML .vtp polygon file."""
+
+        return self.read_surfaces_vtk(fpath, name, sformfile)
+
     @staticmethod
-    def import_vtk_polygons(vtkfile):
-        """Read points and polylines from file"""
-
-        with open(vtkfile) as f:
-            read_points = 0
-            read_polygons = 0
-            for line in f:
-                tokens = line.rstrip("\n").split(' ')
-
-                if tokens[0] == "POINTS":
-                    read_points = 1
-                    npoints = int(tokens[1])
-                    points = []
-                elif read_points == 1 and len(points) < npoints * 3:
-                    for token in tokens:
-                        if token:
-                            points.append(float(token))
-
-                elif tokens[0] == "POLYGONS":
-                    read_polygons = 1
-                    npolys = int(tokens[1])
-                    polygons = []
-                elif read_polygons == 1 and len(polygons) < npolys:
-                    polygon = []
-                    for token in tokens[1:]:
-                        if token:
-                            polygon.append(int(token))
-                    polygons.append(polygon)
-
-                elif tokens[0] == '':
-                    pass
-                else:
-                    pass
-
-            points = np.reshape(np.array(points), (npoints, 3))
-
-        return points, polygons
+    def polygons_to_mesh(name, verts, lengths, connectivity):
+        """Create a mesh from packed polygons with foreach_set."""
+
+        me = bpy.data.meshes.new(name)
+
+        me.vertices.add(len(verts))
+        me.vertices.foreach_set("co", np.ravel(verts).astype('float32'))
+
+        me.loops.add(len(connectivity))
+        me.loops.foreach_set("vertex_index", connectivity.astype('int32'))
+
+        loop_start = np.append(0, np.cumsum(lengths)[:-1])[:len(lengths)]
+        me.polygons.add(len(lengths))
+        me.polygons.foreach_set("loop_start", loop_start.astype('int32'))
+        me.polygons.foreach_set("loop_total", lengths.astype('int32'))
+
+        me.update(calc_edges=True)
+
+        return me
 
     @staticmethod
     def beautification(ob, argdict={"iterations": 10, "factor": 0.5,
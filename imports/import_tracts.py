@@ -28,8 +28,8 @@ This module implements importing tracts into NeuroBlender.
 
 import os
 import sys
+import time
 import importlib
-import random
 from mathutils import Vector, Matrix
 from glob import glob
 
@@ -50,7 +50,12 @@ from bpy.props import (BoolProperty,
 from bpy_extras.io_utils import ImportHelper
 
 from .. import (materials as nb_ma,
+                properties as nb_pr,
+                streamlines as nb_sl,
                 utils as nb_ut)
+from . import (cache as nb_ca,
+               import_overlays as nb_im,
+               readers as nb_rd)
 
 
 class NB_OT_import_tracts(Operator, ImportHelper):
@@ -65,7 +70,7 @@ class NB_OT_import_tracts(Operator, ImportHelper):
     filter_glob = StringProperty(
         options={"HIDDEN"},
         # NOTE: multiline comment """ """ not working here
-        default="*.vtk;" +
+        default="*.vtk;*.vtp;" +
                 "*.bfloat;*.Bfloat;*.bdouble;*.Bdouble;" +
                 "*.tck;*.trk;" +
                 "*.npy;*.npz;*.dpy")
@@ -89,12 +94,73 @@ class NB_OT_import_tracts(Operator, ImportHelper):
         default=1.,
         min=0.,
         max=1.)
+    resample_mode = EnumProperty(
+        name="Resampling",
+        description="Resampling scheme for the individual streamlines",
+        default="subsample",
+        items=[("subsample", "subsample",
+                "Keep every int(1/interpolate)-th point", 0),
+               ("step", "arc-length step",
+                "Resample at a fixed arc-length step", 1),
+               ("count", "point count",
+                "Resample to a fixed number of points", 2),
+               ("rdp", "simplify",
+                "Ramer-Douglas-Peucker simplification", 3)])
+    resample_step = FloatProperty(
+        name="Step",
+        description="Arc-length step between resampled points",
+        default=1.,
+        min=0.001,
+        subtype="DISTANCE")
+    resample_npoints = IntProperty(
+        name="Points",
+        description="Number of points per resampled streamline",
+        default=20,
+        min=2)
+    rdp_tolerance = FloatProperty(
+        name="Tolerance",
+        description="Maximal deviation from the original streamline",
+        default=0.1,
+        min=0.,
+        subtype="DISTANCE")
     weed_tract = FloatProperty(
         name="Tract weeding",
         description="Retain a random selection of streamlines",
         default=1.,
         min=0.,
         max=1.)
+    weed_mode = EnumProperty(
+        name="Weeding mode",
+        description="Sampling scheme for tract weeding",
+        default="random",
+        items=[("random", "random",
+                "Simple random sample of streamlines", 0),
+               ("length", "length",
+                "Sample within streamline length quantiles", 1),
+               ("endpoints", "endpoints",
+                "Sample within grid cells of the endpoints", 2),
+               ("label", "label",
+                "Sample within the labels of a data column", 3)])
+    weed_seed = IntProperty(
+        name="Weeding seed",
+        description="Seed of the random selection of streamlines",
+        default=0,
+        min=0)
+    weed_nstrata = IntProperty(
+        name="Length quantiles",
+        description="Number of length quantiles to sample within",
+        default=10,
+        min=1)
+    weed_cellsize = FloatProperty(
+        name="Endpoint cellsize",
+        description="Size of the endpoint grid cells to sample within",
+        default=10.,
+        min=0.,
+        subtype="DISTANCE")
+    weed_label = StringProperty(
+        name="Label",
+        description="Name of the data column with streamline labels",
+        default="structure")
 
     beautify = BoolProperty(
         name="Beautify",
@@ -160,26 +226,164 @@ class NB_OT_import_tracts(Operator, ImportHelper):
         description="Create a QuickBundles centroids object",
         default=False)
 
+    import_scalars = BoolProperty(
+        name="Import scalars",
+        description="""Add per-point scalars in the file as scalargroups
+            (a material per streamline; slow for large tracts)""",
+        default=False)
+
+    use_lod = BoolProperty(
+        name="Viewport proxy",
+        description="Show a decimated proxy in the viewport; render in full",
+        default=False)
+    lod_weed = FloatProperty(
+        name="Proxy weeding",
+        description="Fraction of the streamlines retained in the proxy",
+        default=0.1,
+        min=0.,
+        max=1.)
+    lod_tolerance = FloatProperty(
+        name="Proxy tolerance",
+        description="Simplification tolerance of the proxy streamlines",
+        default=1.,
+        min=0.,
+        subtype="DISTANCE")
+
+    use_modal = BoolProperty(
+        name="Modal",
+        description="Import in batches with progress report (ESC: cancel)",
+        default=False)
+    batchsize = IntProperty(
+        name="Batch size",
+        description="Number of points added to the curve per batch",
+        default=100000,
+        min=1000)
+
+    stages = ('parse', 'weed', 'resample', 'splines',
+              'materials', 'scalars', 'quickbundles', 'lod')
+
     def execute(self, context):
 
         filenames = [f.name for f in self.files]
         if not filenames:
             filenames = os.listdir(self.directory)
 
-        for f in filenames:
-            fpath = os.path.join(self.directory, f)
-            streamlines = self.read_streamlines_from_file(fpath)
-            # TODO: handle cases where transform info is included in tractfile
-            affine = nb_ut.read_affine_matrix(self.sformfile)
-            self.import_tract(
-                context, streamlines, fpath, affine, self.sformfile,
-                weed_tract=self.weed_tract,
-                interpolate_streamlines=self.interpolate_streamlines,
-                use_quickbundles=self.use_quickbundles,
-                )
+        fpaths = [os.path.join(self.directory, f) for f in filenames]
+
+        self.timings = {stage: 0. for stage in self.stages}
+        self.cancelled = False
+        self.steps = self.import_tracts_steps(context, fpaths)
+
+        if self.use_modal and context.window is not None:
+            wm = context.window_manager
+            wm.progress_begin(0, 100)
+            wm.modal_handler_add(self)
+            self.timer = wm.event_timer_add(0.01, context.window)
+            return {"RUNNING_MODAL"}
+
+        for _ in self.steps:
+            pass
+
+        self.report_timings()
 
         return {"FINISHED"}
 
+    def modal(self, context, event):
+
+        if event.type == 'ESC':
+            # finish the current tract with the streamlines built so far
+            self.cancelled = True
+            for _ in self.steps:
+                pass
+            self.finish_modal(context)
+            info = "import cancelled: retained the streamlines built so far"
+            self.report({'WARNING'}, info)
+            return {"FINISHED"}
+
+        if event.type != 'TIMER':
+            return {"PASS_THROUGH"}
+
+        try:
+            progress, info = next(self.steps)
+        except StopIteration:
+            self.finish_modal(context)
+            return {"FINISHED"}
+        except:
+            self.finish_modal(context)
+            raise
+
+        context.window_manager.progress_update(100 * progress)
+        self.status_text_set(context, info)
+
+        return {"RUNNING_MODAL"}
+
+    def finish_modal(self, context):
+        """Remove the timer and progress report of the modal import."""
+
+        wm = context.window_manager
+        wm.event_timer_remove(self.timer)
+        wm.progress_end()
+        self.status_text_set(context)
+        self.report_timings()
+
+    @staticmethod
+    def status_text_set(context, text=None):
+        """Show the progress of the import in the info header."""
+
+        for area in context.screen.areas:
+            if area.type == 'INFO':
+                if text is None:
+                    area.header_text_set()
+                else:
+                    area.header_text_set(text)
+
+    def report_timings(self):
+        """Report the time spent in the stages of the import."""
+
+        timings = ["{} {:.2f}s".format(stage, self.timings[stage])
+                   for stage in self.stages if self.timings[stage]]
+        info = "import timings: {}".format('; '.join(timings))
+        self.report({'INFO'}, info)
+
+    def import_tracts_steps(self, context, fpaths):
+        """Import tract files step by step.
+
+        Yields (progress, info) after every batch of streamlines;
+        stops after the current tract when the import is cancelled.
+        """
+
+        files = self.read_streamlines_from_files(fpaths)
+
+        try:
+            while not self.cancelled:
+
+                t = time.time()
+                try:
+                    fpath, streamlines = next(files)
+                except StopIteration:
+                    break
+                self.timings['parse'] += time.time() - t
+
+                # NOTE: .trk streamlines are read in RAS+ mm (header affine)
+                # TODO: handle other formats with transform info in the file
+                affine = nb_ut.read_affine_matrix(self.sformfile)
+                steps = self.import_tract_steps(
+                    context, streamlines, fpath, affine, self.sformfile,
+                    weed_tract=self.weed_tract,
+                    interpolate_streamlines=self.interpolate_streamlines,
+                    use_quickbundles=self.use_quickbundles,
+                    timings=self.timings,
+                    )
+
+                ifile = fpaths.index(fpath)
+                for progress in steps:
+                    info = "importing {} ({}/{}): {:.0%}".format(
+                        os.path.basename(fpath), ifile + 1, len(fpaths),
+                        progress)
+                    yield (ifile + progress) / len(fpaths), info
+        finally:
+            files.close()
+
     def draw(self, context):
 
         layout = self.layout
@@ -187,9 +391,40 @@ class NB_OT_import_tracts(Operator, ImportHelper):
         row = layout.row()
         row.prop(self, "name")
         row = layout.row()
-        row.prop(self, "interpolate_streamlines")
+        row.prop(self, "resample_mode")
+        row = layout.row()
+        if self.resample_mode == "subsample":
+            row.prop(self, "interpolate_streamlines")
+        elif self.resample_mode == "step":
+            row.prop(self, "resample_step")
+        elif self.resample_mode == "count":
+            row.prop(self, "resample_npoints")
+        elif self.resample_mode == "rdp":
+            row.prop(self, "rdp_tolerance")
         row = layout.row()
         row.prop(self, "weed_tract")
+        if self.weed_tract < 1.:
+            row = layout.row()
+            row.prop(self, "weed_mode")
+            row.prop(self, "weed_seed")
+            row = layout.row()
+            if self.weed_mode == "length":
+                row.prop(self, "weed_nstrata")
+            elif self.weed_mode == "endpoints":
+                row.prop(self, "weed_cellsize")
+            elif self.weed_mode == "label":
+                row.prop(self, "weed_label")
+        row = layout.row()
+        row.prop(self, "import_scalars")
+        row = layout.row()
+        row.prop(self, "use_lod")
+        if self.use_lod:
+            row = layout.row()
+            row.prop(self, "lod_weed")
+            row.prop(self, "lod_tolerance")
+        row = layout.row()
+        row.prop(self, "use_modal")
+        row.prop(self, "batchsize")
 
         row = layout.row()
         row.separator()
@@ -218,6 +453,10 @@ class NB_OT_import_tracts(Operator, ImportHelper):
 
     def invoke(self, context, event):
 
+        # import from the file browser in batches; scripts stay synchronous
+        if not self.properties.is_property_set("use_modal"):
+            self.use_modal = True
+
         context.window_manager.fileselect_add(self)
 
         return {"RUNNING_MODAL"}
@@ -229,6 +468,29 @@ class NB_OT_import_tracts(Operator, ImportHelper):
                      weed_tract=1.,
                      interpolate_streamlines=1.,
                      use_quickbundles=False):
+        """Import a tract object (see import_tract_steps)."""
+
+        steps = self.import_tract_steps(
+            context, streamlines, fpath, affine, sformfile,
+            weed_tract=weed_tract,
+            interpolate_streamlines=interpolate_streamlines,
+            use_quickbundles=use_quickbundles,
+            )
+
+        while True:
+            try:
+                next(steps)
+            except StopIteration as stop:
+                return stop.value
+
+    def import_tract_steps(self, context, streamlines,
+                           fpath='',
+                           affine=Matrix(),
+                           sformfile='',
+                           weed_tract=1.,
+                           interpolate_streamlines=1.,
+                           use_quickbundles=False,
+                           timings=None):
         """Import a tract object.
 
         This imports the streamlines found in the specified file and
@@ -238,24 +500,35 @@ class NB_OT_import_tracts(Operator, ImportHelper):
           http://camino.cs.ucl.ac.uk/index.php?n=Main.Fileformats
         - .tck (MRtrix)
           http://jdtournier.github.io/mrtrix-0.2/appendix/mrtrix.html
-        - .vtk (vtk polydata (ASCII); from MRtrix's 'tracks2vtk' command)
+        - .vtk (vtk polydata (ASCII/BINARY); e.g. MRtrix's 'tracks2vtk')
           http://www.vtk.org/wp-content/uploads/2015/04/file-formats.pdf
-        - .trk (TrackVis; via nibabel)
+        - .vtp (vtk XML polydata; raw/base64, optionally zlib-compressed)
+        - .trk (TrackVis; via nibabel; lazily, with the header affine)
         - .dpy (dipy; via dipy)
         - .npy (2d numpy arrays [Npointsx3]; single streamline per file)
         - .npz (zipped archive of Nstreamlines .npy files)
           http://docs.scipy.org/doc/numpy-1.10.0/reference/generated/numpy.savez.html
 
-        'weed_tract' thins tracts by randomly selecting streamlines.
+        'weed_tract' thins tracts by randomly selecting streamlines
+        (seeded; optionally stratified by length, endpoints or label).
         'interpolate_streamlines' keeps every nth point of the streamlines
-        (int(1/interpolate_streamlines)).
+        (int(1/interpolate_streamlines)); alternatively, streamlines are
+        resampled at a fixed step or point count, or simplified (RDP).
         'sformfile' sets matrix_world to affine transformation.
 
+        The streamlines are added in batches of self.batchsize points:
+        the fraction of streamlines added is yielded after every batch.
+        Batching stops when self.cancelled is set.
+        The time spent per stage is accumulated in 'timings'.
+        Returns the NeuroBlender tract.
         """
 
         scn = context.scene
         nb = scn.nb
 
+        if timings is None:
+            timings = {stage: 0. for stage in self.stages}
+
         # TODO: check names in groups
         ca = [bpy.data.objects,
               bpy.data.meshes,
@@ -268,6 +541,7 @@ class NB_OT_import_tracts(Operator, ImportHelper):
         nb_ob, info = self.tract_to_nb(context, ob, fpath, sformfile,
                                        weed_tract, interpolate_streamlines)
 
+        t = time.time()
         matgroup = [(-1, name)]
         if os.path.splitext(fpath)[1][1:] == 'swc':
             matgroup += [(1, '{}.soma'.format(name)),
@@ -280,14 +554,51 @@ class NB_OT_import_tracts(Operator, ImportHelper):
         elif not use_quickbundles:
             for i, matname in reversed(matgroup):
                 nb_ma.materialise(ob, matname=matname, idx=i)
+        timings['materials'] += time.time() - t
+
+        # weed before reading: only the retained streamlines are read
+        t = time.time()
+        weedargs = {"mode": self.weed_mode,
+                    "seed": self.weed_seed,
+                    "nstrata": self.weed_nstrata,
+                    "cellsize": self.weed_cellsize,
+                    "label": self.weed_label}
+        streamlines = self.weed_streamlines(streamlines, weed_tract, weedargs)
+        nstreamlines = len(streamlines)
+        timings['weed'] += time.time() - t
+
+        # add streamlines (in chunks to bound the memory footprint)
+        resampleargs = {"mode": self.resample_mode,
+                        "step": self.resample_step,
+                        "npoints": self.resample_npoints,
+                        "tolerance": self.rdp_tolerance}
+        scalars = {}
+        lengths = []
+        nadded = 0
+        for chunk in streamlines.chunks(self.batchsize):
+            nadded += len(chunk)
+            chunk = self.add_streamlines(
+                ob, chunk,
+                interpolate_streamlines=interpolate_streamlines,
+                resampleargs=resampleargs,
+                timings=timings,
+                )
+            if self.import_scalars:
+                lengths.append(chunk.lengths)
+                for scalarname in chunk.scalar_names():
+                    values = chunk.data[scalarname]
+                    scalars.setdefault(scalarname, []).append(values)
+            yield nadded / max(nstreamlines, 1)
+            if getattr(self, 'cancelled', False):
+                break
 
-        # add streamlines
-        self.add_streamlines(
-            ob, streamlines,
-            weed_tract=weed_tract,
-            interpolate_streamlines=interpolate_streamlines,
-            )
+        t = time.time()
+        if scalars:
+            self.scalargroups_to_nb(context, nb_ob, ob, fpath,
+                                    scalars, np.concatenate(lengths))
+        timings['scalars'] += time.time() - t
 
+        t = time.time()
         if use_quickbundles:
             bpy.ops.nb.create_labelgroup(
                 data_path=nb_ob.path_from_id(),
@@ -295,10 +606,21 @@ class NB_OT_import_tracts(Operator, ImportHelper):
                 qb_threshold=self.qb_threshold,
                 qb_centroids=self.qb_centroids,
                 )
+        timings['quickbundles'] += time.time() - t
 
         # beautify
+        t = time.time()
         if self.beautify:
             self.beautification(ob)
+        timings['materials'] += time.time() - t
+
+        t = time.time()
+        if self.use_lod and not getattr(self, 'cancelled', False):
+            lodargs = {"weed": self.lod_weed,
+                       "tolerance": self.lod_tolerance,
+                       "seed": self.weed_seed}
+            self.lod_to_nb(context, ob, nb_ob, streamlines, lodargs)
+        timings['lod'] += time.time() - t
 
         ob.matrix_world = affine
 
@@ -356,6 +678,46 @@ class NB_OT_import_tracts(Operator, ImportHelper):
 
         return nb_ob, info
 
+    @staticmethod
+    def lod_to_nb(context, ob, nb_ob, streamlines,
+                  lodargs={"weed": 0.1, "tolerance": 1., "seed": 0}):
+        """Add a level-of-detail proxy to a tract object.
+
+        The proxy is a weeded and simplified (RDP) copy of the streamlines,
+        parented to the tract. It replaces the tract in the viewport,
+        while the full tract is rendered. The proxy has the base material
+        of the tract only: it does not follow the tract's overlays.
+        """
+
+        name = '{}.proxy'.format(ob.name)
+        proxy = NB_OT_import_tracts.create_tract_object(context, name)
+
+        weedargs = {"mode": "random", "seed": lodargs["seed"]}
+        streamlines = NB_OT_import_tracts.weed_streamlines(
+            streamlines, lodargs["weed"], weedargs)
+        resampleargs = {"mode": "rdp", "tolerance": lodargs["tolerance"]}
+        for chunk in streamlines.chunks():
+            NB_OT_import_tracts.add_streamlines(proxy, chunk,
+                                                resampleargs=resampleargs)
+
+        if ob.data.materials:
+            proxy.data.materials.append(ob.data.materials[0])
+        mat_idxs = np.zeros(len(proxy.data.splines), dtype='int32')
+        proxy.data.splines.foreach_set('material_index', mat_idxs)
+        proxy.data.fill_mode = ob.data.fill_mode
+        proxy.data.bevel_depth = ob.data.bevel_depth
+        proxy.data.bevel_resolution = 0
+
+        proxy.parent = ob
+        nb_ut.move_to_layer(proxy, 0)
+
+        nb_ob.lod_proxy = proxy.name
+        nb_ob.lod_weed = lodargs["weed"]
+        nb_ob.lod_tolerance = lodargs["tolerance"]
+        nb_ob.use_lod = True
+
+        return proxy
+
     @staticmethod
     def labelgroup_to_nb(name, parent, matgroup):
         """Add a labelgroup to NeuroBlender."""
@@ -382,425 +744,225 @@ class NB_OT_import_tracts(Operator, ImportHelper):
 
         return group
 
+    @staticmethod
+    def scalargroups_to_nb(context, nb_ob, ob, fpath, scalars, lengths):
+        """Add per-point scalars read with the streamlines as scalargroups.
+
+        'scalars' maps a scalar name to a list of packed per-point arrays
+        (one per imported chunk) of streamlines with 'lengths'.
+        """
+
+        group = None
+        bounds = np.cumsum(lengths)[:-1]
+        for scalarname, values in sorted(scalars.items()):
+            sg_data = [np.split(np.concatenate(values), bounds)]
+            name = '{}.{}'.format(nb_ob.name, scalarname)
+            group = nb_im.NB_OT_import_overlays.tracts_scalargroup_to_nb(
+                context, name, fpath, sg_data, nb_ob, ob) or group
+
+        if group is not None:
+            nb_pr.overlays_enum_callback(nb_ob, context)
+            nb_ob.active_overlay = group.name
+
+    def read_streamlines_from_files(self, fpaths):
+        """Yield the packed streamlines read from a list of files.
+
+        Text formats are parsed in a pool of worker processes
+        (settingprops.nworkers), while the caller builds the curves on
+        the main thread; memory-mapped and lazily read formats are read
+        in the main process. Files that fail to read are skipped.
+        """
+
+        nworkers = bpy.context.scene.nb.settingprops.nworkers
+        pooled = [fpath for fpath in fpaths if nb_rd.has_pooled_reader(fpath)]
+        nworkers = min(nb_rd.pool_size(nworkers), len(pooled))
+
+        if nworkers < 2:
+            for fpath in fpaths:
+                streamlines = self.read_streamlines_from_file(fpath)
+                if streamlines is not None:
+                    yield fpath, streamlines
+            return
+
+        options = self.reader_options()
+        cacheargs = self.cache_arguments()
+        tasks = [(fpath, options, cacheargs) for fpath in pooled]
+        results = nb_rd.read_streamlines_parallel(
+            tasks, nworkers, bpy.app.binary_path_python)
+        try:
+            for fpath in fpaths:
+                if nb_rd.has_pooled_reader(fpath):
+                    _, streamlines, error = next(results)
+                    if not self.report_read(fpath, streamlines, error):
+                        continue
+                else:
+                    streamlines = self.read_streamlines_from_file(fpath)
+                    if streamlines is None:
+                        continue
+                yield fpath, streamlines
+        finally:
+            results.close()
+
     def read_streamlines_from_file(self, fpath):
-        """Read a set of streamlines from file."""
+        """Read a set of packed streamlines from file (or None on failure)."""
 
-        outcome = "failed"
         ext = os.path.splitext(fpath)[1]
+        fun = getattr(self, "read_streamlines_{}".format(ext[1:]), None)
+        if fun is None:
+            error = NotImplementedError(
+                "file format '{}' not supported".format(ext))
+            self.report_read(fpath, None, error)
+            return None
 
         try:
-            fun = "self.read_streamlines_{}".format(ext[1:])
-            streamlines = eval('{}(fpath)'.format(fun))
-
-        except NameError:
-            reason = "file format '{}' not supported".format(ext)
-            info = "import {}: {}".format(outcome, reason)
-            return info
-        except (IOError, FileNotFoundError):
-            reason = "file '{}' not valid".format(fpath)
-            info = "import {}: {}".format(outcome, reason)
-            return info
-
-        except:
-            reason = "unknown import error"
-            info = "import {}: {}".format(outcome, reason)
-            raise
-        else:
-            info = "imported {} streamlines from {}".format(len(streamlines), fpath)
+            options = self.reader_options().get(ext, {})
+            streamlines = self.read_streamlines_cached(fpath, fun, options)
+        except Exception as error:
+            self.report_read(fpath, None, error)
+            return None
 
-        self.report({'INFO'}, info)
+        self.report_read(fpath, streamlines)
 
         return streamlines
 
-    def read_streamlines_npy(self, fpath):
-        """Read a [Npointsx3] streamline from a *.npy file."""
-
-        streamline = np.load(fpath)
+    def report_read(self, fpath, streamlines, error=None):
+        """Report the outcome of reading a tract file.
 
-        return [streamline]
+        Unsupported formats, invalid (malformed) files and
+        missing modules are reported as warnings; other errors are raised.
+        """
 
-    def read_streamlines_npz(self, fpath):
-        """Return all streamlines from a *.npz file.
+        if error is None:
+            info = "imported {} streamlines from {}".format(len(streamlines),
+                                                            fpath)
+            self.report({'INFO'}, info)
+            return True
+
+        if isinstance(error, NotImplementedError):
+            reason = str(error)
+        elif isinstance(error, ImportError):
+            reason = "nibabel not found"
+        elif isinstance(error, (IOError, ValueError)):
+            reason = "file '{}' not valid ({})".format(fpath, error)
+        else:
+            raise error
 
-        e.g. from
-        'np.savez_compressed(outfile, streamlines0=streamlines0, ..=..)'
-        NOTE: This doesn't work for .npz pickled in Python 2.x,!! ==>
-        Unicode unpickling incompatibility
-        """
+        info = "import failed: {}".format(reason)
+        self.report({'WARNING'}, info)
 
-        # TODO: proper checks and error handling
-        # TODO: multitract npz
-        streamlines = []
-        npzfile = np.load(fpath)
-        k = npzfile.files[0]
-        if len(npzfile.files) == 0:
-            print('No files in archive.')
-        elif len(npzfile.files) == 1:  # single tract / streamline
-            if len(npzfile[k][0][0]) == 3:  # k contains a list of Nx3 arrays
-                streamlines = npzfile[k]
-            else:  # k contains a single Nx3 array
-                streamlines.append(npzfile[k])
-        elif len(npzfile.files) > 1:  # multiple tracts / streamlines
-            if len(npzfile[k][0][0]) == 3:  # k contains a list of Nx3 arrays
-                print('multi-tract npz not supported yet.')
-            else:  # each k contains a single Nx3 array
-                for k in npzfile:
-                    streamlines.append(npzfile[k])
+        return False
 
-        return streamlines
+    @staticmethod
+    def cache_arguments():
+        """Return the streamline cache arguments (or None if disabled)."""
 
-    def read_streamlines_dpy(self, fpath):
-        """Return all streamlines in a dipy .dpy tract file (uses dipy)."""
+        settingprops = bpy.context.scene.nb.settingprops
+        if not settingprops.use_cache:
+            return None
 
-        if nb_ut.validate_dipy('.trk'):
-            dpr = Dpy(fpath, 'r')  # FIXME
-            streamlines = dpr.read_tracks()
-            dpr.close()
+        projectdir = bpy.path.abspath(settingprops.projectdir)
 
-        return streamlines
+        return {'cachedir': nb_ca.cache_dir(projectdir),
+                'maxsize': int(settingprops.cache_size * 1024 ** 3),
+                'use_hash': settingprops.cache_hash}
 
-    def read_streamlines_trk(self, fpath):
-        """Return all streamlines in a Trackvis .trk tract file."""
+    def reader_options(self):
+        """Return the reader options of the operator per file extension."""
 
-        nib = nb_ut.validate_nibabel('.trk')
-        if bpy.context.scene.nb.settingprops.nibabel_valid:
-            tv = nib.trackvis
-            streams, _ = tv.read(fpath)
-            streamlines = [s[0] for s in streams]
+        return {'.swc': {'radius_factor_soma': self.radius_factor_soma}}
 
-            return streamlines
+    @classmethod
+    def read_streamlines_cached(cls, fpath, read_fun, options=None):
+        """Read streamlines through the project's streamline cache.
 
-    def read_streamlines_tck(self, fpath):
-        """Return all streamlines in a MRtrix .tck tract file."""
+        Parsed streamlines are stored as memory-mappable .npy files
+        under the project directory; reading falls back to read_fun
+        when the cache is disabled. The reader 'options' that read_fun
+        applies are part of the cache key.
+        """
 
-        datatype, offset = self.read_mrtrix_header(fpath)
-        streamlinevector = self.read_mrtrix_tracks(fpath, datatype, offset)
-        streamlines = self.unpack_mrtrix_streamlines(streamlinevector)
+        cacheargs = cls.cache_arguments()
+        if cacheargs is None:
+            return read_fun(fpath)
 
-        return streamlines
+        return nb_ca.read_streamlines_cached(fpath, read_fun,
+                                             options=options, **cacheargs)
 
-    @staticmethod
-    def read_mrtrix_header(tckfile):
-        """Return the datatype and offset for a MRtrix .tck tract file."""
-
-        with open(tckfile, 'rb') as f:
-            data = f.read()
-            lines = data.split(b'\n')
-            for line in lines:
-                if line == b'END':
-                    break
-                else:
-                    tokens = line.decode("utf-8").rstrip("\n").split(' ')
-                    if tokens[0] == 'datatype:':
-                        datatype = tokens[1]
-                    elif tokens[0] == 'file:':
-                        offset = int(tokens[2])
+    def read_streamlines_npy(self, fpath):
+        """Read a [Npointsx3] streamline from a *.npy file."""
 
-            return datatype, offset
+        return nb_rd.read_npy_streamlines(fpath)
 
-    @staticmethod
-    def read_mrtrix_tracks(tckfile, datatype, offset):
-        """Return the data from a MRtrix .tck tract file."""
+    def read_streamlines_npz(self, fpath):
+        """Return all streamlines from a *.npz file."""
 
-        f = open(tckfile, "rb")
-        f.seek(offset)
-        if datatype.startswith('Float32'):
-            ptype = 'f4'
-        if datatype.endswith('BE'):
-            ptype = '>' + ptype
-        elif datatype.endswith('LE'):
-            ptype = '<' + ptype
-        streamlinevector = np.fromfile(f, dtype=ptype)
+        return nb_rd.read_npz_streamlines(fpath)
 
-        return streamlinevector
+    def read_streamlines_dpy(self, fpath):
+        """Return all streamlines in a dipy .dpy tract file (uses dipy)."""
 
-    @staticmethod
-    def unpack_mrtrix_streamlines(streamlinevector):
-        """Extract the streamlines from the streamlinevector.
+        if nb_ut.validate_dipy('.trk'):
+            dpr = Dpy(fpath, 'r')  # FIXME
+            streamlines = dpr.read_tracks()
+            dpr.close()
 
-        streamlinevector contains N streamlines
-        separated by 'nan' triplets and ended with an 'inf' triplet
-        """
+        return nb_sl.Streamlines.from_list(streamlines)
 
-        streamlines = []
-        streamlinevector = np.reshape(streamlinevector, [-1, 3])
-        idxs_nan = np.where(np.isnan(streamlinevector))[0][0::3]
-        i = 0
-        for j in idxs_nan:
-            streamlines.append(streamlinevector[i:j, :])
-            i = j + 1
+    def read_streamlines_trk(self, fpath):
+        """Return all streamlines in a Trackvis .trk tract file.
 
-        return streamlines
+        The streamlines are read lazily in chunks (in RAS+ mm space).
+        """
 
-    def read_streamlines_vtk(self, fpath):
-        """Return all streamlines in a (MRtrix) .vtk tract file."""
+        nb_ut.validate_nibabel('.trk')
 
-        points, tracts, _, _, _ = self.import_vtk_polylines(fpath)
-        streamlines = self.unpack_vtk_polylines(points, tracts)
+        return nb_rd.read_trackvis_streamlines(fpath)
 
-        return streamlines
+    def read_streamlines_tck(self, fpath):
+        """Return all streamlines in a MRtrix .tck tract file.
 
-    @staticmethod
-    def import_vtk_polylines(vtkfile):
-        """Read points and polylines from file"""
-
-        with open(vtkfile) as f:
-            scalars = cscalars = lut = None
-            read_points = 0
-            read_tracts = 0
-            read_scalars = 0
-            read_cscalars = 0
-            read_lut = 0
-            for line in f:
-                tokens = line.rstrip("\n").split(' ')
-
-                if tokens[0] == "POINTS":
-                    read_points = 1
-                    npoints = int(tokens[1])
-                    points = []
-                elif read_points == 1 and len(points) < npoints*3:
-                    for token in tokens:
-                        if token:
-                            points.append(float(token))
-
-                elif tokens[0] == "LINES":
-                    read_tracts = 1
-                    ntracts = int(tokens[1])
-                    tracts = []
-                elif read_tracts == 1 and len(tracts) < ntracts:
-                    tract = []
-                    for token in tokens[1:]:
-                        if token:
-                            tract.append(int(token))
-                    tracts.append(tract)
-
-                elif tokens[0] == "POINT_DATA":
-                    nattr = int(tokens[1])
-                elif tokens[0] == "SCALARS":
-                    read_scalars = 1
-                    scalar_name = tokens[1]
-                    scalar_dtype = tokens[2]
-                    scalar_ncomp = tokens[3]
-                    scalars = []
-                elif read_scalars == 1 and len(scalars) < nattr:
-                    scalar = []
-                    for token in tokens:
-                        if token:
-                            scalar.append(float(token))  # NOTE: floats assumed
-                    scalars.append(scalar)
-
-                elif tokens[0] == "COLOR_SCALARS":
-                    read_cscalars = 1
-                    cscalar_name = tokens[1]
-                    cscalar_ncomp = tokens[2]
-                    cscalars = []
-                elif read_cscalars == 1 and len(cscalars) < nattr:
-                    cscalar = []
-                    for token in tokens:
-                        if token:
-                            cscalar.append(float(token))
-                    cscalars.append(cscalar)
-
-                elif tokens[0] == "LOOKUP_TABLE":
-                    read_lut = 1
-                    lut_name = tokens[1]
-                    lut_size = tokens[2]
-                    lut = []
-                elif read_lut == 1 and len(lut) < lut_size:
-                    entry = []
-                    for token in tokens:
-                        if token:
-                            entry.append(float(token))
-                    lut.append(entry)
-
-                elif tokens[0] == '':
-                    pass
-                else:
-                    pass
+        The streamlines are a view on the memory-mapped file.
+        """
 
-            points = np.reshape(np.array(points), (npoints, 3))
+        return nb_rd.read_mrtrix_streamlines(fpath)
 
-        return points, tracts, scalars, cscalars, lut
+    def read_streamlines_vtk(self, fpath):
+        """Return all streamlines in a (MRtrix) .vtk tract file.
 
-    # TODO SCALARS
-    # SCALARS dataName dataType numComp
-    # LOOKUP_TABLE tableName
-    # s0
-    # s1
-    # TODO COLOR_SCALARS
-    # POINT_DATA 754156
-    # COLOR_SCALARS scalars 4
-    # 0 1 0.988235 1 0 1 0.988235 1 0 1 0.996078 1
-    # 0 0.980392 1 1 0 0.956863 1 1
-    # 0 0.854902 1 1 0 0.560784 1 1
+        Point data arrays are returned as streamline data columns.
+        """
 
-    @staticmethod
-    def unpack_vtk_polylines(points, tracts):
-        """Convert indexed polylines to coordinate lists."""
+        return nb_rd.read_vtk_streamlines(fpath)
 
-        streamlines = []
-        for tract in tracts:
-            streamline = []
-            for point in tract:
-                streamline.append(points[point])
-            stream = np.reshape(streamline, (len(streamline), 3))
-            streamlines.append(stream)
+    def read_streamlines_vtp(self, fpath):
+        """Return all streamlines in a VTK XML polydata .vtp file."""
 
-        return streamlines
+        return nb_rd.read_vtk_streamlines(fpath)
 
     def read_streamlines_Bfloat(self, fpath):
         """Return all streamlines in a Camino .Bfloat tract file."""
 
-        streamlines = self.read_camino_streamlines(fpath, '>f4')
-
-        return streamlines
+        return nb_rd.read_camino_streamlines(fpath, '>f4')
 
     def read_streamlines_bfloat(self, fpath):
         """Return all streamlines in a Camino .bfloat tract file."""
 
-        streamlines = self.read_camino_streamlines(fpath, '<f4')
-
-        return streamlines
+        return nb_rd.read_camino_streamlines(fpath, '<f4')
 
     def read_streamlines_Bdouble(self, fpath):
         """Return all streamlines in a Camino .Bdouble tract file."""
 
-        streamlines = self.read_camino_streamlines(fpath, '>f8')
-
-        return streamlines
+        return nb_rd.read_camino_streamlines(fpath, '>f8')
 
     def read_streamlines_bdouble(self, fpath):
         """Return all streamlines in a Camino .bdouble tract file."""
 
-        streamlines = self.read_camino_streamlines(fpath, '<f8')
-
-        return streamlines
-
-    @staticmethod
-    def read_camino_streamlines(fpath, camdtype):
-        """Return all streamlines in a Camino tract file."""
-
-        streamlinevec = np.fromfile(fpath, dtype=camdtype)
-
-        streamlines = []
-        offset = 0
-        while offset < len(streamlinevec):
-            npoints = streamlinevec[offset].astype(int)
-            ntokens = npoints * 3
-            offset += 2
-            streamline = streamlinevec[offset:ntokens + offset]
-            streamline = np.reshape(streamline, (npoints, 3))
-            offset += ntokens
-            streamlines.append(streamline)
-
-        return streamlines
-
-    @staticmethod
-    def unpack_camino_streamline(streamlinevec):
-        """Extract the first streamline from the streamlinevector.
-
-        streamlinevector contains N streamlines of M points:
-        each streamline: [length seedindex M*xyz]
-        # DEPRECATED: deletion is incredibly sloooooooowwww
-        """
-
-        streamline_npoints = streamlinevec[0]
-        streamline_end = streamline_npoints * 3 + 2
-        streamline = streamlinevec[2:streamline_end]
-        streamline = np.reshape(streamline, (streamline_npoints, 3))
-        indices = range(0, streamline_end.astype(int))
-        streamlinevec = np.delete(streamlinevec, indices, 0)
-
-        return streamline, streamlinevec
+        return nb_rd.read_camino_streamlines(fpath, '<f8')
 
     def read_streamlines_swc(self, fpath):
         """Return all neuron branches in a swc file."""
 
-        swcdict = {}
-        streamlines = []
-        streamline = []
-        with open(fpath, 'rb') as f:
-            data = f.read()
-            lines = data.split(b'\n')
-            for line in lines:
-
-                if line.startswith(b'#') or line == b'':
-                    continue
-
-                idx, cp = self.decode_line_swc(line)
-                swcdict[idx] = cp
-
-                if 'branchpoint' not in cp.keys():
-                    cp['branchpoint'] = False
-
-                if cp['parent'] < 0:  # skip master parent point
-                    continue
-
-                pp = swcdict[cp['parent']]
-
-                if cp['structure'] == 1:
-                    cp['radius'] *= self.radius_factor_soma
-
-                if cp['structure'] == pp['structure'] == 1:  # no soma
-                    continue
-
-                if cp['parent'] < idx - 1:  # new branch
-
-                    pp['branchpoint'] = True
-
-                    if streamline:
-                        streamlines.append(streamline)
-                    point = pp['co'] + [pp['radius']] + [pp['structure']] + [idx]
-                    streamline = [point]
-                    if pp['colourcode'] is not None:
-                        streamline += [pp['colourcode']]
-
-                point = cp['co'] + [cp['radius']] + [cp['structure']] + [idx]
-                if cp['colourcode'] is not None:
-                    point += [cp['colourcode']]
-                streamline.append(point)
-
-            if streamline:
-                streamlines.append(streamline)
-
-        # mark branchpoints
-        for streamline in streamlines:
-            for point in streamline:
-                idx = point[5]
-                point.append(float(swcdict[idx]['branchpoint']))
-
-        return streamlines
-
-    def decode_line_swc(self, line):
-        """Parse a line of a swc file.
-        structure lookup:
-        Standardized swc files (www.neuromorpho.org)
-        0 - undefined
-        1 - soma
-        2 - axon
-        3 - (basal) dendrite
-        4 - apical dendrite
-        5+ - custom
-        """
-
-        tokens = line.decode("utf-8").rstrip("\n").split(' ')
-        if not tokens[0]:  # catch spaces in front of line
-            tokens = tokens[1:]
-
-        idx = int(tokens[0])
-        pointdict = {
-            'structure': int(tokens[1]),
-            'co': [float(token) for token in tokens[2:5]],
-            'radius': float(tokens[5]),
-            'parent': int(tokens[6]),
-            }
-
-        try:
-            pointdict['colourcode'] = int(tokens[7])  # TODO: implement
-        except IndexError:
-            pointdict['colourcode'] = None
-
-        return idx, pointdict
+        return nb_rd.read_swc_streamlines(fpath, self.radius_factor_soma)
 
     @staticmethod
     def beautification(ob, argdict={"mode": "FULL",
@@ -833,38 +995,53 @@ class NB_OT_import_tracts(Operator, ImportHelper):
 
         return ob
 
+    @staticmethod
+    def weed_streamlines(streamlines, weed_tract=1.,
+                         weedargs={"mode": "random", "seed": 0}):
+        """Return a view on a random selection of the streamlines.
+
+        'weedargs' are passed to streamlines.weed (mode, seed, ...).
+        """
+
+        if weed_tract < 1.:
+            idxs = nb_sl.weed(streamlines, weed_tract, **weedargs)
+            streamlines = streamlines.subset(idxs)
+
+        return streamlines
+
     @staticmethod
     def add_streamlines(ob, streamlines,
                         radius=0.2, radius_variation=False,
-                        weed_tract=1., interpolate_streamlines=1.):
-        """Add streamlines to a tract object."""
+                        weed_tract=1., interpolate_streamlines=1.,
+                        resampleargs={"mode": "subsample"},
+                        timings=None):
+        """Add packed streamlines to a tract object.
+
+        'resampleargs' are passed to streamlines.resample (mode, step, ...).
+        The time spent per stage is accumulated in 'timings' (if given).
+        Return the (weeded and resampled) streamlines that were added.
+        """
 
-        if (weed_tract == 1) and (interpolate_streamlines == 1):
-            for streamline in streamlines:
-                nb_ut.make_polyline(ob.data, streamline,
-                                    radius, radius_variation)
-        else:
+        if timings is None:
+            timings = {'weed': 0., 'resample': 0., 'splines': 0.}
 
-            nsamples = int(len(streamlines) * weed_tract)
-            streamlines_sample = random.sample(range(len(streamlines)), nsamples)
-
-            for i, streamline in enumerate(streamlines):
-                if i in streamlines_sample:
-                    if interpolate_streamlines < 1.:
-                        # TODO: spline interpolation
-                        subs_sl = int(1/interpolate_streamlines)
-                        idxs = set(list(range(0, len(streamline), subs_sl)))
-                        idxs.add(len(streamline))
-                        for i, point in enumerate(streamline):
-                            if point[6]:
-                                idxs.add(i)
-                        mask = [True if i in idxs else False
-                                for i, point in enumerate(streamline)]
-                        streamline = np.array(streamline)[mask, :]
-                    nb_ut.make_polyline(ob.data, streamline,
-                                        radius, radius_variation)
+        t = time.time()
+        streamlines = NB_OT_import_tracts.weed_streamlines(streamlines,
+                                                           weed_tract)
+        timings['weed'] += time.time() - t
 
-        return ob
+        t = time.time()
+        streamlines = nb_sl.resample(streamlines,
+                                     factor=interpolate_streamlines,
+                                     **resampleargs)
+        timings['resample'] += time.time() - t
+
+        t = time.time()
+        nb_ut.make_polylines(ob.data, streamlines,
+                             radius, radius_variation)
+        timings['splines'] += time.time() - t
+
+        return streamlines
 
 
 class NB_OT_attach_neurons(Operator, ImportHelper):
@@ -913,6 +1090,16 @@ class NB_OT_attach_neurons(Operator, ImportHelper):
         description="Integrate the neurons in the tract object",
         default=False)
 
+    use_instancing = BoolProperty(
+        name="Instancing",
+        description="Place the neurons as linked duplicates",
+        default=False)
+
+    realize_instances = BoolProperty(
+        name="Realize instances",
+        description="Join the neuron instances into curve objects",
+        default=False)
+
     def execute(self, context):
 
         scn = context.scene
@@ -921,6 +1108,7 @@ class NB_OT_attach_neurons(Operator, ImportHelper):
             self.keep_layers = False
 
         layers = self.load_config()
+        self.surface_indices = {}
 
         split_path = self.data_path.split('.')
         nb_ob = scn.path_resolve('.'.join(split_path[:2]))
@@ -941,10 +1129,17 @@ class NB_OT_attach_neurons(Operator, ImportHelper):
             idxs = self.get_indices(buildtype, ob, nb_it)
             layer['idxs'] = idxs[::int(1/self.density)]
 
-            layerob = self.place_neuron_layer(context, buildtype, layer, ob)
-            layerobs.append(layerob)
+            if self.use_instancing:
+                layerob = self.instance_neuron_layer(context, buildtype,
+                                                     layer, ob)
+            else:
+                layerob = self.place_neuron_layer(context, buildtype,
+                                                  layer, ob)
+            if layerob is not None:
+                layerobs.append(layerob)
 
-            if self.keep_layers:
+            if (self.keep_layers and layerob is not None and
+                    layerob.type == 'CURVE'):
                 NB_OT_import_tracts.tract_to_nb(
                     context, layerob,
                     interpolate_streamlines=layer['interpolate_streamlines']
@@ -953,6 +1148,19 @@ class NB_OT_attach_neurons(Operator, ImportHelper):
             if not self.keep_neurons:
                 self.remove_neurons(context, layer['neuronset'])
 
+        if self.use_instancing and not self.realize_instances:
+            # the instances share the curves of the neurons
+            curves = {inst.data.name: inst.data
+                      for layerob in layerobs for inst in layerob.children}
+            if buildtype.startswith('tracts'):
+                curves[ob.data.name] = ob.data
+            self.scale_radius(curves.values())
+            return {"FINISHED"}
+
+        if not layerobs:
+            self.report({'WARNING'}, "no valid targets for the neurons")
+            return {"CANCELLED"}
+
         if not self.keep_layers:
 
             bpy.ops.object.select_all(action='DESELECT')
@@ -980,10 +1188,7 @@ class NB_OT_attach_neurons(Operator, ImportHelper):
             if buildtype.startswith('tracts'):
                 layerobs.append(ob)
 
-        for layerob in layerobs:
-            for spl in layerob.data.splines:
-                for point in spl.points:
-                    point.radius *= self.radius_factor
+        self.scale_radius([layerob.data for layerob in layerobs])
 
         return {"FINISHED"}
 
@@ -993,6 +1198,15 @@ class NB_OT_attach_neurons(Operator, ImportHelper):
 
         return {"RUNNING_MODAL"}
 
+    def scale_radius(self, curves):
+        """Multiply the point radii of curves by the radius factor."""
+
+        for curve in curves:
+            for spl in curve.splines:
+                radii = np.zeros(len(spl.points), dtype='float32')
+                spl.points.foreach_get('radius', radii)
+                spl.points.foreach_set('radius', radii * self.radius_factor)
+
     def load_config(self, selection=[]):
         """Load a configuration for neuron layers."""
 
@@ -1024,6 +1238,7 @@ class NB_OT_attach_neurons(Operator, ImportHelper):
             files=files,
             beautify=False,
             interpolate_streamlines=layer['interpolate_streamlines'],
+            use_modal=False,
             )
 
         layer['neuronset'] = []
@@ -1115,9 +1330,11 @@ class NB_OT_attach_neurons(Operator, ImportHelper):
 
         bpy.ops.object.select_all(action='DESELECT')
 
-        for idx in layer['idxs']:
+        choice = np.random.randint(len(layer['neuronset']),
+                                   size=len(layer['idxs']))
+        for idx, i in zip(layer['idxs'], choice):
 
-            neuron = random.choice(layer['neuronset'])
+            neuron = layer['neuronset'][i]
             neuronob = bpy.data.objects[neuron['name']]
 
             if buildtype.startswith('tracts'):
@@ -1151,15 +1368,190 @@ class NB_OT_attach_neurons(Operator, ImportHelper):
         # reset the radius to correct for scaling
         scalefactor = transmat.to_scale()[0]
         for spl in curveob.data.splines:
-            for point in spl.points:
-                point.radius /= scalefactor
+            radii = np.zeros(len(spl.points), dtype='float32')
+            spl.points.foreach_get('radius', radii)
+            spl.points.foreach_set('radius', radii / scalefactor)
 
         return curveob
 
+    def instance_neuron_layer(self, context, buildtype, layer, ob):
+        """Place a layer of neurons as instances.
+
+        The matrices of the layer are computed in one batch.
+        Without realizing, the instances are linked duplicates of a copy
+        of their neuron's curve, placed by their object matrix;
+        the radii of the copy are divided by the (median) scale of its
+        instances. Realized instances are transformed in bulk into one
+        curve, keeping the radii of the neurons (as place_neuron).
+        The neurons themselves are not modified.
+        """
+
+        scn = context.scene
+
+        bpy.ops.object.select_all(action='DESELECT')
+
+        idxs = np.asarray(layer['idxs'], dtype='int64')
+        v0, v1, is_valid = self.target_arrays(buildtype, ob, idxs)
+        idxs, v0, v1 = idxs[is_valid], v0[is_valid], v1[is_valid]
+        if not len(idxs):
+            return None
+
+        neuronset = layer['neuronset']
+        neuronobs = [bpy.data.objects[neuron['name']]
+                     for neuron in neuronset]
+        choice = np.random.randint(len(neuronset), size=len(idxs))
+        transmats = self.get_transmats(neuronset, choice, v0, v1, layer)
+        scales = np.linalg.norm(transmats[:, :3, 0], axis=1)
+
+        extend = (buildtype.startswith('tracts') and
+                  layer['extend_streamline'])
+        strip_axons = extend and layer['snappoint'] == 'soma'
+
+        # the scale of the neuron curves in the (instanced) layer
+        curvescales = np.ones(len(neuronobs))
+        if not self.realize_instances:
+            for i in np.unique(choice):
+                curvescales[i] = np.median(scales[choice == i])
+
+        if extend:
+            radiusfactors = scales / curvescales[choice]
+            if self.realize_instances:
+                radiusfactors = np.ones(len(choice))
+            self.extend_axons(ob, idxs, neuronobs, choice, transmats,
+                              radiusfactors, layer['snappoint'])
+
+        if self.realize_instances:
+            layerob = self.realize_neuron_layer(
+                context, neuronobs, choice, transmats, strip_axons)
+            return self.name_layer(layerob, layer['name'])
+
+        layerob = bpy.data.objects.new(layer['name'], None)
+        scn.objects.link(layerob)
+        curves = {i: self.neuron_instance_curve(neuronobs[i],
+                                                curvescales[i],
+                                                strip_axons)
+                  for i in np.unique(choice)}
+        for i, transmat in zip(choice, transmats):
+            inst = bpy.data.objects.new(neuronobs[i].name, curves[i])
+            inst.matrix_world = Matrix(transmat.tolist())
+            scn.objects.link(inst)
+            inst.parent = layerob
+
+        return layerob
+
+    def neuron_instance_curve(self, neuronob, scalefactor=1.,
+                              strip_axons=False):
+        """Return a copy of a neuron curve to instance.
+
+        The radii are divided by scalefactor and the axons are removed
+        if requested.
+        """
+
+        curve = neuronob.data.copy()
+        if strip_axons:
+            for spl in [spl for spl in curve.splines
+                        if spl.material_index == 2]:
+                curve.splines.remove(spl)
+
+        for spl in curve.splines:
+            radii = np.zeros(len(spl.points), dtype='float32')
+            spl.points.foreach_get('radius', radii)
+            spl.points.foreach_set('radius', radii / scalefactor)
+
+        return curve
+
+    def realize_neuron_layer(self, context, neuronobs, choice, transmats,
+                             strip_axons=False):
+        """Create one curve object of all neuron instances of a layer.
+
+        The points of every neuron are read once and transformed with
+        the matrices of its instances in one batch. The radii are not
+        scaled (cf. place_neuron). The curve settings and materials are
+        those of the first neuron.
+        """
+
+        layers = []
+        for i in np.unique(choice):
+            neuron = nb_ut.curve_to_streamlines(neuronobs[i].data,
+                                                with_data=True)
+            if strip_axons:
+                structure = neuron.per_streamline('structure')
+                neuron = neuron.subset(np.flatnonzero(structure != 2))
+            neuron = neuron.pack()
+
+            mats = transmats[choice == i]
+            points = np.einsum('kij,pj->kpi', mats[:, :3, :3],
+                               neuron.points) + mats[:, None, :3, 3]
+            ninst = len(mats)
+            lengths = np.tile(neuron.lengths, ninst)
+            offsets = np.append(0, np.cumsum(lengths)[:-1])
+            data = {name: np.tile(values, ninst)
+                    for name, values in neuron.data.items()}
+            layers.append(nb_sl.Streamlines(points.reshape(-1, 3),
+                                            offsets, lengths, data))
+
+        curve = neuronobs[0].data.copy()
+        curve.splines.clear()
+        nb_ut.make_polylines(curve, nb_sl.Streamlines.concatenate(layers))
+
+        curveob = bpy.data.objects.new('ob', curve)
+        context.scene.objects.link(curveob)
+        curveob.select = True
+
+        return curveob
+
+    def get_transmats(self, neuronset, choice, v0, v1, layer):
+        """Build the transformation matrices of a layer of neurons.
+
+        This is a batch equivalent of target_dict and get_transmat
+        for targets (v0, v1) with neurons neuronset[choice].
+        """
+
+        segvec = v1 - v0
+        location = v0 + segvec * layer['offset']
+        length = np.linalg.norm(segvec, axis=1) * layer['scalefactor']
+
+        n_location = np.array([n['location'] for n in neuronset])[choice]
+        n_orient = np.array([n['orientation'] for n in neuronset])[choice]
+        n_length = np.array([n['length'] for n in neuronset])[choice]
+
+        rotations = nb_ut.rotation_difference_matrices(n_orient, segvec)
+        scalefactors = length / n_length
+
+        transmats = np.tile(np.eye(4), (len(choice), 1, 1))
+        transmats[:, :3, :3] = rotations * scalefactors[:, None, None]
+        transmats[:, :3, 3] = location - n_location
+
+        return transmats
+
+    def target_arrays(self, buildtype, ob, idxs, length=1.):
+        """Return the targets (v0, v1) and their validity as arrays.
+
+        This is a batch equivalent of target_tracts and target_surfaces.
+        """
+
+        if buildtype.startswith('tracts'):
+            streamlines = nb_ut.curve_to_streamlines(ob.data)
+            rows = streamlines.last_points()[idxs]
+            is_valid = streamlines.lengths[idxs] > 1
+            v0 = streamlines.points[rows].astype('float64')
+            vt = streamlines.points[np.where(is_valid, rows - 1, rows)]
+            v1 = v0 + (v0 - vt)
+        elif buildtype.startswith('surfaces'):
+            surface_index = self.get_surface_index(ob)
+            v0 = surface_index['co'][idxs].astype('float64')
+            if surface_index['outer_co'] is not None:
+                v1 = surface_index['outer_co'][idxs]
+            else:
+                v1 = v0 + surface_index['normal'][idxs] * length
+            is_valid = np.ones(len(idxs), dtype='bool')
+
+        return v0, v1, is_valid
+
     def target_tracts(self, ob, idx, length=1.):
         """Attach a layer of neurons to tract ends."""
 
-        spline = ob.data.splines[idx]
+        spline = ob.data.splines[int(idx)]
         is_valid = len(spline.points) > 1
 
         v0 = Vector(spline.points[-1].co[:3])
@@ -1171,18 +1563,13 @@ class NB_OT_attach_neurons(Operator, ImportHelper):
     def target_surfaces(self, ob, idx, length=1.):
         """Attach a layer of neurons to tract ends."""
 
-        v0 = ob.data.vertices[idx].co
-
-        if 'white' in ob.name:
-            outername = ob.name.replace('white', 'pial')
-            outer = bpy.data.objects.get(outername)
-        else:
-            outer = None
+        surface_index = self.get_surface_index(ob)
 
-        if outer is not None:
-            v1 = outer.data.vertices[idx].co
+        v0 = Vector(surface_index['co'][idx])
+        if surface_index['outer_co'] is not None:
+            v1 = Vector(surface_index['outer_co'][idx])
         else:
-            v1 = v0 + ob.data.vertices[idx].normal * length
+            v1 = v0 + Vector(surface_index['normal'][idx]) * length
 
         return v0, v1, v0, True
 
@@ -1203,6 +1590,11 @@ class NB_OT_attach_neurons(Operator, ImportHelper):
         bpy.context.scene.objects.active = ob
         bpy.ops.object.join()
 
+        return self.name_layer(ob, layername)
+
+    def name_layer(self, ob, layername):
+        """Rename a layer object and copy its materials."""
+
         ob.name = ob.data.name = layername
         ob.material_slots[0].material.name = layername
 
@@ -1235,32 +1627,82 @@ class NB_OT_attach_neurons(Operator, ImportHelper):
         if snappoint == 'soma':
             self.delete_processes_by_matindex(neuronob, 2)
 
-    def get_vertex_indices_in_groups(self, surf, vgs):
-        """Return all vertex indices included in a vertex group."""
+    def extend_axons(self, ob, idxs, neuronobs, choice, transmats,
+                     radiusfactors, snappoint='soma'):
+        """Extend the tract splines to neuron instances.
+
+        This is a batch equivalent of extend_axon: the axon points are
+        transformed with the matrices of the instances and their radii
+        multiplied by the radiusfactors (the scale of the instance curve).
+        The neurons are not modified.
+        """
+
+        idx = 0 if snappoint == 'soma' else -1
+
+        axons = []
+        for neuronob in neuronobs:
+            for spl in neuronob.data.splines:
+                if spl.material_index == 2:
+                    break
+            point = spl.points[idx]
+            axons.append(list(point.co) + [point.radius])
+        axons = np.array(axons)[choice]
+
+        co = np.copy(axons[:, :4])
+        co[:, :3] = np.einsum('nij,nj->ni', transmats[:, :3, :3],
+                              axons[:, :3]) + transmats[:, :3, 3]
+        radii = axons[:, 4] * radiusfactors
+
+        for i, spline_idx in enumerate(idxs):
+            spline = ob.data.splines[int(spline_idx)]
+            spline.points.add()
+            spline.points[-1].co = co[i]
+            spline.points[-1].radius = radii[i]
+
+    def get_surface_index(self, ob):
+        """Return the vertex arrays and vertex groups of a surface.
+
+        The index is built once per surface (per execution) and holds
+        the vertex coordinates and normals, the vertex coordinates of
+        the paired pial surface of a white surface (or None), and
+        the (polygon) vertex indices of each vertex group.
+        """
+
+        try:
+            return self.surface_indices[ob.name]
+        except KeyError:
+            pass
+
+        co, normal = nb_ut.vertex_arrays(ob.data)
+
+        outer_co = None
+        if 'white' in ob.name:
+            outername = ob.name.replace('white', 'pial')
+            outer = bpy.data.objects.get(outername)
+            if outer is not None:
+                outer_co, _ = nb_ut.vertex_arrays(outer.data)
+
+        groups = nb_ut.vertex_group_indices(ob, polygon_vertices_only=True)
+
+        surface_index = {'co': co, 'normal': normal,
+                         'outer_co': outer_co, 'groups': groups}
+        self.surface_indices[ob.name] = surface_index
 
-        vi_select = []
-        vgs_idxs = [g.index for g in vgs]
-        me = surf.data
-        for poly in surf.data.polygons:
-            for vi in poly.vertices:
-                allgroups = [g.group for g in me.vertices[vi].groups]
-                for vgs_idx in vgs_idxs:
-                    if vgs_idx in allgroups:
-                        vi_select.append(vi)
-        return vi_select
+        return surface_index
 
     def get_indices(self, buildtype, ob, nb_it=None):
         """Return the indices for attaching neuron."""
 
         if buildtype == 'tracts':
-            idxs = [i for i in range(0, len(ob.data.splines))]
+            idxs = np.arange(len(ob.data.splines))
         elif buildtype == 'surfaces':
-            idxs = [i for i in range(0, len(ob.data.vertices))]
+            idxs = np.arange(len(ob.data.vertices))
         elif buildtype == 'tracts_labelgroup':
-            idxs = [i for i, spl in enumerate(ob.data.splines)
-                    if spl.material_index == nb_it.value]
+            mat_idxs = np.zeros(len(ob.data.splines), dtype='int32')
+            ob.data.splines.foreach_get('material_index', mat_idxs)
+            idxs = np.flatnonzero(mat_idxs == nb_it.value)
         elif buildtype == 'surfaces_labelgroup':
-            vgs = [ob.vertex_groups[nb_it.name]]
-            idxs = self.get_vertex_indices_in_groups(ob, vgs)
+            groups = self.get_surface_index(ob)['groups']
+            idxs = groups[nb_it.name]
 
         return idxs
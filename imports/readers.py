@@ -0,0 +1,1273 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# <pep8 compliant>
+
+
+"""The NeuroBlender imports (readers) module.
+
+NeuroBlender is a Blender add-on to create artwork from neuroscientific data.
+This module implements reading tract and surface data files
+independently of Blender.
+"""
+
+
+import os
+import re
+import base64
+import zlib
+import functools
+import itertools
+import collections
+import multiprocessing
+from xml.etree import ElementTree
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+from .. import streamlines as nb_sl
+from . import cache as nb_ca
+
+
+# ========================================================================== #
+# MRtrix (.tck)
+# ========================================================================== #
+
+
+def read_mrtrix_header(fpath):
+    """Return the header fields of a MRtrix .tck file.
+
+    Only the header block up to the 'END' line is read.
+    """
+
+    header = {}
+    with open(fpath, 'rb') as f:
+        f.readline()  # 'mrtrix tracks'
+        for line in f:
+            line = line.decode("utf-8").strip()
+            if line == 'END':
+                break
+            key, _, value = line.partition(':')
+            header[key.strip()] = value.strip()
+
+    return header
+
+
+def mrtrix_dtype(datatype):
+    """Return the numpy dtype for a MRtrix datatype string."""
+
+    ptype = 'f8' if datatype.startswith('Float64') else 'f4'
+    if datatype.endswith('BE'):
+        ptype = '>' + ptype
+    else:
+        ptype = '<' + ptype
+
+    return np.dtype(ptype)
+
+
+def memmap_mrtrix_data(fpath, ncols=3):
+    """Memory-map the data of a MRtrix .tck/.tsf file as [Nrows x ncols].
+
+    Tracks (.tck) have 3 columns, track scalar files (.tsf) have 1.
+    """
+
+    header = read_mrtrix_header(fpath)
+    dtype = mrtrix_dtype(header['datatype'])
+    offset = int(header['file'].split()[1])
+
+    nrows = (os.path.getsize(fpath) - offset) // (dtype.itemsize * ncols)
+    if nrows < 1:
+        return np.zeros((0, ncols), dtype=dtype)
+
+    return np.memmap(fpath, dtype=dtype, mode='r',
+                     offset=offset, shape=(nrows, ncols))
+
+
+def find_delimiters(data, blocksize=1048576):
+    """Return the row indices of the NaN delimiters in MRtrix data.
+
+    The data are scanned in blocks of rows to bound memory use.
+    Scanning stops at the first Inf (end-of-file) triplet;
+    any rows following the last delimiter are discarded.
+    """
+
+    idxs = []
+    for start in range(0, len(data), blocksize):
+        block = data[start:start + blocksize, 0]
+        nonfinite = np.flatnonzero(~np.isfinite(block))
+        if not len(nonfinite):
+            continue
+        is_end = np.isinf(block[nonfinite])
+        if is_end.any():
+            idxs.append(nonfinite[:np.argmax(is_end)] + start)
+            break
+        idxs.append(nonfinite + start)
+
+    if not idxs:
+        return np.zeros(0, dtype='int64')
+
+    return np.concatenate(idxs).astype('int64')
+
+
+def read_mrtrix_streamlines(fpath):
+    """Return the streamlines of a MRtrix .tck file.
+
+    The data are memory-mapped and the NaN delimiters located in one
+    vectorized pass. The returned Streamlines are a view on the file:
+    iterate over 'streamlines.chunks()' to bound peak memory to a chunk.
+    """
+
+    data = memmap_mrtrix_data(fpath)
+    starts, lengths = mrtrix_ranges(data)
+
+    return nb_sl.Streamlines(data, starts, lengths)
+
+
+def mrtrix_ranges(data):
+    """Return the start row and length of the nonempty MRtrix streamlines."""
+
+    delims = find_delimiters(data)
+    starts = np.append(0, delims[:-1] + 1)[:len(delims)]
+    lengths = delims - starts
+    nonempty = lengths > 0
+
+    return starts[nonempty], lengths[nonempty]
+
+
+def read_mrtrix_scalars(fpath):
+    """Return the per-point scalars of a MRtrix track scalar (.tsf) file.
+
+    The data are memory-mapped and split on the NaN delimiters in the
+    same vectorized pass as the tracks, such that the scalars align with
+    the streamlines of the corresponding .tck.
+    Returns the packed scalars and the number of scalars per streamline.
+    """
+
+    data = memmap_mrtrix_data(fpath, ncols=1)
+    starts, lengths = mrtrix_ranges(data)
+    rows = nb_sl.ranges_to_indices(starts, lengths)
+
+    return np.asarray(data[rows, 0], dtype='float32'), lengths
+
+
+# ========================================================================== #
+# TrackVis (.trk; via nibabel)
+# ========================================================================== #
+
+
+def read_trackvis_streamlines(fpath):
+    """Return the streamlines of a TrackVis .trk file (uses nibabel).
+
+    The file is loaded lazily with nibabel's streamlines API and read in
+    chunks on iteration. Points are returned in RAS+ mm space:
+    the voxel-to-RAS affine of the header is applied by nibabel.
+    Per-point and per-streamline data arrays are returned as
+    per-point data columns (per-streamline values are repeated).
+    """
+
+    import nibabel as nib
+
+    trkfile = nib.streamlines.load(fpath, lazy_load=True)
+    nstreamlines = int(trkfile.header.get('nb_streamlines', 0)) or None
+
+    def chunk_fun(chunksize):
+        items = []
+        npoints = 0
+        for item in trkfile.tractogram:
+            items.append(item)
+            npoints += len(item.streamline)
+            if npoints >= chunksize:
+                yield tractogram_items_to_streamlines(items)
+                items = []
+                npoints = 0
+        if items:
+            yield tractogram_items_to_streamlines(items)
+
+    return nb_sl.LazyStreamlines(chunk_fun, nstreamlines)
+
+
+def tractogram_items_to_streamlines(items):
+    """Pack a list of nibabel TractogramItems."""
+
+    items = [item for item in items if len(item.streamline)]
+    streamlines = nb_sl.Streamlines.from_list(
+        [item.streamline for item in items])
+    if not items:
+        return streamlines
+
+    for name in items[0].data_for_points:
+        values = np.concatenate([item.data_for_points[name]
+                                 for item in items])
+        streamlines.data[name] = attribute_array(values, values.shape[1])
+
+    for name in items[0].data_for_streamline:
+        values = np.array([item.data_for_streamline[name]
+                           for item in items]).reshape(len(items), -1)
+        values = np.repeat(values, streamlines.lengths, axis=0)
+        streamlines.data[name] = attribute_array(values, values.shape[1])
+
+    return streamlines
+
+
+# ========================================================================== #
+# NumPy (.npy/.npz)
+# ========================================================================== #
+
+
+def read_npy_streamlines(fpath):
+    """Return the [Npointsx3] streamline in a .npy file."""
+
+    streamline = np.load(fpath)
+
+    return nb_sl.Streamlines.from_list([streamline])
+
+
+def read_npz_streamlines(fpath):
+    """Return all streamlines from a .npz file.
+
+    e.g. from
+    'np.savez_compressed(outfile, streamlines0=streamlines0, ..=..)'
+    NOTE: This doesn't work for .npz pickled in Python 2.x,!! ==>
+    Unicode unpickling incompatibility
+    """
+
+    # TODO: proper checks and error handling
+    # TODO: multitract npz
+    streamlines = []
+    npzfile = np.load(fpath)
+    k = npzfile.files[0] if npzfile.files else None
+    if len(npzfile.files) == 0:
+        print('No files in archive.')
+    elif len(npzfile.files) == 1:  # single tract / streamline
+        if len(npzfile[k][0][0]) == 3:  # k contains a list of Nx3 arrays
+            streamlines = npzfile[k]
+        else:  # k contains a single Nx3 array
+            streamlines.append(npzfile[k])
+    elif len(npzfile.files) > 1:  # multiple tracts / streamlines
+        if len(npzfile[k][0][0]) == 3:  # k contains a list of Nx3 arrays
+            print('multi-tract npz not supported yet.')
+        else:  # each k contains a single Nx3 array
+            for k in npzfile:
+                streamlines.append(npzfile[k])
+
+    return nb_sl.Streamlines.from_list(streamlines)
+
+
+# ========================================================================== #
+# SWC neuron morphology (.swc)
+# ========================================================================== #
+
+
+SWC_COMMENT = re.compile(b'#[^\\n]*')
+
+
+def read_swc_nodes(fpath):
+    """Return the node columns of a swc file.
+
+    Standardized swc files (www.neuromorpho.org) have a line per node:
+    'index structure x y z radius parent [colourcode]'.
+    Comments are stripped and the values are parsed in a single call.
+    structure lookup:
+    0 - undefined
+    1 - soma
+    2 - axon
+    3 - (basal) dendrite
+    4 - apical dendrite
+    5+ - custom
+    """
+
+    with open(fpath, 'rb') as f:
+        text = SWC_COMMENT.sub(b'', f.read()).decode("utf-8")
+
+    lines = [line for line in text.splitlines()[:100] if line.strip()]
+    ncols = len(lines[0].split()) if lines else 7
+
+    values = np.fromstring(text, dtype='float64', sep=' ')
+    if ncols < 7 or len(values) % ncols:
+        # lines with and without colourcode: parse line by line
+        values = np.genfromtxt(fpath, usecols=range(7), ndmin=2)
+        ncols = 7
+    values = values.reshape(-1, ncols)
+
+    nodes = {'index': values[:, 0].astype('int64'),
+             'structure': values[:, 1].astype('int64'),
+             'co': values[:, 2:5].astype('float32'),
+             'radius': values[:, 5].astype('float32'),
+             'parent': values[:, 6].astype('int64')}
+
+    return nodes
+
+
+def read_swc_streamlines(fpath, radius_factor_soma=1.):
+    """Return all neuron branches in a swc file.
+
+    A branch is a run of nodes in file order that each connect to the
+    previous node; a node connecting to an earlier node starts a new
+    branch that includes that (branch)point. Root nodes and links
+    within the soma are not drawn; the soma radius is scaled by
+    'radius_factor_soma'. The branches are derived from the parent
+    column with array operations.
+    """
+
+    nodes = read_swc_nodes(fpath)
+    idxs, parents = nodes['index'], nodes['parent']
+    structure = nodes['structure']
+    if not len(idxs):
+        return nb_sl.Streamlines()
+
+    # row of every node's parent
+    lut = np.full(max(idxs.max(), parents.max()) + 1, -1, dtype='int64')
+    lut[idxs] = np.arange(len(idxs))
+    has_parent = parents >= 0
+    prows = np.full(len(idxs), -1, dtype='int64')
+    prows[has_parent] = lut[parents[has_parent]]
+    if np.any(prows[has_parent] < 0):
+        raise ValueError("swc node with unknown parent")
+
+    radius = nodes['radius'].copy()
+    radius[(structure == 1) & has_parent] *= radius_factor_soma
+
+    # nodes that are drawn, and those that start a new branch
+    soma_link = (structure == 1) & (structure[prows] == 1)
+    rows = np.flatnonzero(has_parent & ~soma_link)
+    if not len(rows):
+        return nb_sl.Streamlines()
+    new_branch = parents[rows] < idxs[rows] - 1
+
+    branchpoint = np.zeros(len(idxs), dtype='float32')
+    branchpoint[prows[rows[new_branch]]] = 1.
+
+    # a new branch is preceded by its parent node
+    ends = np.cumsum(1 + new_branch)
+    points = np.empty(ends[-1], dtype='int64')
+    points[ends - 1] = rows
+    points[ends[new_branch] - 2] = prows[rows[new_branch]]
+
+    starts = ends[new_branch] - 2
+    if not new_branch[0]:
+        starts = np.append(0, starts)
+    lengths = np.diff(np.append(starts, len(points)))
+
+    data = {'radius': radius[points],
+            'structure': structure[points].astype('float32'),
+            'index': idxs[points].astype('float32'),
+            'branchpoint': branchpoint[points]}
+
+    return nb_sl.Streamlines(nodes['co'][points], starts, lengths, data)
+
+
+# ========================================================================== #
+# Camino (.Bfloat/.bfloat/.Bdouble/.bdouble)
+# ========================================================================== #
+
+
+def index_camino_streamlines(data):
+    """Return the offsets and lengths of the streamlines in Camino data.
+
+    Each streamline is stored as [npoints, seedindex, x0, y0, z0, ...];
+    the sweep only reads the two-value header of every streamline.
+    The offsets point to the first coordinate of each streamline.
+    A truncated streamline at the end of the data is discarded.
+    """
+
+    offsets = []
+    lengths = []
+    pos = 0
+    while pos + 2 <= len(data):
+        npoints = int(data[pos])
+        if pos + 2 + npoints * 3 > len(data):
+            break
+        offsets.append(pos + 2)
+        lengths.append(npoints)
+        pos += 2 + npoints * 3
+
+    return np.array(offsets, dtype='int64'), np.array(lengths, dtype='int64')
+
+
+def camino_index_path(fpath):
+    """Return the path of the offsets index cached next to a Camino file."""
+
+    return '{}.index.npz'.format(fpath)
+
+
+def load_camino_index(fpath):
+    """Return the cached offsets and lengths of a Camino file (or None).
+
+    The index is only used if the size and modification time
+    of the tract file match those recorded in the index.
+    """
+
+    stat = os.stat(fpath)
+    try:
+        index = np.load(camino_index_path(fpath))
+    except (IOError, OSError, ValueError):
+        return None
+
+    try:
+        if (int(index['size']) == stat.st_size and
+                float(index['mtime']) == stat.st_mtime):
+            return index['offsets'], index['lengths']
+    except KeyError:
+        pass
+    finally:
+        index.close()
+
+    return None
+
+
+def save_camino_index(fpath, offsets, lengths):
+    """Cache the offsets and lengths of a Camino file next to it.
+
+    Failure to write the index (e.g. a read-only directory) is not an error.
+    """
+
+    stat = os.stat(fpath)
+    try:
+        with open(camino_index_path(fpath), 'wb') as f:
+            np.savez(f, offsets=offsets, lengths=lengths,
+                     size=stat.st_size, mtime=stat.st_mtime)
+    except (IOError, OSError):
+        pass
+
+
+def read_camino_streamlines(fpath, dtype):
+    """Return the streamlines of a Camino tract file.
+
+    The file is memory-mapped and indexed in a single sweep over the
+    streamline headers; the index is cached next to the file.
+    The returned Streamlines are a view on the file: the points of
+    a streamline are only read when it is selected.
+    """
+
+    dtype = np.dtype(dtype)
+    if os.path.getsize(fpath) < 2 * dtype.itemsize:
+        return nb_sl.Streamlines()
+
+    data = np.memmap(fpath, dtype=dtype, mode='r')
+
+    index = load_camino_index(fpath)
+    if index is None:
+        index = index_camino_streamlines(data)
+        save_camino_index(fpath, *index)
+    offsets, lengths = index
+
+    # row r of the view is data[r:r + 3]: point j of a streamline
+    # starting at offset o is row o + 3 * j
+    points = as_strided(data, shape=(len(data) - 2, 3),
+                        strides=(dtype.itemsize, dtype.itemsize))
+
+    return nb_sl.Streamlines(points, offsets, lengths, stride=3)
+
+
+# ========================================================================== #
+# VTK polydata (legacy .vtk; XML .vtp)
+# ========================================================================== #
+
+
+VTK_LEGACY_DTYPES = {
+    'unsigned_char': 'u1', 'char': 'i1',
+    'unsigned_short': 'u2', 'short': 'i2',
+    'unsigned_int': 'u4', 'int': 'i4',
+    'unsigned_long': 'u8', 'long': 'i8',
+    'float': 'f4', 'double': 'f8',
+    'vtkidtype': 'i4', 'vtktypeint32': 'i4', 'vtktypeint64': 'i8',
+    }
+
+VTK_XML_DTYPES = {
+    'Int8': 'i1', 'UInt8': 'u1',
+    'Int16': 'i2', 'UInt16': 'u2',
+    'Int32': 'i4', 'UInt32': 'u4',
+    'Int64': 'i8', 'UInt64': 'u8',
+    'Float32': 'f4', 'Float64': 'f8',
+    }
+
+VTK_CELLTYPES = {
+    'VERTICES': 'verts', 'Verts': 'verts',
+    'LINES': 'lines', 'Lines': 'lines',
+    'TRIANGLE_STRIPS': 'strips', 'Strips': 'strips',
+    'POLYGONS': 'polys', 'Polys': 'polys',
+    }
+
+VTK_KEYWORDS = (
+    'DATASET', 'POINTS', 'VERTICES', 'LINES', 'TRIANGLE_STRIPS', 'POLYGONS',
+    'POINT_DATA', 'CELL_DATA', 'SCALARS', 'COLOR_SCALARS', 'LOOKUP_TABLE',
+    'VECTORS', 'NORMALS', 'TENSORS', 'TEXTURE_COORDINATES', 'FIELD',
+    'METADATA',
+    )
+
+VTK_WHITESPACE = np.zeros(256, dtype='bool')  # byte value lookup table
+VTK_WHITESPACE[[9, 10, 11, 12, 13, 32]] = True
+VTK_SPACE = re.compile(b'\\s')
+
+
+def vtk_file_format(fpath):
+    """Return the encoding of a VTK file: 'ASCII', 'BINARY' or 'XML'."""
+
+    with open(fpath, 'rb') as f:
+        head = f.read(256)
+
+    if head.lstrip().startswith(b'<'):
+        return 'XML'
+
+    lines = head.split(b'\n')
+    if len(lines) < 3:
+        raise ValueError("'{}' is not a valid VTK file".format(fpath))
+
+    fmt = lines[2].strip().upper().decode("utf-8")
+    if fmt not in ('ASCII', 'BINARY'):
+        raise ValueError("'{}' is not a valid VTK file".format(fpath))
+
+    return fmt
+
+
+def read_vtk_polydata(fpath):
+    """Read a VTK polydata file into numpy arrays.
+
+    Supported are legacy ASCII/BINARY .vtk files and XML .vtp files
+    (inline or appended data; raw or base64 encoded; zlib compressed).
+    Returns a dictionary with
+    - 'points': [Npointsx3] coordinates
+    - 'verts', 'lines', 'strips', 'polys': (lengths, connectivity) cells
+    - 'point_data', 'cell_data': dictionaries of named arrays
+    """
+
+    if vtk_file_format(fpath) == 'XML':
+        return read_vtk_xml(fpath)
+    else:
+        return read_vtk_legacy(fpath)
+
+
+def init_polydata():
+    """Return an empty polydata dictionary."""
+
+    polydata = {'points': np.zeros((0, 3), dtype='float32'),
+                'point_data': {},
+                'cell_data': {}}
+    for celltype in set(VTK_CELLTYPES.values()):
+        polydata[celltype] = (np.zeros(0, dtype='int64'),
+                              np.zeros(0, dtype='int64'))
+
+    return polydata
+
+
+def vtk_streamlines(polydata):
+    """Convert the polylines of VTK polydata to packed streamlines.
+
+    The point data arrays are gathered into the streamline data columns.
+    """
+
+    lengths, connectivity = polydata['lines']
+    offsets = np.append(0, np.cumsum(lengths)[:-1])[:len(lengths)]
+    points = np.asarray(polydata['points'][connectivity], dtype='float32')
+    data = {name: values[connectivity]
+            for name, values in polydata['point_data'].items()}
+
+    return nb_sl.Streamlines(points, offsets, lengths, data)
+
+
+def read_vtk_streamlines(fpath):
+    """Return the streamlines in a VTK polydata file."""
+
+    return vtk_streamlines(read_vtk_polydata(fpath))
+
+
+# -------------------------------------------------------------------------- #
+# legacy VTK
+# -------------------------------------------------------------------------- #
+
+
+def next_line(buf, pos):
+    """Return the next non-empty line in buf and the position after it."""
+
+    while pos < len(buf):
+        end = buf.find(b'\n', pos)
+        if end < 0:
+            end = len(buf)
+        line = buf[pos:end].strip()
+        pos = end + 1
+        if line:
+            return line.decode("utf-8"), pos
+
+    return '', pos
+
+
+def starts_with(buf, pos, keyword):
+    """Check if the next non-whitespace bytes in buf start with keyword."""
+
+    while pos < len(buf) and buf[pos:pos + 1].isspace():
+        pos += 1
+
+    return buf[pos:pos + len(keyword)].upper() == keyword
+
+
+def read_binary_values(buf, pos, count, dtype):
+    """Read count big-endian binary values from buf at pos."""
+
+    dtype = np.dtype(dtype).newbyteorder('>')
+    values = np.frombuffer(buf, dtype=dtype, count=count, offset=pos)
+
+    return values.astype(dtype.newbyteorder('=')), pos + count * dtype.itemsize
+
+
+def ascii_values_end(buf, pos, count, blocksize=16777216):
+    """Return the position in buf after the next count ASCII values.
+
+    Token starts are counted in blocks of bytes with numpy,
+    rather than splitting the text token by token.
+    """
+
+    if not count:
+        return pos
+
+    seen = 0
+    prev_space = True
+    while pos < len(buf):
+        block = np.frombuffer(buf, dtype='u1', offset=pos,
+                              count=min(blocksize, len(buf) - pos))
+        space = VTK_WHITESPACE[block]
+        starts = np.flatnonzero(~space & np.append(prev_space, space[:-1]))
+        if seen + len(starts) >= count:
+            start = pos + starts[count - seen - 1]
+            match = VTK_SPACE.search(buf, start)
+            return match.start() if match else len(buf)
+        seen += len(starts)
+        prev_space = space[-1]
+        pos += len(block)
+
+    raise ValueError("unexpected end of VTK file")
+
+
+def read_ascii_values(buf, pos, count, dtype):
+    """Read count whitespace-separated ASCII values from buf at pos."""
+
+    end = ascii_values_end(buf, pos, count)
+    values = np.fromstring(buf[pos:end].decode("utf-8"), dtype='float64',
+                           sep=' ')
+    if len(values) != count:
+        raise ValueError("invalid ASCII data in VTK file")
+
+    return values.astype(dtype), end
+
+
+def legacy_dtype(vtktype):
+    """Return the numpy dtype for a legacy VTK datatype string."""
+
+    try:
+        return np.dtype(VTK_LEGACY_DTYPES[vtktype.lower()])
+    except KeyError:
+        raise ValueError("VTK datatype '{}' not supported".format(vtktype))
+
+
+def unpack_legacy_cells(cells, ncells):
+    """Split a legacy [n, i0, .., in-1, n, ...] cell array.
+
+    Return the cell lengths and the concatenated point indices.
+    """
+
+    cells = np.asarray(cells, dtype='int64')
+    if not ncells:
+        return np.zeros(0, dtype='int64'), np.zeros(0, dtype='int64')
+
+    # fast path: all cells have the same number of points (e.g. triangles)
+    n = cells[0]
+    if len(cells) == ncells * (n + 1) and np.all(cells[::n + 1] == n):
+        connectivity = cells.reshape(ncells, n + 1)[:, 1:].ravel()
+        return np.full(ncells, n, dtype='int64'), connectivity
+
+    starts = np.zeros(ncells, dtype='int64')
+    pos = 0
+    for i in range(ncells):
+        starts[i] = pos + 1
+        pos += cells[pos] + 1
+    lengths = cells[starts - 1]
+
+    return lengths, cells[nb_sl.ranges_to_indices(starts, lengths)]
+
+
+def read_vtk_legacy(fpath):
+    """Read a legacy (ASCII or BINARY) VTK polydata file."""
+
+    with open(fpath, 'rb') as f:
+        buf = f.read()
+
+    if vtk_file_format(fpath) == 'BINARY':
+        read_values, color_dtype = read_binary_values, 'u1'
+    else:
+        read_values, color_dtype = read_ascii_values, 'f4'
+
+    polydata = init_polydata()
+    attributes = polydata['point_data']
+    nattr = 0
+
+    pos = 0
+    for _ in range(3):  # version, title, format
+        _, pos = next_line(buf, pos)
+
+    while True:
+        line, pos = next_line(buf, pos)
+        if not line:
+            break
+        tokens = line.split()
+        key = tokens[0].upper()
+
+        if key == 'DATASET':
+            if tokens[1].upper() != 'POLYDATA':
+                reason = "VTK dataset '{}' not supported".format(tokens[1])
+                raise ValueError(reason)
+
+        elif key == 'POINTS':
+            npoints = int(tokens[1])
+            values, pos = read_values(buf, pos, npoints * 3,
+                                      legacy_dtype(tokens[2]))
+            polydata['points'] = values.reshape(npoints, 3)
+
+        elif key in VTK_CELLTYPES:
+            ncells, size = int(tokens[1]), int(tokens[2])
+            if starts_with(buf, pos, b'OFFSETS'):  # vtk >= 5.1
+                nextline, nextpos = next_line(buf, pos)
+                offsets, pos = read_values(
+                    buf, nextpos, ncells, legacy_dtype(nextline.split()[1]))
+                nextline, nextpos = next_line(buf, pos)
+                connectivity, pos = read_values(
+                    buf, nextpos, size, legacy_dtype(nextline.split()[1]))
+                cells = (np.diff(offsets).astype('int64'),
+                         connectivity.astype('int64'))
+            else:
+                values, pos = read_values(buf, pos, size, 'i4')
+                cells = unpack_legacy_cells(values, ncells)
+            polydata[VTK_CELLTYPES[key]] = cells
+
+        elif key in ('POINT_DATA', 'CELL_DATA'):
+            attributes = polydata[key.lower()]
+            nattr = int(tokens[1])
+
+        elif key == 'SCALARS':
+            ncomp = int(tokens[3]) if len(tokens) > 3 else 1
+            if starts_with(buf, pos, b'LOOKUP_TABLE'):
+                _, pos = next_line(buf, pos)
+            values, pos = read_values(buf, pos, nattr * ncomp,
+                                      legacy_dtype(tokens[2]))
+            attributes[tokens[1]] = attribute_array(values, ncomp)
+
+        elif key == 'COLOR_SCALARS':
+            ncomp = int(tokens[2])
+            values, pos = read_values(buf, pos, nattr * ncomp, color_dtype)
+            if color_dtype == 'u1':
+                values = values / 255.
+            attributes[tokens[1]] = attribute_array(values, ncomp, 'float32')
+
+        elif key in ('VECTORS', 'NORMALS', 'TENSORS',
+                     'TEXTURE_COORDINATES'):
+            if key == 'TEXTURE_COORDINATES':
+                ncomp, vtktype = int(tokens[2]), tokens[3]
+            else:
+                ncomp, vtktype = 9 if key == 'TENSORS' else 3, tokens[2]
+            values, pos = read_values(buf, pos, nattr * ncomp,
+                                      legacy_dtype(vtktype))
+            attributes[tokens[1]] = values.reshape(nattr, ncomp)
+
+        elif key == 'FIELD':
+            for _ in range(int(tokens[2])):
+                line, pos = next_line(buf, pos)
+                name, ncomp, ntuples, vtktype = line.split()[:4]
+                ncomp, ntuples = int(ncomp), int(ntuples)
+                values, pos = read_values(buf, pos, ncomp * ntuples,
+                                          legacy_dtype(vtktype))
+                attributes[name] = attribute_array(values, ncomp)
+
+        elif key == 'LOOKUP_TABLE':
+            _, pos = read_values(buf, pos, int(tokens[2]) * 4, color_dtype)
+
+        elif key == 'METADATA':
+            # skip the metadata up to the next section keyword
+            while pos < len(buf):
+                line, nextpos = next_line(buf, pos)
+                if line.split()[:1] and line.split()[0] in VTK_KEYWORDS:
+                    break
+                pos = nextpos
+
+        else:
+            raise ValueError("VTK keyword '{}' not supported".format(key))
+
+    return polydata
+
+
+def attribute_array(values, ncomp, dtype=None):
+    """Reshape flat attribute values to [N] or [NxNcomp]."""
+
+    values = values.reshape(-1, ncomp)
+    if ncomp == 1:
+        values = values[:, 0]
+    if dtype is not None:
+        values = values.astype(dtype)
+
+    return values
+
+
+# -------------------------------------------------------------------------- #
+# XML VTK (.vtp)
+# -------------------------------------------------------------------------- #
+
+
+def read_vtk_xml(fpath):
+    """Read an XML VTK polydata (.vtp) file."""
+
+    with open(fpath, 'rb') as f:
+        buf = f.read()
+
+    # raw appended data is not valid XML: split it off before parsing
+    appended = None
+    encoding = 'raw'
+    start = buf.find(b'<AppendedData')
+    if start >= 0:
+        tagend = buf.find(b'>', start)
+        tag = ElementTree.fromstring(buf[start:tagend] + b'/>')
+        encoding = tag.get('encoding', 'raw')
+        datastart = buf.find(b'_', tagend) + 1
+        dataend = buf.rfind(b'</AppendedData>')
+        appended = buf[datastart:dataend]
+        if encoding == 'base64':
+            appended = appended.strip()
+        buf = buf[:start] + b'</VTKFile>'
+
+    root = ElementTree.fromstring(buf)
+    if root.get('type') != 'PolyData':
+        reason = "VTK dataset '{}' not supported".format(root.get('type'))
+        raise ValueError(reason)
+
+    byteorder = '>' if root.get('byte_order') == 'BigEndian' else '<'
+    fileinfo = {
+        'byteorder': byteorder,
+        'header_type': byteorder + VTK_XML_DTYPES[root.get('header_type',
+                                                          'UInt32')],
+        'compressed': root.get('compressor') is not None,
+        'appended': appended,
+        'encoding': encoding,
+        }
+
+    polydata = init_polydata()
+    piece = root.find('PolyData').find('Piece')
+    if piece is None:
+        return polydata
+
+    points = piece.find('Points')
+    if points is not None:
+        values = read_xml_dataarray(points.find('DataArray'), fileinfo)
+        polydata['points'] = values.reshape(-1, 3)
+
+    for celltag in ('Verts', 'Lines', 'Strips', 'Polys'):
+        cells = piece.find(celltag)
+        if cells is None:
+            continue
+        arrays = {da.get('Name'): read_xml_dataarray(da, fileinfo)
+                  for da in cells.findall('DataArray')}
+        offsets = np.append(0, arrays['offsets']).astype('int64')
+        polydata[VTK_CELLTYPES[celltag]] = (
+            np.diff(offsets), arrays['connectivity'].astype('int64'))
+
+    for datatag in ('PointData', 'CellData'):
+        attrs = piece.find(datatag)
+        if attrs is None:
+            continue
+        attributes = polydata['point_data' if datatag == 'PointData'
+                              else 'cell_data']
+        for i, da in enumerate(attrs.findall('DataArray')):
+            ncomp = int(da.get('NumberOfComponents', 1))
+            values = read_xml_dataarray(da, fileinfo)
+            name = da.get('Name', 'array{:d}'.format(i))
+            attributes[name] = attribute_array(values, ncomp)
+
+    return polydata
+
+
+def read_xml_dataarray(dataarray, fileinfo):
+    """Decode an XML VTK DataArray into a flat numpy array."""
+
+    dtype = np.dtype(fileinfo['byteorder'] +
+                     VTK_XML_DTYPES[dataarray.get('type')])
+    fmt = dataarray.get('format', 'ascii')
+
+    if fmt == 'ascii':
+        return np.fromstring(dataarray.text or '',
+                             dtype=dtype.newbyteorder('='), sep=' ')
+    elif fmt == 'binary':  # inline data are always base64 encoded
+        text = b''.join((dataarray.text or '').encode("utf-8").split())
+        raw = decode_xml_base64(text, fileinfo)
+    elif fmt == 'appended':
+        offset = int(dataarray.get('offset', 0))
+        if fileinfo['encoding'] == 'base64':
+            raw = decode_xml_base64(fileinfo['appended'][offset:], fileinfo)
+        else:
+            raw = decode_xml_raw(fileinfo['appended'], offset, fileinfo)
+    else:
+        raise ValueError("VTK DataArray format '{}' not supported".format(fmt))
+
+    values = np.frombuffer(raw, dtype=dtype)
+
+    return values.astype(dtype.newbyteorder('='))
+
+
+def decompress_xml_blocks(header, data):
+    """Decompress the zlib blocks of a compressed VTK data array.
+
+    The header is [nblocks, blocksize, lastblocksize, compsize0, ...].
+    """
+
+    compsizes = np.asarray(header[3:], dtype='int64')
+    bounds = np.append(0, np.cumsum(compsizes))
+
+    return b''.join(zlib.decompress(data[i:j])
+                    for i, j in zip(bounds[:-1], bounds[1:]))
+
+
+def decode_xml_raw(buf, offset, fileinfo):
+    """Return the bytes of a raw appended data array at offset."""
+
+    htype = np.dtype(fileinfo['header_type'])
+    if not fileinfo['compressed']:
+        nbytes = int(np.frombuffer(buf, htype, 1, offset)[0])
+        start = offset + htype.itemsize
+        return buf[start:start + nbytes]
+
+    nblocks = int(np.frombuffer(buf, htype, 1, offset)[0])
+    header = np.frombuffer(buf, htype, 3 + nblocks, offset)
+    start = offset + (3 + nblocks) * htype.itemsize
+
+    nbytes = int(sum(header[3:]))
+
+    return decompress_xml_blocks(header, buf[start:start + nbytes])
+
+
+def b64_nchars(nbytes):
+    """Return the number of base64 characters encoding nbytes."""
+
+    return 4 * ((nbytes + 2) // 3)
+
+
+def decode_xml_base64(text, fileinfo):
+    """Return the bytes of a base64 encoded data array.
+
+    The header may be encoded separately from or jointly with the data.
+    """
+
+    htype = np.dtype(fileinfo['header_type'])
+
+    if not fileinfo['compressed']:
+        hbytes = htype.itemsize
+        hchars = b64_nchars(hbytes)
+        nbytes = int(np.frombuffer(base64.b64decode(text[:hchars]),
+                                   htype, 1)[0])
+        if text[hchars - 1:hchars] == b'=' or not hbytes % 3:
+            return base64.b64decode(text[hchars:hchars + b64_nchars(nbytes)])
+        else:
+            raw = base64.b64decode(text[:b64_nchars(hbytes + nbytes)])
+            return raw[hbytes:hbytes + nbytes]
+
+    # the first three header entries are a whole number of base64 quanta
+    head = base64.b64decode(text[:b64_nchars(3 * htype.itemsize)])
+    nblocks = int(np.frombuffer(head, htype, 1)[0])
+    hbytes = (3 + nblocks) * htype.itemsize
+    hchars = b64_nchars(hbytes)
+    header = np.frombuffer(base64.b64decode(text[:hchars]), htype, 3 + nblocks)
+    nbytes = int(sum(header[3:]))
+    if text[hchars - 1:hchars] == b'=' or not hbytes % 3:
+        data = base64.b64decode(text[hchars:hchars + b64_nchars(nbytes)])
+    else:
+        data = base64.b64decode(text[:b64_nchars(hbytes + nbytes)])[hbytes:]
+
+    return decompress_xml_blocks(header, data)
+
+
+# ========================================================================== #
+# Tract scalars (.tsf/.asc/.npz)
+# ========================================================================== #
+
+
+ASC_WHITESPACE = np.zeros(256, dtype='bool')
+ASC_WHITESPACE[[ord(c) for c in ' \t\r\n']] = True
+
+
+def read_asc_scalars(fpath):
+    """Return the per-point scalars of a text file (a streamline per line).
+
+    The values are parsed in a single call; the number of values per
+    line is counted from the token starts in the raw bytes.
+    Returns the packed scalars and the number of scalars per streamline.
+    """
+
+    with open(fpath, 'rb') as f:
+        text = f.read()
+
+    values = np.fromstring(text.decode("utf-8"), dtype='float64', sep=' ')
+
+    chars = np.frombuffer(text, dtype='uint8')
+    is_space = ASC_WHITESPACE[chars]
+    newlines = chars == ord('\n')
+    nlines = np.count_nonzero(newlines)
+    if len(chars) and not newlines[-1]:
+        nlines += 1
+
+    token_starts = ~is_space & np.append(True, is_space[:-1])
+    line_ids = np.cumsum(newlines) - newlines
+    lengths = np.bincount(line_ids[token_starts], minlength=nlines)
+
+    if lengths.sum() != len(values):
+        raise ValueError("invalid values in '{}'".format(fpath))
+
+    return values.astype('float32'), lengths.astype('int64')
+
+
+def read_npz_scalars(fpath):
+    """Return the per-point scalars of a .npz file (a streamline per key).
+
+    The streamlines are ordered by the numbers in the keys,
+    e.g. from 'np.savez(outfile, *scalars)' ('arr_0', 'arr_1', ...).
+    Returns the packed scalars and the number of scalars per streamline.
+    """
+
+    npzfile = np.load(fpath)
+    keys = sorted(npzfile.files, key=numbered_key)
+    scalars = [np.ravel(npzfile[k]) for k in keys]
+    if not scalars:
+        return np.zeros(0, dtype='float32'), np.zeros(0, dtype='int64')
+
+    lengths = np.array([len(scalar) for scalar in scalars], dtype='int64')
+
+    return np.concatenate(scalars).astype('float32'), lengths
+
+
+def numbered_key(name):
+    """Return a sort key that orders trailing numbers numerically."""
+
+    match = re.match(r'(.*?)(\d*)$', name)
+
+    return match.group(1), int(match.group(2) or -1)
+
+
+SCALAR_READERS = {
+    '.tsf': read_mrtrix_scalars,
+    '.asc': read_asc_scalars,
+    '.npz': read_npz_scalars,
+    }
+
+
+def read_tract_scalars(fpath):
+    """Return the per-point scalars of a tract scalar file.
+
+    Returns a list with an array of scalars for every streamline:
+    views on the packed scalars.
+    """
+
+    _, ext = os.path.splitext(fpath)
+    values, lengths = SCALAR_READERS[ext](fpath)
+
+    return np.split(values, np.cumsum(lengths)[:-1])
+
+
+# ========================================================================== #
+# Process pool
+# ========================================================================== #
+
+
+STREAMLINE_READERS = {
+    '.npy': (read_npy_streamlines, {}),
+    '.npz': (read_npz_streamlines, {}),
+    '.swc': (read_swc_streamlines, {}),
+    '.trk': (read_trackvis_streamlines, {}),
+    '.tck': (read_mrtrix_streamlines, {}),
+    '.vtk': (read_vtk_streamlines, {}),
+    '.vtp': (read_vtk_streamlines, {}),
+    '.Bfloat': (read_camino_streamlines, {'dtype': '>f4'}),
+    '.bfloat': (read_camino_streamlines, {'dtype': '<f4'}),
+    '.Bdouble': (read_camino_streamlines, {'dtype': '>f8'}),
+    '.bdouble': (read_camino_streamlines, {'dtype': '<f8'}),
+    }
+
+
+# text formats that are parsed in worker processes;
+# memory-mapped and lazily read formats are read in the main process
+POOLED_EXTENSIONS = ('.swc', '.vtk', '.vtp')
+
+# code run in a worker process before it imports the readers
+WORKER_BOOTSTRAP = """
+import sys
+import types
+for name, path in {!r}:
+    module = types.ModuleType(name)
+    module.__path__ = [path]
+    sys.modules.setdefault(name, module)
+"""
+
+
+def has_streamline_reader(fpath):
+    """Check if a tract file can be read without Blender."""
+
+    return os.path.splitext(fpath)[1] in STREAMLINE_READERS
+
+
+def has_pooled_reader(fpath):
+    """Check if a tract file is parsed in a worker process."""
+
+    return os.path.splitext(fpath)[1] in POOLED_EXTENSIONS
+
+
+def read_streamlines(fpath, options={}):
+    """Return the streamlines of a tract file.
+
+    The reader is chosen by file extension;
+    'options' maps extensions to extra reader keyword arguments,
+    e.g. {'.swc': {'radius_factor_soma': 0.5}}.
+    Raises NotImplementedError for unsupported file formats.
+    """
+
+    ext = os.path.splitext(fpath)[1]
+    try:
+        fun, kwargs = STREAMLINE_READERS[ext]
+    except KeyError:
+        raise NotImplementedError(
+            "file format '{}' not supported".format(ext))
+    kwargs = dict(kwargs, **options.get(ext, {}))
+
+    return fun(fpath, **kwargs)
+
+
+def read_task(task):
+    """Return the streamlines of a task (through the cache).
+
+    'task' is a tuple (fpath, options, cacheargs), where 'cacheargs'
+    are the keyword arguments of cache.read_streamlines_cached
+    (or None to bypass the cache).
+    """
+
+    fpath, options, cacheargs = task
+    read_fun = functools.partial(read_streamlines, options=options)
+    if cacheargs is None:
+        return read_fun(fpath)
+
+    ext = os.path.splitext(fpath)[1]
+
+    return nb_ca.read_streamlines_cached(fpath, read_fun,
+                                         options=options.get(ext, {}),
+                                         **cacheargs)
+
+
+def parse_streamlines(task):
+    """Read and pack the streamlines of a tract file in a worker process.
+
+    The streamlines are packed for the transfer to the main process;
+    streamlines that were written to the cache are not transferred,
+    but mapped from the cache by the main process (see 'load_parsed').
+    Returns a tuple (fpath, streamlines, error),
+    with streamlines None for cached files.
+    """
+
+    try:
+        streamlines = read_task(task)
+        if isinstance(streamlines.points, np.memmap):
+            streamlines = None
+        else:
+            streamlines = streamlines.pack()
+    except Exception as error:
+        return task[0], None, error
+
+    return task[0], streamlines, None
+
+
+def load_parsed(task, result):
+    """Map the streamlines of a file cached by a worker process."""
+
+    fpath, streamlines, error = result
+    if streamlines is None and error is None:
+        try:
+            streamlines = read_task(task)
+        except Exception as error:
+            return fpath, None, error
+
+    return fpath, streamlines, error
+
+
+def pool_size(nworkers=0):
+    """Return the number of worker processes (0: one per core)."""
+
+    if nworkers > 0:
+        return nworkers
+
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def worker_bootstrap():
+    """Return the code that makes this module importable in a worker.
+
+    The packages of the add-on are registered without running their
+    __init__ (which imports bpy), such that the bpy-free readers can
+    be imported in a plain Python process.
+    """
+
+    subpackage, package = __package__, __package__.rpartition('.')[0]
+    subpath = os.path.dirname(os.path.abspath(__file__))
+    packages = [(package, os.path.dirname(subpath)), (subpackage, subpath)]
+
+    return WORKER_BOOTSTRAP.format(packages)
+
+
+def read_streamlines_parallel(tasks, nworkers=0, executable=None):
+    """Yield the parsed streamlines of a list of tract files in order.
+
+    The files are parsed in a pool of worker processes (see
+    'parse_streamlines' for the tasks and yielded tuples), such that the
+    caller can build the streamlines of one file while the next files
+    are parsed. The workers are spawned with the Python 'executable'
+    (not forked from Blender) and at most 'nworkers' files are parsed
+    ahead of the caller, bounding the results held in memory.
+    Without an executable, or with a single worker or file,
+    the files are read serially in the calling process.
+    """
+
+    nworkers = min(pool_size(nworkers), len(tasks))
+
+    if executable is None or nworkers < 2:
+        for task in tasks:
+            try:
+                yield task[0], read_task(task), None
+            except Exception as error:
+                yield task[0], None, error
+        return
+
+    context = multiprocessing.get_context('spawn')
+    context.set_executable(executable)
+    pool = context.Pool(nworkers, initializer=exec,
+                        initargs=(worker_bootstrap(),))
+    try:
+        tasks = iter(tasks)
+        pending = collections.deque()
+        for task in itertools.islice(tasks, nworkers):
+            pending.append((task, pool.apply_async(parse_streamlines,
+                                                   (task,))))
+        while pending:
+            task, result = pending.popleft()
+            for nexttask in itertools.islice(tasks, 1):
+                pending.append((nexttask, pool.apply_async(
+                    parse_streamlines, (nexttask,))))
+            yield load_parsed(task, result.get())
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
@@ -742,8 +742,13 @@ def make_cr_mat_surface_sg(scalargroup, img=[]):
     return mat
 
 
-def make_cr_mat_tract_sg(name, img, group):
-    """Create a Cycles material for a tract scalargroup."""
+def make_cr_mat_tract_sg(name, group, atlasgroup, offset, row, scale):
+    """Create a Cycles material for a streamline of a tract scalargroup.
+
+    The streamline's scalars are read from the scalargroup's atlas,
+    starting at pixel column 'offset' and 'row' and spanning 'scale'
+    pixels (see make_cr_atlasgroup_tract_sg).
+    """
 
     mat = (bpy.data.materials.get(name) or
            bpy.data.materials.new(name))
@@ -766,11 +771,14 @@ def make_cr_mat_tract_sg(name, img, group):
     groupnode.node_tree = group
     groupnode.label = "NodeGroup"
 
-    itex = nodes.new("ShaderNodeTexImage")
-    itex.location = 400, 100
-    itex.name = prefix + "Image Texture"
-    itex.image = img
-    itex.label = "Image texture"
+    atlasnode = nodes.new("ShaderNodeGroup")
+    atlasnode.location = 400, 100
+    atlasnode.name = prefix + "Atlas"
+    atlasnode.node_tree = atlasgroup
+    atlasnode.label = "Atlas"
+    atlasnode.inputs["Offset"].default_value = offset
+    atlasnode.inputs["Row"].default_value = row
+    atlasnode.inputs["Scale"].default_value = scale
 
     texc = nodes.new("ShaderNodeTexCoord")
     texc.location = 200, 100
@@ -778,12 +786,149 @@ def make_cr_mat_tract_sg(name, img, group):
     texc.label = "Texture Coordinate"
 
     links.new(groupnode.outputs["Shader"], out.inputs["Surface"])
-    links.new(itex.outputs["Color"], groupnode.inputs["Color"])
-    links.new(texc.outputs["UV"], itex.inputs["Vector"])
+    links.new(atlasnode.outputs["Color"], groupnode.inputs["Color"])
+    links.new(texc.outputs["UV"], atlasnode.inputs["Vector"])
 
     return mat
 
 
+def make_cr_atlasgroup_tract_sg(img, layerrows, nb_ov=None):
+    """Create a Cycles node group to sample a tract scalargroup atlas.
+
+    The curve UV runs along the streamline (x) and around it (y).
+    The scalars of the streamlines are packed contiguously in the atlas,
+    wrapped across its rows. The position along the streamline,
+    p = UV.x * Scale + Offset, is converted to a pixel (column, row),
+    offset by Row and by Layer * layerrows (the 'Layer' value selects
+    the timepoint). The atlas is sampled at the pixels on either side of
+    p and the colours are interpolated linearly.
+    """
+
+    width, height = img.size
+
+    name = "TractOvAtlas.{}".format(nb_ov.name)
+    group = bpy.data.node_groups.new(name, "ShaderNodeTree")
+    group.inputs.new("NodeSocketVector", "Vector")
+    group.inputs.new("NodeSocketFloat", "Offset")
+    group.inputs.new("NodeSocketFloat", "Row")
+    group.inputs.new("NodeSocketFloat", "Scale")
+    group.outputs.new("NodeSocketColor", "Color")
+
+    nodes = group.nodes
+    links = group.links
+
+    nodes.clear()
+
+    def math_node(name, operation, location, value=None):
+        """Add a math node (with a constant second input)."""
+
+        node = nodes.new("ShaderNodeMath")
+        node.label = name
+        node.name = name
+        node.operation = operation
+        node.location = location
+        if value is not None:
+            node.inputs[1].default_value = value
+        return node
+
+    output_node = nodes.new("NodeGroupOutput")
+    output_node.location = (1600, 0)
+
+    mixc = nodes.new("ShaderNodeMixRGB")
+    mixc.label = "MixSamples"
+    mixc.name = "MixSamples"
+    mixc.blend_type = 'MIX'
+    mixc.location = 1400, 0
+
+    input_node = group.nodes.new("NodeGroupInput")
+    input_node.location = (-800, 0)
+
+    sxyz = nodes.new("ShaderNodeSeparateXYZ")
+    sxyz.label = "Separate XYZ"
+    sxyz.name = "Separate XYZ"
+    sxyz.location = -600, 100
+
+    tval = nodes.new("ShaderNodeValue")
+    tval.label = "Layer"
+    tval.name = "Layer"
+    tval.outputs[0].default_value = 0
+    tval.location = -600, -200
+
+    # position along the packed scalars
+    muls = math_node("MultiplyScale", 'MULTIPLY', (-400, 100))
+    addo = math_node("AddOffset", 'ADD', (-200, 100))
+    frac = math_node("Fraction", 'MODULO', (0, 200), 1.)
+    subf = math_node("SubtractFraction", 'SUBTRACT', (200, 100))
+
+    # first row of the streamline in the layer
+    mull = math_node("MultiplyLayer", 'MULTIPLY', (-400, -200), layerrows)
+    addr = math_node("AddRow", 'ADD', (-200, -200))
+
+    links.new(input_node.outputs["Vector"], sxyz.inputs[0])
+    links.new(sxyz.outputs["X"], muls.inputs[0])
+    links.new(input_node.outputs["Scale"], muls.inputs[1])
+    links.new(muls.outputs["Value"], addo.inputs[0])
+    links.new(input_node.outputs["Offset"], addo.inputs[1])
+    links.new(addo.outputs["Value"], frac.inputs[0])
+    links.new(addo.outputs["Value"], subf.inputs[0])
+    links.new(frac.outputs["Value"], subf.inputs[1])
+    links.new(tval.outputs["Value"], mull.inputs[0])
+    links.new(input_node.outputs["Row"], addr.inputs[0])
+    links.new(mull.outputs["Value"], addr.inputs[1])
+    links.new(frac.outputs["Value"], mixc.inputs["Fac"])
+
+    # sample the pixels at floor(p) and floor(p) + 1
+    for i in range(2):
+        prefix = "Sample{}.".format(i)
+        y = -400 * i
+
+        addi = math_node(prefix + "AddIndex", 'ADD', (400, y), i)
+        modw = math_node(prefix + "Column", 'MODULO', (600, y), width)
+        subc = math_node(prefix + "SubtractColumn", 'SUBTRACT',
+                         (600, y - 200))
+        divw = math_node(prefix + "RowsWrapped", 'DIVIDE',
+                         (800, y - 200), width)
+        addw = math_node(prefix + "AddRowsWrapped", 'ADD', (1000, y - 200))
+        cenx = math_node(prefix + "CenterX", 'ADD', (800, y), 0.5)
+        ceny = math_node(prefix + "CenterY", 'ADD', (1000, y - 100), 0.5)
+        divx = math_node(prefix + "NormalizeX", 'DIVIDE', (1000, y), width)
+        divy = math_node(prefix + "NormalizeY", 'DIVIDE',
+                         (1000, y - 300), height)
+
+        cxyz = nodes.new("ShaderNodeCombineXYZ")
+        cxyz.label = prefix + "Combine XYZ"
+        cxyz.name = prefix + "Combine XYZ"
+        cxyz.location = 1200, y
+
+        itex = nodes.new("ShaderNodeTexImage")
+        itex.label = prefix + "Image Texture"
+        itex.name = prefix + "Image Texture"
+        itex.image = img
+        itex.interpolation = 'Closest'
+        itex.extension = 'EXTEND'
+        itex.location = 1200, y - 200
+
+        links.new(subf.outputs["Value"], addi.inputs[0])
+        links.new(addi.outputs["Value"], modw.inputs[0])
+        links.new(addi.outputs["Value"], subc.inputs[0])
+        links.new(modw.outputs["Value"], subc.inputs[1])
+        links.new(subc.outputs["Value"], divw.inputs[0])
+        links.new(divw.outputs["Value"], addw.inputs[0])
+        links.new(addr.outputs["Value"], addw.inputs[1])
+        links.new(modw.outputs["Value"], cenx.inputs[0])
+        links.new(cenx.outputs["Value"], divx.inputs[0])
+        links.new(addw.outputs["Value"], ceny.inputs[0])
+        links.new(ceny.outputs["Value"], divy.inputs[0])
+        links.new(divx.outputs["Value"], cxyz.inputs["X"])
+        links.new(divy.outputs["Value"], cxyz.inputs["Y"])
+        links.new(cxyz.outputs["Vector"], itex.inputs["Vector"])
+        links.new(itex.outputs["Color"], mixc.inputs[i + 1])
+
+    links.new(mixc.outputs["Color"], output_node.inputs["Color"])
+
+    return group
+
+
 def make_cr_matgroup_tract_sg(diffcol, mix=0.04, nb_ov=None):
     """Create a Cycles material group for a tract scalargroup."""
 
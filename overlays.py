@@ -30,6 +30,8 @@ import os
 import re
 
 import numpy as np
+from mathutils import Vector
+from mathutils.bvhtree import BVHTree
 
 import bpy
 from bpy.types import PropertyGroup as pg
@@ -38,14 +40,19 @@ from bpy.types import (Operator,
                        UIList)
 from bpy.props import (BoolProperty,
                        StringProperty,
+                       EnumProperty,
+                       FloatVectorProperty,
                        IntProperty,
                        FloatProperty,
                        CollectionProperty)
 from bpy_extras.io_utils import (ImportHelper,
                                  ExportHelper)
 
-from . import (materials as nb_ma,
+from . import (clustering as nb_cl,
+               materials as nb_ma,
                properties as nb_pr,
+               spatial as nb_sp,
+               streamlines as nb_sl,
                utils as nb_ut)
 from .imports import (import_tracts as nb_it,
                       import_surfaces as nb_is,
@@ -123,6 +130,12 @@ class NB_OT_create_labelgroup(Operator):
         default=30.,
         min=0.)
 
+    qb_hierarchy = StringProperty(
+        name="Finer thresholds",
+        description="""Comma-separated finer thresholds for nested
+            labelgroups (clustered within the clusters of the threshold)""",
+        default="")
+
     qb_centroids = BoolProperty(
         name="Centroids",
         description="Create a QuickBundles centroids object",
@@ -133,6 +146,11 @@ class NB_OT_create_labelgroup(Operator):
         description="Create a tract object for every QuickBundles cluster",
         default=False)
 
+    qb_use_dipy = BoolProperty(
+        name="Use dipy",
+        description="Use dipy's QuickBundles (if available)",
+        default=False)
+
     def draw(self, context):
 
         row = self.layout.row()
@@ -141,12 +159,18 @@ class NB_OT_create_labelgroup(Operator):
         row = self.layout.row()
         row.prop(self, "qb_threshold")
 
+        row = self.layout.row()
+        row.prop(self, "qb_hierarchy")
+
         row = self.layout.row()
         row.prop(self, "qb_centroids")
 
         row = self.layout.row()
         row.prop(self, "qb_separation")
 
+        row = self.layout.row()
+        row.prop(self, "qb_use_dipy")
+
     def execute(self, context):
 
         scn = bpy.context.scene
@@ -158,12 +182,31 @@ class NB_OT_create_labelgroup(Operator):
         name = nb_ob.name
         ob = bpy.data.objects[name]
 
-        streamlines = self.splines_to_streamlines(ob)
-        clusters = self.quickbundles(streamlines)
+        try:
+            thresholds = self.get_thresholds()
+        except ValueError:
+            info = "invalid thresholds: '{}'".format(self.qb_hierarchy)
+            self.report({'WARNING'}, info)
+            return {"CANCELLED"}
+
+        features = nb_ut.get_streamline_features(ob, self.qb_points)
+        if len(thresholds) > 1:
+            levels = [(threshold, nb_cl.labels_to_clusters(labels, cents))
+                      for threshold, labels, cents in
+                      nb_cl.quickbundles_hierarchy(features, thresholds)]
+        else:
+            levels = [(self.qb_threshold, self.quickbundles(features))]
+        clusters = levels[-1][1]
         if not clusters:
             return {"CANCELLED"}
 
-        nb_ob = self.qb_labelgroup(ob, nb_ob, clusters)
+        for threshold, level_clusters in levels:
+            postfix = 'qb'
+            if len(levels) > 1:
+                postfix = 'qb{:g}'.format(threshold).replace('.', '_')
+            lg = self.qb_labelgroup(ob, nb_ob, level_clusters,
+                                    postfix=postfix)
+        nb_ob = lg
 
         if self.qb_centroids:
             cob, nb_cob = self.qb_centroids_import(context, ob, clusters)
@@ -180,47 +223,48 @@ class NB_OT_create_labelgroup(Operator):
 
         return context.window_manager.invoke_props_dialog(self)
 
-    def quickbundles(self, streamlines):
-        """Segment tract with QuickBundles."""
+    def get_thresholds(self):
+        """Return the thresholds from coarse to fine (at least one)."""
+
+        finer = [float(t) for t in self.qb_hierarchy.split(',') if t.strip()]
+
+        return sorted(set([self.qb_threshold] + finer), reverse=True)
+
+    def quickbundles(self, features):
+        """Segment tract with QuickBundles.
+
+        The features are the streamlines resampled to qb_points.
+        Without dipy (or by default) the built-in QuickBundles is used.
+        """
 
         # TODO: implement other metrics
-        try:
-            from dipy.segment.clustering import QuickBundles
-            from dipy.segment.metric import ResampleFeature
-            from dipy.segment.metric import AveragePointwiseEuclideanMetric
-        except ImportError:
-            return None
-        else:
+        if self.qb_use_dipy:
+            try:
+                from dipy.segment.clustering import QuickBundles
+                from dipy.segment.metric import AveragePointwiseEuclideanMetric
+            except ImportError:
+                self.report({'WARNING'}, "dipy not found: using built-in")
+            else:
+                metric = AveragePointwiseEuclideanMetric()
+                qb = QuickBundles(threshold=self.qb_threshold, metric=metric)
+                return qb.cluster(list(features))
 
-            feature = ResampleFeature(nb_points=self.qb_points)
-            metric = AveragePointwiseEuclideanMetric(feature=feature)
-            qb = QuickBundles(threshold=self.qb_threshold, metric=metric)
-            clusters = qb.cluster(streamlines)
+        labels, centroids = nb_cl.quickbundles(features, self.qb_threshold)
 
-        return clusters
+        return nb_cl.labels_to_clusters(labels, centroids)
 
     def splines_to_streamlines(self, ob):
-        """Read curve object splines into list of numpy streamlines."""
-
-        streamlines = []
-        for spl in ob.data.splines:
-            streamline = []
-            for point in spl.points:
-                slpoint = list(point.co[:3])
-                slpoint.append(point.radius)
-                slpoint.append(spl.material_index)
-                slpoint.append(point.weight)
-                streamline.append(slpoint)
-            streamlines.append(np.array(streamline))
+        """Read curve object splines into packed streamlines."""
 
-        return streamlines
+        return nb_ut.curve_to_streamlines(ob.data, with_data=True)
 
     def qb_centroids_import(self, context, ob, clusters):
         """Import a tract objects for QuickBundles centroids."""
 
         cname = '{}.centroids'.format(ob.name)
 
-        centroids = [cluster.centroid for cluster in clusters]
+        centroids = nb_sl.Streamlines.from_list(
+            [cluster.centroid for cluster in clusters])
 
         it_class = nb_it.NB_OT_import_tracts
         create_tract_object = it_class.create_tract_object
@@ -243,10 +287,10 @@ class NB_OT_create_labelgroup(Operator):
         return cob, nb_cob
 
     def qb_labelgroup(self, ob, nb_ob,
-                      clusters=None, centroid=False):
+                      clusters=None, centroid=False, postfix='qb'):
         """Create a labelgroup from QuickBundles clusters."""
 
-        name = '{}.qb'.format(nb_ob.name)
+        name = '{}.{}'.format(nb_ob.name, postfix)
 
         # TODO: remove/store previous material_slots...
         matgroup = [(cluster.id + 1,
@@ -266,24 +310,20 @@ class NB_OT_create_labelgroup(Operator):
         return labelgroup
 
     def set_material_indices(self, ob, clusters, lg, centroid=False):
-        """Set the material indices according to cluster id's."""
+        """Set the material indices according to cluster id's.
+
+        The labels of 'lg' are in the order of the clusters, label i
+        in material slot i+1; every label stores the indices of its splines.
+        """
 
         splines = ob.data.splines
-        lab_idxs = np.zeros(len(splines), dtype='int')
-        mat_idxs = np.zeros(len(splines))
-        for i, cluster in enumerate(clusters):
-            if centroid:
-                mat_idxs[i] = cluster.id + 1
-                lab_idxs[i] = cluster.id
-            else:
-                mat_idxs[cluster.indices] = cluster.id + 1
-                lab_idxs[cluster.indices] = cluster.id
+        mat_idxs = np.zeros(len(splines), dtype='int32')
+        for i, (cluster, label) in enumerate(zip(clusters, lg.labels)):
+            idxs = [i] if centroid else cluster.indices
+            mat_idxs[idxs] = i + 1
+            nb_ut.set_label_splines(label, idxs)
 
-        it = zip(splines, mat_idxs, lab_idxs)
-        for i, (spl, mat_idx, lab_idx) in enumerate(it):
-            spl.material_index = mat_idx
-            splidx = lg.labels[lab_idx].spline_indices.add()
-            splidx.spline_index = i
+        splines.foreach_set('material_index', mat_idxs)
 
 
 class NB_OT_separate_labels(Operator):
@@ -357,6 +397,15 @@ class NB_OT_separate_labels(Operator):
                    "depth": ob.data.bevel_depth,
                    "res": ob.data.bevel_resolution}
 
+        streamlines = nb_ut.curve_to_streamlines(ob.data, with_data=True)
+        mat_idxs = streamlines.per_streamline('structure')
+        # the label material is the first slot of the new object
+        data = {k: v for k, v in streamlines.data.items()
+                if k != 'structure'}
+        streamlines = nb_sl.Streamlines(streamlines.points,
+                                        streamlines.offsets,
+                                        streamlines.lengths, data)
+
         obs = []
         for i, ms in enumerate(ob.material_slots):
 
@@ -372,10 +421,8 @@ class NB_OT_separate_labels(Operator):
             ms_ob.data.materials.append(mat)
             obs.append(ms_ob)
 
-            for spl in ob.data.splines:
-                if spl.material_index == i:
-                    polyline = ms_ob.data.splines.new('POLY')
-                    self.copy_spline(spl, polyline)
+            idxs = np.flatnonzero(mat_idxs == i)
+            nb_ut.make_polylines(ms_ob.data, streamlines.select(idxs))
 
             tract_to_nb = nb_it.NB_OT_import_tracts.tract_to_nb
             tract_to_nb(context, ms_ob,
@@ -386,15 +433,6 @@ class NB_OT_separate_labels(Operator):
 
         return obs
 
-    def copy_spline(self, spline, newspline):
-        """Copy over a POLY spline."""
-
-        newspline.points.add(len(spline.points) - 1)
-        for point, newpoint in zip(spline.points, newspline.points):
-            newpoint.co = point.co
-            newpoint.radius = point.radius
-            newpoint.weight = point.weight
-
     def separate_labels_surfaces(self, context, labelgroup):
         """Separate surface labels according to material."""
 
@@ -428,6 +466,309 @@ class NB_OT_separate_labels(Operator):
         return obs
 
 
+def roi_surfaces_enum_callback(self, context):
+    """Populate the enum with the NeuroBlender surfaces."""
+
+    nb = context.scene.nb
+
+    items = [(surf.name, surf.name, "Surface mesh", i)
+             for i, surf in enumerate(nb.surfaces)]
+
+    return items
+
+
+def roi_labels_enum_callback(self, context):
+    """Populate the enum with the voxelvolume labelgroups and labels."""
+
+    nb = context.scene.nb
+
+    items = []
+    for vvol in nb.voxelvolumes:
+        for lg in vvol.labelgroups:
+            items.append((lg.path_from_id(), lg.name,
+                          "All labels in the labelgroup", len(items)))
+            for label in lg.labels:
+                items.append((label.path_from_id(), label.name,
+                              "Label {:d}".format(label.value), len(items)))
+
+    return items
+
+
+class MeshRegion(object):
+    """The interior of a closed mesh as a region of interest.
+
+    A point is inside if it is behind the surface at its nearest point.
+    Points are tested one by one against a BVH tree of the mesh.
+    """
+
+    def __init__(self, ob, scene):
+
+        self.tree = BVHTree.FromObject(ob, scene)
+        self.inverse = np.array(ob.matrix_world.inverted())
+        corners = np.array([ob.matrix_world * Vector(co)
+                            for co in ob.bound_box])
+        self.lo, self.hi = corners.min(axis=0), corners.max(axis=0)
+
+    def bounds(self):
+        """Return the corners (lo, hi) of the bounding box."""
+
+        return self.lo, self.hi
+
+    def contains(self, points):
+        """Return a mask of the points inside the region."""
+
+        points = np.dot(points, self.inverse[:3, :3].T) + self.inverse[:3, 3]
+
+        inside = np.zeros(len(points), dtype='bool')
+        for i, point in enumerate(points):
+            point = Vector(point)
+            location, normal, _, _ = self.tree.find_nearest(point)
+            if location is not None:
+                inside[i] = (point - location).dot(normal) < 0
+
+        return inside
+
+
+class NB_OT_filter_tract(Operator):
+    bl_idname = "nb.filter_tract"
+    bl_label = "Filter tract"
+    bl_description = "Select streamlines by a region of interest"
+    bl_options = {"REGISTER", "UNDO"}
+
+    data_path = StringProperty(
+        name="data path",
+        description="Specify object data path",
+        default="")
+    name = StringProperty(
+        name="Name",
+        description="Name of the output (default: '<tract>.roi')",
+        default="")
+
+    region = EnumProperty(
+        name="Region",
+        description="The type of region of interest",
+        default="sphere",
+        items=[("sphere", "sphere", "A sphere around a centre", 0),
+               ("box", "box", "An axis-aligned box around a centre", 1),
+               ("surface", "surface", "The interior of a surface", 2),
+               ("label", "label", "A label in a voxelvolume", 3)])
+    criterion = EnumProperty(
+        name="Criterion",
+        description="The points of a streamline tested against the region",
+        default="through",
+        items=[("through", "through", "Any point is in the region", 0),
+               ("start", "start", "The first point is in the region", 1),
+               ("end", "end", "The last point is in the region", 2),
+               ("endpoints", "endpoints",
+                "The first or the last point is in the region", 3)])
+    action = EnumProperty(
+        name="Action",
+        description="Keep or drop the streamlines that meet the criterion",
+        default="keep",
+        items=[("keep", "keep", "Keep the streamlines in the region", 0),
+               ("drop", "drop", "Drop the streamlines in the region", 1)])
+    output = EnumProperty(
+        name="Output",
+        description="Output the selection as a tract or a labelgroup",
+        default="tract",
+        items=[("tract", "tract", "Create a new tract object", 0),
+               ("labelgroup", "labelgroup",
+                "Label the selection in a new labelgroup", 1)])
+
+    centre = FloatVectorProperty(
+        name="Centre",
+        description="The centre of the sphere or box (world space)",
+        default=[0., 0., 0.],
+        subtype="TRANSLATION")
+    radius = FloatProperty(
+        name="Radius",
+        description="The radius of the sphere",
+        default=10.,
+        min=0.,
+        subtype="DISTANCE")
+    size = FloatVectorProperty(
+        name="Size",
+        description="The size of the box",
+        default=[20., 20., 20.],
+        min=0.,
+        subtype="XYZ")
+    surface = EnumProperty(
+        name="Surface",
+        description="The (closed) surface to test against",
+        items=roi_surfaces_enum_callback)
+    labels = EnumProperty(
+        name="Labels",
+        description="The labelgroup or label to test against",
+        items=roi_labels_enum_callback)
+
+    def draw(self, context):
+
+        row = self.layout.row()
+        row.prop(self, "name")
+
+        row = self.layout.row()
+        row.prop(self, "region", expand=True)
+        if self.region in ("sphere", "box"):
+            row = self.layout.row()
+            row.prop(self, "centre")
+            row = self.layout.row()
+            if self.region == "sphere":
+                row.prop(self, "radius")
+            else:
+                row.prop(self, "size")
+        elif self.region == "surface":
+            row = self.layout.row()
+            row.prop(self, "surface")
+        elif self.region == "label":
+            row = self.layout.row()
+            row.prop(self, "labels")
+
+        row = self.layout.row()
+        row.prop(self, "criterion", expand=True)
+        row = self.layout.row()
+        row.prop(self, "action", expand=True)
+        row = self.layout.row()
+        row.prop(self, "output", expand=True)
+
+    def execute(self, context):
+
+        scn = context.scene
+
+        split_path = self.data_path.split('.')
+        nb_ob = scn.path_resolve('.'.join(split_path[:2]))
+        ob = bpy.data.objects[nb_ob.name]
+
+        try:
+            region = self.get_region(context)
+        except (KeyError, ValueError, ImportError, IOError) as error:
+            infostring = 'region of interest not available: {}'
+            self.report({'WARNING'}, infostring.format(error))
+            return {"CANCELLED"}
+
+        index = nb_ut.get_spatial_index(ob)
+        selected = nb_sp.select_streamlines(index, region,
+                                            ob.matrix_world, self.criterion)
+        if self.action == "drop":
+            selected = ~selected
+
+        if self.output == "tract":
+            name = self.roi_tract(context, ob, nb_ob, selected)
+        else:
+            name = self.roi_labelgroup(ob, nb_ob, selected)
+
+        infostring = 'selected {:d} of {:d} streamlines of "{}" in "{}"'
+        info = infostring.format(int(selected.sum()), len(selected),
+                                 nb_ob.name, name)
+        self.report({'INFO'}, info)
+
+        return {"FINISHED"}
+
+    def invoke(self, context, event):
+
+        self.centre = context.scene.cursor_location
+
+        return context.window_manager.invoke_props_dialog(self)
+
+    def get_region(self, context):
+        """Return the region of interest (in world space)."""
+
+        scn = context.scene
+
+        if self.region == "sphere":
+            region = nb_sp.SphereRegion(self.centre, self.radius)
+        elif self.region == "box":
+            half = np.array(self.size) / 2
+            region = nb_sp.BoxRegion(np.array(self.centre) - half,
+                                     np.array(self.centre) + half)
+        elif self.region == "surface":
+            surf = bpy.data.objects[self.surface]
+            region = MeshRegion(surf, scn)
+        elif self.region == "label":
+            region = self.label_region(context)
+
+        return region
+
+    def label_region(self, context):
+        """Return a region of a voxelvolume labelgroup or label."""
+
+        import nibabel as nib
+
+        scn = context.scene
+
+        item = scn.path_resolve(self.labels)
+        split_path = self.labels.split('.')
+        vvol = scn.path_resolve('.'.join(split_path[:2]))
+        lg = scn.path_resolve('.'.join(split_path[:3]))
+
+        labels = None if item == lg else [item.value]
+
+        img = nib.load(bpy.path.abspath(lg.filepath))
+        data = np.asanyarray(img.dataobj)
+        data = data.reshape(data.shape[:3] + (-1,))[..., 0]
+        affine = np.array(bpy.data.objects[vvol.name].matrix_world)
+
+        return nb_sp.LabelRegion(data, affine, labels)
+
+    def roi_tract(self, context, ob, nb_ob, selected):
+        """Create a tract object of the selected streamlines.
+
+        The streamlines are read with their radii, weights and
+        material indices, such that the new tract looks as the selection.
+        """
+
+        it_class = nb_it.NB_OT_import_tracts
+
+        ca = [bpy.data.objects, bpy.data.curves, bpy.data.materials]
+        name = self.name or '{}.roi'.format(ob.name)
+        name = nb_ut.check_name(name, "", ca)
+
+        rob = it_class.create_tract_object(context, name)
+        streamlines = nb_ut.curve_to_streamlines(ob.data, with_data=True)
+        streamlines = streamlines.subset(np.flatnonzero(selected))
+        for chunk in streamlines.chunks():
+            it_class.add_streamlines(rob, chunk)
+
+        for mat in ob.data.materials:
+            rob.data.materials.append(mat)
+        argdict = {"mode": ob.data.fill_mode,
+                   "depth": ob.data.bevel_depth,
+                   "res": ob.data.bevel_resolution}
+        it_class.beautification(rob, argdict)
+
+        it_class.tract_to_nb(context, rob,
+                             nb_ob.filepath,
+                             nb_ob.sformfile,
+                             nb_ob.tract_weeded,
+                             nb_ob.streamlines_interpolated)
+        rob.matrix_world = ob.matrix_world
+
+        return name
+
+    def roi_labelgroup(self, ob, nb_ob, selected):
+        """Label the selected streamlines in a new labelgroup."""
+
+        name = self.name or '{}.roi'.format(nb_ob.name)
+        matname = '{}.selected'.format(name)
+
+        value = len(ob.data.materials)
+        nb_ma.materialise(ob, matname=matname, idx=value, mode='append')
+
+        it_class = nb_it.NB_OT_import_tracts
+        labelgroup = it_class.labelgroup_to_nb(name, nb_ob,
+                                               [(value, matname)])
+
+        splines = ob.data.splines
+        mat_idxs = np.zeros(len(splines), dtype='int32')
+        splines.foreach_get('material_index', mat_idxs)
+        mat_idxs[selected] = value
+        splines.foreach_set('material_index', mat_idxs)
+
+        nb_ut.set_label_splines(labelgroup.labels[0],
+                                np.flatnonzero(selected))
+
+        return name
+
+
 class NB_OT_weightpaint(Operator):
     bl_idname = "nb.weightpaint"
     bl_label = "wp_mode button"
@@ -139,6 +139,8 @@ class NB_PT_base(bpy.types.Panel):
             self.drawunit_tri(layout, "carvers", nb, nb_ob)
             self.drawunit_tri(layout, "material", nb, nb_ob)
             self.drawunit_tri(layout, "transform", nb, nb_ob)
+            if nb.objecttype == "tracts" and nb_ob.lod_proxy:
+                self.drawunit_tri(layout, "lod", nb, nb_ob)
             if nb.settingprops.advanced:
                 self.drawunit_tri(layout, "info", nb, nb_ob)
 
@@ -637,6 +639,16 @@ class NB_PT_base(bpy.types.Panel):
             col = row.column()
             col.prop(ob, "matrix_world")
 
+    def drawunit_tri_lod(self, layout, nb, nb_ob):
+
+        row = layout.row()
+        row.prop(nb_ob, "use_lod")
+
+        row = layout.row()
+        row.prop(nb_ob, "lod_weed", emboss=False)
+        row.prop(nb_ob, "lod_tolerance", emboss=False)
+        row.enabled = False
+
     def drawunit_tri_info(self, layout, nb, nb_ob):
 
         row = layout.row()
@@ -1323,6 +1335,7 @@ class NB_PT_animation(bpy.types.Panel):
             row = layout.row()
             row.prop(anim, "anim_tract", text="")
             row.prop(anim, "spline_index")
+            row.operator("nb.pick_streamline", icon='CURSOR', text="")
         elif anim.pathtype == 'Select':
             row = layout.row()
             row.prop(anim, "anim_curve", text="")
@@ -1434,6 +1447,8 @@ class NB_PT_settings(bpy.types.Panel):
 
         self.drawunit_tri(layout, "texture_preferences", nb, data=None)
 
+        self.drawunit_tri(layout, "import_preferences", nb, data=None)
+
         self.drawunit_tri(layout, "manage_colourmaps", nb, data=None)
 
     def drawunit_settings_preset(self, layout):
@@ -1482,6 +1497,17 @@ class NB_PT_settings(bpy.types.Panel):
 #         row.prop(nb.settingprops, "texmethod")
         row.prop(nb.settingprops, "uv_resolution", text="UV resolution")
 
+    def drawunit_tri_import_preferences(self, layout, nb, data):
+
+        row = layout.row()
+        row.prop(nb.settingprops, "nworkers")
+        row = layout.row()
+        row.prop(nb.settingprops, "use_cache")
+        row = layout.row()
+        row.prop(nb.settingprops, "cache_size")
+        row.prop(nb.settingprops, "cache_hash")
+        row.enabled = nb.settingprops.use_cache
+
     def drawunit_tri_manage_colourmaps(self, layout, nb, data):
 
         self.drawunit_manage_colourmaps(layout, nb)
@@ -30,6 +30,7 @@ import os
 import re
 from glob import glob
 
+import numpy as np
 import mathutils
 
 import bpy
@@ -99,6 +100,17 @@ def index_scalars_handler(dummy):
             index_scalars_update_func(group=sg)
 
 
+@persistent
+def spatial_index_handler(dummy):
+    """Discard the spatial indices and features of edited tract objects."""
+
+    names = set(nb_ut.SPATIAL_INDICES) | set(nb_ut.STREAMLINE_FEATURES)
+    for name in names:
+        ob = bpy.data.objects.get(name)
+        if ob is None or ob.is_updated_data:
+            nb_ut.invalidate_spatial_index(name)
+
+
 @persistent
 def init_settings_handler(dummy):
     """Force update on NeuroBlender settings."""
@@ -707,8 +719,11 @@ def index_scalars_update_func(group=None):
             pg_sc4 = pg.bl_rna_get_subclass_py("ScalarGroupProperties")
 
         if isinstance(nb_ob, pg_sc1):
-            disable_tract_overlay(ob, ob.data.splines)
-            render_tracts_scalargroup(group, ob)
+            if tracts_scalargroup_is_rendered(group, ob):
+                set_tracts_scalargroup_layer(group)
+            else:
+                disable_tract_overlay(ob, ob.data.splines)
+                render_tracts_scalargroup(group, ob)
 
         elif isinstance(nb_ob, pg_sc2):
 
@@ -919,6 +934,22 @@ def sformfile_update(self, context):
         ob.matrix_world = affine
 
 
+def lod_update(self, context):
+    """Show the full tract or its level-of-detail proxy in the viewport.
+
+    The proxy is never rendered: final frames use the full tract.
+    """
+
+    ob = bpy.data.objects.get(self.name)
+    proxy = bpy.data.objects.get(self.lod_proxy)
+    if ob is None or proxy is None:
+        return
+
+    ob.hide = self.use_lod
+    proxy.hide = not self.use_lod
+    proxy.hide_render = True
+
+
 def carvers_update(self, context):
     """Set scaling, positions and rotations for the carveobject."""
 
@@ -1287,24 +1318,60 @@ def disable_tract_overlay(ob, coll=[]):
     for _ in range(1, len(ob.data.materials)):
         ob.data.materials.pop(1)
 
-    for item in coll:
-        item.material_index = 0
+    if len(coll):
+        coll.foreach_set('material_index', np.zeros(len(coll), dtype='int32'))
 
 
 def render_tracts_scalargroup(scalargroup, ob):
     """Enable tract scalargroup materials."""
 
-    scalar = scalargroup.scalars[scalargroup.index_scalars]
-    splformat = '{}.'.format(scalar.name) + scalargroup.spline_postfix
-    for i, spl in enumerate(ob.data.splines):
+    splformat = '{}.{}'.format(scalargroup.name, scalargroup.spline_postfix)
+    for i in range(len(ob.data.splines)):
         mat = bpy.data.materials[splformat.format(i)]
         ob.data.materials.append(mat)
-        spl.material_index = i + 1
+
+    mat_idxs = np.arange(1, len(ob.data.splines) + 1, dtype='int32')
+    ob.data.splines.foreach_set('material_index', mat_idxs)
+
+    set_tracts_scalargroup_layer(scalargroup)
+
+
+def tracts_scalargroup_is_rendered(scalargroup, ob):
+    """Check if the materials of a tract scalargroup are assigned.
+
+    The streamline materials do not depend on the timepoint,
+    such that switching timepoints only needs to select the atlas layer.
+    """
+
+    mats = ob.data.materials
+    if len(mats) != len(ob.data.splines) + 1:
+        return False
+
+    splformat = '{}.{}'.format(scalargroup.name, scalargroup.spline_postfix)
+
+    return mats[1] is not None and mats[1].name == splformat.format(0)
+
+
+def set_tracts_scalargroup_layer(scalargroup):
+    """Select the timepoint of a tract scalargroup in its atlas."""
+
+    atlasgroup = bpy.data.node_groups.get(
+        "TractOvAtlas.{}".format(scalargroup.name))
+    if atlasgroup is not None:
+        tval = atlasgroup.nodes["Layer"]
+        tval.outputs[0].default_value = scalargroup.index_scalars
 
 
 def render_tracts_labelgroup(labelgroup, ob):
-    """Enable tract scalargroup materials."""
+    """Enable tract labelgroup materials.
 
+    Every label gets the next material slot (as on import);
+    its splines are assigned to that slot.
+    """
+
+    splines = ob.data.splines
+    mat_idxs = np.zeros(len(splines), dtype='int32')
+    splines.foreach_get('material_index', mat_idxs)
     for label in labelgroup.labels:
         if label.is_rendered:
             mat = bpy.data.materials[label.name]
@@ -1313,9 +1380,9 @@ def render_tracts_labelgroup(labelgroup, ob):
             # FIXME: will turn it grey:
             # either replace with default tract material or with trans=0?
         ob.data.materials.append(mat)
-        for splidx in label.spline_indices:
-            spl = ob.data.splines[splidx.spline_index]
-            spl.material_index = label.value
+        slot = len(ob.data.materials) - 1
+        mat_idxs[nb_ut.get_label_splines(label)] = slot
+    splines.foreach_set('material_index', mat_idxs)
 
 
 def render_surfaces_scalargroup(scalargroup, ob):
@@ -1653,6 +1720,25 @@ class SettingsProperties(pg):
         items=[("none", "none", "none", 0),
                ("simple", "simple", "simple", 1)])
 
+    nworkers = IntProperty(
+        name="Workers",
+        description="Number of processes to parse tract files (0: all cores)",
+        default=0,
+        min=0)
+    use_cache = BoolProperty(
+        name="Use cache",
+        description="Cache parsed streamlines in the project directory",
+        default=False)
+    cache_size = FloatProperty(
+        name="Cache size (GB)",
+        description="Maximal size of the streamline cache",
+        default=10.,
+        min=0.)
+    cache_hash = BoolProperty(
+        name="Hash file content",
+        description="Include a hash of the file content in the cache key",
+        default=False)
+
 
 class CameraProperties(pg):
     """Properties of cameras."""
@@ -2304,15 +2390,6 @@ class ColorRampProperties(pg):
         self.nn_position = position * drange + dmin
 
 
-class SplineGroupProperties(pg):
-    """Custom properties of splinegroups."""
-
-    spline_index = IntProperty(
-        name="Spline index",
-        description="Index of spline in the labelgroup",
-        default=0)
-
-
 class ScalarProperties(pg):
     """Properties of scalar overlays."""
 
@@ -2461,11 +2538,6 @@ class LabelProperties(pg):
         max=1,
         update=material_update)
 
-    spline_indices = CollectionProperty(
-        type=SplineGroupProperties,
-        name="spline indices",
-        description="The collection of splines belonging to this label")
-
 
 class BorderProperties(pg):
     """Properties of border overlays."""
@@ -2899,6 +2971,26 @@ class TractProperties(pg):
         min=0.,
         max=1.)
 
+    use_lod = BoolProperty(
+        name="Viewport proxy",
+        description="Show the level-of-detail proxy in the viewport",
+        default=False,
+        update=lod_update)
+    lod_proxy = StringProperty(
+        name="Proxy",
+        description="The name of the level-of-detail proxy object")
+    lod_weed = FloatProperty(
+        name="Proxy weeding",
+        description="Fraction of the streamlines retained in the proxy",
+        default=0.1,
+        min=0.,
+        max=1.)
+    lod_tolerance = FloatProperty(
+        name="Proxy tolerance",
+        description="Simplification tolerance of the proxy streamlines",
+        default=1.,
+        min=0.)
+
     carvers = CollectionProperty(
         type=CarverProperties,
         name="carvers",
@@ -3236,6 +3328,10 @@ class NeuroBlenderProperties(pg):
         name="Info",
         default=False,
         description="Show/hide the object's info")
+    show_lod = BoolProperty(
+        name="Level of detail",
+        default=False,
+        description="Show/hide the object's level-of-detail options")
     show_overlay_material = BoolProperty(
         name="Overlay material",
         default=False,
@@ -3329,6 +3425,10 @@ class NeuroBlenderProperties(pg):
         name="Scene preferences",
         default=False,
         description="Show/hide the scene preferences")
+    show_import_preferences = BoolProperty(
+        name="Import preferences",
+        default=False,
+        description="Show/hide the import preferences")
 
     tracts = CollectionProperty(
         type=TractProperties,
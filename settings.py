@@ -117,6 +117,10 @@ class NB_OT_setting_presets(AddPresetBase, Operator):
                      "nb.settingprops.texmethod",
                      "nb.settingprops.uv_resolution",
                      "nb.settingprops.advanced",
-                     "nb.settingprops.verbose"]
+                     "nb.settingprops.verbose",
+                     "nb.settingprops.nworkers",
+                     "nb.settingprops.use_cache",
+                     "nb.settingprops.cache_size",
+                     "nb.settingprops.cache_hash"]
 
     preset_subdir = "neuroblender_settings"
@@ -0,0 +1,349 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# <pep8 compliant>
+
+
+"""The NeuroBlender spatial module.
+
+NeuroBlender is a Blender add-on to create artwork from neuroscientific data.
+This module implements spatial indices for fast radius, box and
+nearest-neighbour queries on points and streamlines (independent of Blender).
+"""
+
+
+import numpy as np
+
+from . import streamlines as nb_sl
+
+
+class GridIndex(object):
+    """A uniform grid over a set of points.
+
+    The points are sorted by the (linear) index of their grid cell,
+    such that the points of a block of cells are found by binary search.
+    The default cellsize puts about 'density' points in a cell.
+    """
+
+    def __init__(self, points, cellsize=None, density=8):
+
+        self.points = np.asarray(points, dtype='float32').reshape(-1, 3)
+
+        if len(self.points):
+            self.origin = self.points.min(axis=0).astype('float64')
+            self.upper = self.points.max(axis=0).astype('float64')
+        else:
+            self.origin = self.upper = np.zeros(3)
+        extent = self.upper - self.origin
+
+        if cellsize is None:
+            extent = np.maximum(extent, np.amax(extent) * 1e-3 or 1.)
+            volume = np.prod(extent) * density / max(len(self.points), 1)
+            cellsize = volume ** (1. / 3)
+        self.cellsize = max(float(cellsize), 1e-6)
+
+        self.shape = np.floor(extent / self.cellsize).astype('int64') + 1
+
+        cellids = self.cell_ids(self.cell_coords(self.points))
+        self.order = np.argsort(cellids, kind='mergesort')
+        self.cellids = cellids[self.order]
+
+    def __len__(self):
+
+        return len(self.points)
+
+    def cell_coords(self, points):
+        """Return the (clipped) grid coordinates of points."""
+
+        coords = np.floor((points - self.origin) / self.cellsize)
+
+        return np.clip(coords, 0, self.shape - 1).astype('int64')
+
+    def cell_ids(self, coords):
+        """Return the linear cell indices of grid coordinates."""
+
+        coords = np.asarray(coords, dtype='int64').reshape(-1, 3)
+
+        return (coords[:, 0] * self.shape[1] + coords[:, 1]) * \
+            self.shape[2] + coords[:, 2]
+
+    def candidates(self, lo, hi):
+        """Return the indices of the points in the cells overlapping a box."""
+
+        lo = np.asarray(lo, dtype='float64')
+        hi = np.asarray(hi, dtype='float64')
+        if not len(self) or np.any(hi < lo):
+            return np.zeros(0, dtype='int64')
+
+        clo = self.cell_coords(lo[None])[0]
+        chi = self.cell_coords(hi[None])[0]
+        if np.prod(chi - clo + 1) > len(self):
+            return np.arange(len(self))
+
+        grid = np.mgrid[clo[0]:chi[0] + 1,
+                        clo[1]:chi[1] + 1,
+                        clo[2]:chi[2] + 1].reshape(3, -1).T
+        cellids = self.cell_ids(grid)
+        starts = np.searchsorted(self.cellids, cellids, side='left')
+        stops = np.searchsorted(self.cellids, cellids, side='right')
+        rows = nb_sl.ranges_to_indices(starts, stops - starts)
+
+        return self.order[rows]
+
+    def query_box(self, lo, hi):
+        """Return the sorted indices of the points within a box."""
+
+        idxs = self.candidates(lo, hi)
+        points = self.points[idxs]
+        inside = np.all((points >= lo) & (points <= hi), axis=1)
+
+        return np.sort(idxs[inside])
+
+    def query_radius(self, centre, radius):
+        """Return the sorted indices of the points within a sphere."""
+
+        centre = np.asarray(centre, dtype='float64')
+        idxs = self.candidates(centre - radius, centre + radius)
+        sqdist = np.sum((self.points[idxs] - centre) ** 2, axis=1)
+
+        return np.sort(idxs[sqdist <= radius ** 2])
+
+    def query_nearest(self, point):
+        """Return the index of and the distance to the nearest point.
+
+        The search radius is doubled until a point is found:
+        the nearest point within a radius is the nearest point overall.
+        """
+
+        if not len(self):
+            return -1, np.inf
+
+        point = np.asarray(point, dtype='float64')
+        outside = np.maximum(np.maximum(self.origin - point,
+                                        point - self.upper), 0)
+        radius = np.linalg.norm(outside) + self.cellsize
+        while True:
+            idxs = self.candidates(point - radius, point + radius)
+            sqdist = np.sum((self.points[idxs] - point) ** 2, axis=1)
+            within = sqdist <= radius ** 2
+            if np.any(within):
+                i = np.argmin(np.where(within, sqdist, np.inf))
+                return int(idxs[i]), float(np.sqrt(sqdist[i]))
+            radius *= 2
+
+
+class SpatialIndex(object):
+    """A spatial index over the points and endpoints of streamlines.
+
+    Queries return (sorted) streamline indices. The endpoint index
+    is built on first use.
+    """
+
+    def __init__(self, streamlines, cellsize=None):
+
+        self.streamlines = streamlines.pack()
+        self.ids = self.streamlines.streamline_ids()
+        self.grid = GridIndex(self.streamlines.points, cellsize)
+        self._endpoints = None
+
+    def __len__(self):
+
+        return len(self.streamlines)
+
+    @property
+    def endpoints(self):
+        """A grid over the first and last points of the streamlines."""
+
+        if self._endpoints is None:
+            sl = self.streamlines
+            rows = np.append(sl.first_points(), sl.last_points())
+            self._endpoints = GridIndex(sl.points[rows], self.grid.cellsize)
+
+        return self._endpoints
+
+    def nearest_streamline(self, point):
+        """Return the streamline and point nearest to a point.
+
+        Returns (streamline index, point row, distance).
+        """
+
+        row, distance = self.grid.query_nearest(point)
+        if row < 0:
+            return -1, -1, distance
+
+        return int(self.ids[row]), row, distance
+
+    def nearest_endpoint(self, point):
+        """Return the streamline with the endpoint nearest to a point.
+
+        Returns (streamline index, is last point, distance).
+        """
+
+        idx, distance = self.endpoints.query_nearest(point)
+        if idx < 0:
+            return -1, False, distance
+
+        return idx % len(self), idx >= len(self), distance
+
+    def streamlines_in_radius(self, centre, radius):
+        """Return the streamlines with a point within a sphere."""
+
+        return np.unique(self.ids[self.grid.query_radius(centre, radius)])
+
+    def streamlines_in_box(self, lo, hi):
+        """Return the streamlines with a point within a box."""
+
+        return np.unique(self.ids[self.grid.query_box(lo, hi)])
+
+    def endpoints_in_radius(self, centre, radius):
+        """Return the streamlines with an endpoint within a sphere."""
+
+        idxs = self.endpoints.query_radius(centre, radius)
+
+        return np.unique(idxs % len(self))
+
+
+class SphereRegion(object):
+    """A spherical region of interest."""
+
+    def __init__(self, centre, radius):
+
+        self.centre = np.asarray(centre, dtype='float64')
+        self.radius = float(radius)
+
+    def bounds(self):
+        """Return the corners (lo, hi) of the bounding box."""
+
+        return self.centre - self.radius, self.centre + self.radius
+
+    def contains(self, points):
+        """Return a mask of the points inside the region."""
+
+        sqdist = np.sum((points - self.centre) ** 2, axis=1)
+
+        return sqdist <= self.radius ** 2
+
+
+class BoxRegion(object):
+    """An axis-aligned box region of interest."""
+
+    def __init__(self, lo, hi):
+
+        self.lo = np.asarray(lo, dtype='float64')
+        self.hi = np.asarray(hi, dtype='float64')
+
+    def bounds(self):
+        """Return the corners (lo, hi) of the bounding box."""
+
+        return self.lo, self.hi
+
+    def contains(self, points):
+        """Return a mask of the points inside the region."""
+
+        return np.all((points >= self.lo) & (points <= self.hi), axis=1)
+
+
+class LabelRegion(object):
+    """A region of interest of the voxels with (one of) the labels.
+
+    'affine' maps voxel indices to coordinates; points are assigned to
+    their nearest voxel. Without labels, all voxels > 0 are included.
+    """
+
+    def __init__(self, labelvolume, affine, labels=None):
+
+        labelvolume = np.asarray(labelvolume).astype('int64')
+        if labels is None:
+            self.mask = labelvolume > 0
+        else:
+            lut = np.zeros(max(labelvolume.max(), max(labels)) + 1,
+                           dtype='bool')
+            lut[np.asarray(labels, dtype='int64')] = True
+            self.mask = lut[np.maximum(labelvolume, 0)]
+
+        self.affine = np.asarray(affine, dtype='float64')
+        self.inverse = np.linalg.inv(self.affine)
+
+    def bounds(self):
+        """Return the corners (lo, hi) of the bounding box."""
+
+        ijk = np.array(np.nonzero(self.mask))
+        if not ijk.size:
+            return np.zeros(3), -np.ones(3)
+
+        return transform_bounds(ijk.min(axis=1) - 0.5, ijk.max(axis=1) + 0.5,
+                                self.affine)
+
+    def contains(self, points):
+        """Return a mask of the points inside the region."""
+
+        ijk = np.dot(points, self.inverse[:3, :3].T) + self.inverse[:3, 3]
+        ijk = np.rint(ijk).astype('int64')
+        valid = np.all((ijk >= 0) & (ijk < self.mask.shape), axis=1)
+
+        inside = np.zeros(len(points), dtype='bool')
+        inside[valid] = self.mask[tuple(ijk[valid].T)]
+
+        return inside
+
+
+def transform_bounds(lo, hi, affine):
+    """Return the bounding box of a box after an affine transformation."""
+
+    corners = np.array([[x, y, z] for x in (lo[0], hi[0])
+                        for y in (lo[1], hi[1])
+                        for z in (lo[2], hi[2])], dtype='float64')
+    corners = np.dot(corners, affine[:3, :3].T) + affine[:3, 3]
+
+    return corners.min(axis=0), corners.max(axis=0)
+
+
+def select_streamlines(index, region, affine=np.eye(4), criterion='through'):
+    """Return a mask of the streamlines that meet a region of interest.
+
+    The index is in object space; 'affine' maps it to the space of the
+    region. With criterion
+    - 'through': any point of the streamline is inside the region
+    - 'start'/'end': the first/last point is inside the region
+    - 'endpoints': the first or the last point is inside the region
+    Only the points within the bounding box of the region are tested.
+    """
+
+    affine = np.asarray(affine, dtype='float64')
+    lo, hi = region.bounds()
+    lo, hi = transform_bounds(lo, hi, np.linalg.inv(affine))
+
+    grid = index.grid if criterion == 'through' else index.endpoints
+    rows = grid.query_box(lo, hi)
+    points = np.dot(grid.points[rows], affine[:3, :3].T) + affine[:3, 3]
+
+    inside = np.zeros(len(grid), dtype='bool')
+    inside[rows] = region.contains(points)
+
+    if criterion == 'through':
+        selected = np.zeros(len(index), dtype='bool')
+        selected[index.ids[inside]] = True
+        return selected
+
+    first, last = inside[:len(index)], inside[len(index):]
+    if criterion == 'start':
+        return first
+    elif criterion == 'end':
+        return last
+
+    return first | last
@@ -0,0 +1,653 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# <pep8 compliant>
+
+
+"""The NeuroBlender streamlines module.
+
+NeuroBlender is a Blender add-on to create artwork from neuroscientific data.
+This module implements the packed streamline container and
+vectorized operations on sets of streamlines (independent of Blender).
+"""
+
+
+import numpy as np
+
+
+# data columns that describe the streamline geometry rather than scalars
+GEOMETRY_COLUMNS = ('radius', 'structure', 'index', 'branchpoint')
+# data columns that are sampled at the nearest point (not interpolated)
+DISCRETE_COLUMNS = ('structure', 'index', 'branchpoint')
+
+# offset of the cell coordinates in endpoint keys (20 bits per axis)
+CELL_BIAS = 2 ** 19
+
+
+class Streamlines(object):
+    """A packed set of streamlines.
+
+    The points of all streamlines are held in one [Npointsx3] buffer;
+    streamline i spans the rows points[offsets[i]:offsets[i] + lengths[i]].
+    Per-point attribute columns (e.g. 'radius', 'structure', 'branchpoint')
+    are held in 'data', aligned with the rows of the point buffer.
+    The point buffer may be a view on a memory-mapped file,
+    in which case rows between streamlines (e.g. delimiters) are skipped.
+    With 'stride' > 1, consecutive points of a streamline are 'stride' rows
+    apart (e.g. an overlapping-row view on a flat file of coordinates).
+    """
+
+    def __init__(self, points=None, offsets=None, lengths=None, data=None,
+                 stride=1):
+
+        if points is None:
+            points = np.zeros((0, 3), dtype='float32')
+        if offsets is None:
+            offsets = [0] if len(points) else []
+        offsets = np.asarray(offsets, dtype='int64')
+        if lengths is None:
+            lengths = np.diff(np.append(offsets, len(points)))
+
+        self.points = points
+        self.offsets = offsets
+        self.lengths = np.asarray(lengths, dtype='int64')
+        self.data = data or {}
+        self.stride = stride
+
+    def __len__(self):
+
+        return len(self.offsets)
+
+    def __iter__(self):
+
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getitem__(self, idx):
+        """Return the points of a streamline or a selection of streamlines."""
+
+        if isinstance(idx, (int, np.integer)):
+            start = self.offsets[idx]
+            stop = start + self.lengths[idx] * self.stride
+            return self.points[start:stop:self.stride]
+
+        return self.select(np.arange(len(self))[idx])
+
+    @property
+    def npoints(self):
+        """The total number of points in the streamlines."""
+
+        return int(self.lengths.sum())
+
+    @property
+    def is_packed(self):
+        """Whether the points are contiguous and in streamline order."""
+
+        if not len(self):
+            return True
+
+        starts = np.append(0, np.cumsum(self.lengths)[:-1])
+
+        return (self.stride == 1 and
+                len(self.points) == self.npoints and
+                np.array_equal(starts, self.offsets))
+
+    @classmethod
+    def from_list(cls, streamlines, columns=()):
+        """Pack a list of [NpointsxK] arrays.
+
+        The first three columns are the coordinates,
+        the remaining columns are stored under the names in 'columns'.
+        """
+
+        streamlines = [np.asarray(sl, dtype='float32') for sl in streamlines]
+        streamlines = [np.atleast_2d(sl) for sl in streamlines if len(sl)]
+        if not streamlines:
+            return cls()
+
+        lengths = np.array([len(sl) for sl in streamlines], dtype='int64')
+        offsets = np.append(0, np.cumsum(lengths)[:-1])
+        rows = np.concatenate(streamlines)
+
+        points = np.ascontiguousarray(rows[:, :3])
+        data = {name: np.ascontiguousarray(rows[:, i + 3])
+                for i, name in enumerate(columns) if i + 3 < rows.shape[1]}
+
+        return cls(points, offsets, lengths, data)
+
+    @classmethod
+    def concatenate(cls, seq):
+        """Concatenate a sequence of Streamlines into one packed set."""
+
+        seq = [sl.pack() for sl in seq if len(sl)]
+        if not seq:
+            return cls()
+
+        points = np.concatenate([sl.points for sl in seq])
+        lengths = np.concatenate([sl.lengths for sl in seq])
+        offsets = np.append(0, np.cumsum(lengths)[:-1])
+        names = set.intersection(*[set(sl.data.keys()) for sl in seq])
+        data = {name: np.concatenate([sl.data[name] for sl in seq])
+                for name in names}
+
+        return cls(points, offsets, lengths, data)
+
+    def row_indices(self, idxs=None):
+        """Return the point buffer rows of (a selection of) the streamlines."""
+
+        if idxs is None:
+            offsets, lengths = self.offsets, self.lengths
+        else:
+            offsets, lengths = self.offsets[idxs], self.lengths[idxs]
+
+        return ranges_to_indices(offsets, lengths, self.stride)
+
+    def subset(self, idxs):
+        """Return a view on the selected streamlines.
+
+        Unlike 'select', no points are read or copied:
+        the subset shares the point buffer of the full set.
+        """
+
+        idxs = np.asarray(idxs, dtype='int64')
+
+        return Streamlines(self.points, self.offsets[idxs], self.lengths[idxs],
+                           self.data, self.stride)
+
+    def select(self, idxs):
+        """Return a packed copy of the selected streamlines."""
+
+        idxs = np.asarray(idxs, dtype='int64')
+        rows = self.row_indices(idxs)
+        lengths = self.lengths[idxs]
+        offsets = np.append(0, np.cumsum(lengths)[:-1])[:len(lengths)]
+
+        points = np.asarray(self.points[rows], dtype='float32')
+        data = {k: np.asarray(v[rows]) for k, v in self.data.items()}
+
+        return Streamlines(points, offsets, lengths, data)
+
+    def pack(self):
+        """Return a packed version of the streamlines."""
+
+        if self.is_packed and self.points.dtype == np.dtype('float32'):
+            return self
+
+        return self.select(np.arange(len(self)))
+
+    def select_points(self, mask):
+        """Return a packed copy retaining the points where mask is True.
+
+        The mask is aligned with the points of the packed streamlines;
+        streamlines without any retained points are dropped.
+        """
+
+        sl = self.pack()
+        mask = np.asarray(mask, dtype='bool')
+        lengths = np.bincount(sl.streamline_ids()[mask], minlength=len(sl))
+        lengths = lengths[lengths > 0]
+        offsets = np.append(0, np.cumsum(lengths)[:-1])[:len(lengths)]
+        data = {k: v[mask] for k, v in sl.data.items()}
+
+        return Streamlines(sl.points[mask], offsets, lengths, data)
+
+    def reverse(self, mask=None):
+        """Return a packed copy with the point order of streamlines reversed.
+
+        Only the streamlines where mask is True are reversed (default: all).
+        """
+
+        sl = self.pack()
+        ids = sl.streamline_ids()
+        rows = np.arange(len(ids))
+        flipped = sl.offsets[ids] + sl.lengths[ids] - 1 - sl.point_indices()
+        if mask is not None:
+            mask = np.asarray(mask, dtype='bool')
+            flipped = np.where(mask[ids], flipped, rows)
+
+        data = {k: v[flipped] for k, v in sl.data.items()}
+
+        return Streamlines(sl.points[flipped], sl.offsets, sl.lengths, data)
+
+    def point_indices(self):
+        """Return the index of every point within its (packed) streamline."""
+
+        ids = self.streamline_ids()
+        starts = np.append(0, np.cumsum(self.lengths)[:-1])[:len(self)]
+
+        return np.arange(len(ids)) - starts[ids]
+
+    def chunks(self, chunksize=1000000):
+        """Yield packed chunks of at most 'chunksize' points.
+
+        A single streamline longer than chunksize gets a chunk of its own.
+        """
+
+        bounds = chunk_bounds(self.lengths, chunksize)
+        for i, j in zip(bounds[:-1], bounds[1:]):
+            yield self.select(np.arange(i, j))
+
+    def streamline_ids(self):
+        """Return the streamline index of every point of a packed set."""
+
+        return np.repeat(np.arange(len(self)), self.lengths)
+
+    def first_points(self):
+        """Return the row index of the first point of every streamline."""
+
+        return self.offsets
+
+    def last_points(self):
+        """Return the row index of the last point of every streamline."""
+
+        return self.offsets + (self.lengths - 1) * self.stride
+
+    def per_streamline(self, name, default=0, point='last'):
+        """Return a per-point column sampled at one point per streamline."""
+
+        if name not in self.data:
+            return np.full(len(self), default)
+
+        rows = self.last_points() if point == 'last' else self.first_points()
+
+        return self.data[name][rows]
+
+    def scalar_names(self):
+        """Return the names of the per-point scalar data columns."""
+
+        return sorted(name for name, values in self.data.items()
+                      if np.ndim(values) == 1 and
+                      name not in GEOMETRY_COLUMNS)
+
+    def transform(self, affine):
+        """Apply a 4x4 affine transformation to the points (in place)."""
+
+        affine = np.asarray(affine, dtype='float64')
+        points = np.dot(self.points, affine[:3, :3].T) + affine[:3, 3]
+        self.points = points.astype('float32')
+
+        return self
+
+
+class LazyStreamlines(object):
+    """A set of streamlines that is read chunk by chunk.
+
+    'chunk_fun(chunksize)' returns a new iterator over packed Streamlines
+    chunks of about chunksize points, such that the set can be iterated
+    more than once without holding all streamlines in memory.
+    If the number of streamlines is not known in advance,
+    it is counted on the first call to len().
+    """
+
+    def __init__(self, chunk_fun, nstreamlines=None):
+
+        self.chunk_fun = chunk_fun
+        self.nstreamlines = nstreamlines
+
+    def __len__(self):
+
+        if self.nstreamlines is None:
+            self.nstreamlines = sum(len(chunk) for chunk in self.chunks())
+
+        return self.nstreamlines
+
+    def chunks(self, chunksize=1000000):
+        """Yield packed chunks of about 'chunksize' points."""
+
+        return self.chunk_fun(chunksize)
+
+    def subset(self, idxs):
+        """Return the streamlines with (sorted) indices idxs, read lazily."""
+
+        idxs = np.asarray(idxs, dtype='int64')
+
+        def chunk_fun(chunksize):
+            start = 0
+            for chunk in self.chunks(chunksize):
+                stop = start + len(chunk)
+                i, j = np.searchsorted(idxs, [start, stop])
+                if j > i:
+                    yield chunk.select(idxs[i:j] - start)
+                start = stop
+
+        return LazyStreamlines(chunk_fun, len(idxs))
+
+
+def weed(streamlines, fraction, mode='random', seed=0,
+         nstrata=10, cellsize=10., label='structure'):
+    """Return the sorted indices of a random selection of streamlines.
+
+    'fraction' of the streamlines is retained; with mode
+    - 'random': a simple random sample
+    - 'length': stratified by length (number of points) quantile
+    - 'endpoints': stratified by the grid cells (of size 'cellsize')
+      of the endpoint pair
+    - 'label': stratified by the per-streamline value of data 'label'
+    Stratified sampling retains at least one streamline per stratum.
+    The selection is reproducible for a given 'seed'.
+    """
+
+    nstreamlines = len(streamlines)
+    rng = np.random.RandomState(seed)
+
+    if fraction >= 1.:
+        return np.arange(nstreamlines)
+
+    if mode == 'random':
+        nsamples = int(nstreamlines * fraction)
+        idxs = rng.choice(nstreamlines, nsamples, replace=False)
+        return np.sort(idxs)
+
+    strata = stratify(streamlines, mode, nstrata, cellsize, label)
+
+    return stratified_sample(strata, fraction, rng)
+
+
+def stratify(streamlines, mode='length', nstrata=10, cellsize=10.,
+             label='structure'):
+    """Return the stratum index of every streamline (see 'weed')."""
+
+    if isinstance(streamlines, LazyStreamlines):
+        keys = np.concatenate([stratum_keys(chunk, mode, cellsize, label)
+                               for chunk in streamlines.chunks()])
+    else:
+        keys = stratum_keys(streamlines, mode, cellsize, label)
+
+    if mode == 'length':
+        quantiles = np.linspace(0, 100, nstrata + 1)[1:-1]
+        bins = np.unique(np.percentile(keys, quantiles))
+        return np.digitize(keys, bins)
+
+    return unique_rows_inverse(keys.reshape(len(keys), -1))
+
+
+def unique_rows_inverse(keys):
+    """Return the index of the unique row of every row of [N x M] keys."""
+
+    if not len(keys):
+        return np.zeros(0, dtype='int64')
+
+    order = np.lexsort(keys.T[::-1])
+    ordered = keys[order]
+    new = np.append(True, np.any(ordered[1:] != ordered[:-1], axis=1))
+    inverse = np.empty(len(keys), dtype='int64')
+    inverse[order] = np.cumsum(new) - 1
+
+    return inverse
+
+
+def stratum_keys(streamlines, mode='length', cellsize=10.,
+                 label='structure'):
+    """Return the stratification key of every streamline.
+
+    Only the lengths or the endpoint rows of the point buffer are read.
+    In 'endpoints' mode, the key is a pair of absolute cell keys
+    [N x 2], such that keys of separately read chunks are comparable.
+    """
+
+    if mode == 'length':
+        return streamlines.lengths
+    elif mode == 'label':
+        return streamlines.per_streamline(label)
+    elif mode != 'endpoints':
+        raise ValueError("weeding mode '{}' not supported".format(mode))
+
+    rows = np.append(streamlines.first_points(), streamlines.last_points())
+    endpoints = np.asarray(streamlines.points[rows], dtype='float64')
+    cells = np.floor(endpoints / cellsize).astype('int64')
+    cells = np.clip(cells + CELL_BIAS, 0, 2 * CELL_BIAS - 1)
+    cellkeys = np.ravel_multi_index(cells.T, (2 * CELL_BIAS,) * 3)
+
+    # the key of an endpoint pair does not depend on streamline direction
+    return np.sort(cellkeys.reshape(2, -1), axis=0).T
+
+
+def stratified_sample(strata, fraction, rng):
+    """Return sorted indices retaining a fraction of every stratum."""
+
+    priority = rng.random_sample(len(strata))
+    order = np.lexsort((priority, strata))
+
+    counts = np.bincount(strata)
+    nsamples = np.maximum(np.round(counts * fraction), 1).astype('int64')
+    nsamples[counts == 0] = 0
+
+    # rank of every streamline within its stratum (in priority order)
+    starts = np.append(0, np.cumsum(counts)[:-1])
+    ranks = np.arange(len(strata)) - starts[strata[order]]
+    keep = order[ranks < nsamples[strata[order]]]
+
+    return np.sort(keep)
+
+
+def subsample_points(streamlines, step):
+    """Keep every step-th point, the last point and branchpoints.
+
+    Return a packed copy of the subsampled streamlines.
+    """
+
+    streamlines = streamlines.pack()
+    idxs = streamlines.point_indices()
+    ids = streamlines.streamline_ids()
+    mask = (idxs % step == 0) | (idxs == streamlines.lengths[ids] - 1)
+    if 'branchpoint' in streamlines.data:
+        mask |= streamlines.data['branchpoint'] > 0
+
+    return streamlines.select_points(mask)
+
+
+def resample(streamlines, mode='subsample', factor=1., step=1.,
+             npoints=20, tolerance=0.1):
+    """Resample or simplify all streamlines in a packed set at once.
+
+    With mode
+    - 'subsample': keep every int(1/factor)-th point (see subsample_points)
+    - 'step': resample at a fixed arc-length step
+    - 'count': resample to a fixed number of points
+    - 'rdp': Ramer-Douglas-Peucker simplification with 'tolerance'
+    """
+
+    if mode == 'subsample':
+        if factor >= 1.:
+            return streamlines
+        return subsample_points(streamlines, int(1/factor))
+    elif mode == 'step':
+        return resample_arclength(streamlines, step=step)
+    elif mode == 'count':
+        return resample_arclength(streamlines, npoints=npoints)
+    elif mode == 'rdp':
+        return simplify_rdp(streamlines, tolerance)
+
+    raise ValueError("resampling mode '{}' not supported".format(mode))
+
+
+def arclength(streamlines):
+    """Return the arc length at every point of a packed set.
+
+    The arc length is zero at the first point of every streamline.
+    """
+
+    ids = streamlines.streamline_ids()
+    seglengths = np.zeros(len(ids))
+    seglengths[1:] = np.linalg.norm(np.diff(streamlines.points, axis=0),
+                                    axis=1)
+    seglengths[streamlines.offsets] = 0
+
+    cumlength = np.cumsum(seglengths)
+
+    return cumlength - cumlength[streamlines.offsets][ids]
+
+
+def resample_arclength(streamlines, step=None, npoints=None):
+    """Resample the streamlines at equidistant points along their arc.
+
+    Either with about 'step' between points (the step is adapted to
+    fit a whole number of steps in every streamline) or with 'npoints'
+    per streamline. Streamline ends are retained. Data columns are
+    interpolated linearly, or sampled at the nearest point for
+    discrete columns (e.g. 'structure').
+    """
+
+    streamlines = streamlines.pack()
+    if not len(streamlines):
+        return streamlines
+
+    arc = arclength(streamlines)
+    last = streamlines.last_points()
+    totals = arc[last]
+
+    if npoints is None:
+        counts = np.ceil(totals / step).astype('int64') + 1
+    else:
+        counts = np.full(len(streamlines), npoints, dtype='int64')
+    counts = np.maximum(counts, 2)
+    counts[streamlines.lengths == 1] = 1
+
+    # place the streamlines on one monotonic axis, separated by gaps
+    bases = np.append(0, np.cumsum(totals + 1.)[:-1])
+    ids = streamlines.streamline_ids()
+    axis = arc + bases[ids]
+
+    new_ids = np.repeat(np.arange(len(streamlines)), counts)
+    new_starts = np.append(0, np.cumsum(counts)[:-1])
+    j = np.arange(len(new_ids)) - new_starts[new_ids]
+    steps = totals / np.maximum(counts - 1, 1)
+    samples = bases[new_ids] + j * steps[new_ids]
+
+    # the segment [i, i+1] of every sample (within its streamline)
+    i = np.searchsorted(axis, samples, side='right') - 1
+    i = np.clip(i, streamlines.offsets[new_ids], last[new_ids] - 1)
+    i = np.maximum(i, streamlines.offsets[new_ids])
+    i1 = np.minimum(i + 1, last[new_ids])
+    seglengths = axis[i1] - axis[i]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        w = np.where(seglengths > 0, (samples - axis[i]) / seglengths, 0.)
+    w = np.clip(w, 0., 1.)[:, None]
+
+    points = (1 - w) * streamlines.points[i] + w * streamlines.points[i1]
+
+    data = {}
+    for name, values in streamlines.data.items():
+        if name in DISCRETE_COLUMNS:
+            data[name] = values[np.where(w[:, 0] > 0.5, i1, i)]
+        else:
+            wv = w if values.ndim > 1 else w[:, 0]
+            data[name] = ((1 - wv) * values[i] + wv * values[i1]).astype(
+                values.dtype)
+
+    return Streamlines(points.astype('float32'), new_starts, counts, data)
+
+
+def simplify_rdp(streamlines, tolerance=0.1):
+    """Simplify the streamlines with the Ramer-Douglas-Peucker algorithm.
+
+    Points are retained where the polyline deviates more than 'tolerance'
+    from the simplified polyline. Rather than recursing per streamline,
+    every iteration splits all segments of all streamlines at once at
+    their farthest point. Streamline ends and branchpoints are retained.
+    """
+
+    streamlines = streamlines.pack()
+    points = np.asarray(streamlines.points, dtype='float64')
+
+    keep = np.zeros(len(points), dtype='bool')
+    keep[streamlines.first_points()] = True
+    keep[streamlines.last_points()] = True
+    if 'branchpoint' in streamlines.data:
+        keep |= streamlines.data['branchpoint'] > 0
+
+    # points in segments that have not been resolved yet
+    pending = ~keep
+    while pending.any():
+        kept = np.flatnonzero(keep)
+        candidates = np.flatnonzero(pending)
+
+        # the segment (between two kept points) of every candidate point;
+        # streamline ends are kept, so segments never span streamlines
+        seg = np.searchsorted(kept, candidates) - 1
+        a = points[kept[seg]]
+        b = points[kept[seg + 1]]
+        dist = segment_distance(points[candidates], a, b)
+
+        # split every segment at its farthest candidate beyond tolerance
+        # (candidates are sorted, so the candidates of a segment are a run)
+        newseg = np.append(True, seg[1:] != seg[:-1])
+        group = np.cumsum(newseg) - 1
+        segmax = np.maximum.reduceat(dist, np.flatnonzero(newseg))
+        maxima = np.flatnonzero(dist == segmax[group])
+        farthest = maxima[np.append(True, np.diff(group[maxima]) > 0)]
+        split = farthest[dist[farthest] > tolerance]
+        keep[candidates[split]] = True
+
+        # segments without a split are final
+        is_split = np.zeros(len(kept), dtype='bool')
+        is_split[seg[split]] = True
+        pending[candidates] = is_split[seg]
+        pending[keep] = False
+
+    return streamlines.select_points(keep)
+
+
+def segment_distance(p, a, b):
+    """Return the distances of points p to the line segments [a, b]."""
+
+    ab = b - a
+    denom = np.einsum('ij,ij->i', ab, ab)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = np.einsum('ij,ij->i', p - a, ab) / denom
+    t = np.clip(np.nan_to_num(t), 0., 1.)[:, None]
+
+    return np.linalg.norm(p - (a + t * ab), axis=1)
+
+
+def ranges_to_indices(starts, lengths, step=1):
+    """Return the concatenated indices of the ranges [start:start+length].
+
+    With step > 1, the ranges are [start:start+length*step:step].
+    """
+
+    starts = np.asarray(starts, dtype='int64')
+    lengths = np.asarray(lengths, dtype='int64')
+    nonempty = lengths > 0
+    starts, lengths = starts[nonempty], lengths[nonempty]
+    if not len(lengths):
+        return np.zeros(0, dtype='int64')
+
+    ends = np.cumsum(lengths)
+    steps = np.full(ends[-1], step, dtype='int64')
+    steps[0] = starts[0]
+    steps[ends[:-1]] = starts[1:] - (starts[:-1] + (lengths[:-1] - 1) * step)
+
+    return np.cumsum(steps)
+
+
+def chunk_bounds(lengths, chunksize):
+    """Return the streamline boundaries of chunks of at most chunksize points.
+
+    A single streamline longer than chunksize gets a chunk of its own.
+    """
+
+    cumpoints = np.cumsum(lengths)
+    bounds = [0]
+    while bounds[-1] < len(lengths):
+        i = bounds[-1]
+        done = cumpoints[i - 1] if i else 0
+        j = int(np.searchsorted(cumpoints, done + chunksize, side='right'))
+        bounds.append(max(j, i + 1))
+
+    return bounds
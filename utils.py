@@ -38,6 +38,17 @@ from mathutils import Matrix
 
 import bpy
 
+from . import (clustering as nb_cl,
+               spatial as nb_sp,
+               streamlines as nb_sl)
+
+
+# spatial indices of tract objects: {name: (signature, SpatialIndex)}
+SPATIAL_INDICES = {}
+
+# resampled streamlines of tract objects: {name: (signature, {npoints: ..})}
+STREAMLINE_FEATURES = {}
+
 
 # ========================================================================== #
 # general utilities
@@ -569,6 +580,42 @@ def slice_rotations(matrix_world, index_ijk):
     return index_xyz, p
 
 
+def rotation_difference_matrices(a, b):
+    """Return the matrices that rotate vectors a onto vectors b.
+
+    This is a batch equivalent of Vector.rotation_difference:
+    the shortest-arc rotation about a x b (Rodrigues' formula).
+    Antiparallel vectors are rotated by pi about an axis orthogonal to a.
+    """
+
+    a = np.asarray(a, dtype='float64').reshape(-1, 3)
+    b = np.asarray(b, dtype='float64').reshape(-1, 3)
+    a = a / np.linalg.norm(a, axis=1)[:, None]
+    b = b / np.linalg.norm(b, axis=1)[:, None]
+
+    v = np.cross(a, b)
+    c = np.sum(a * b, axis=1)
+    antiparallel = c < -1. + 1e-6
+
+    vx = np.zeros((len(v), 3, 3))
+    vx[:, 0, 1], vx[:, 0, 2] = -v[:, 2], v[:, 1]
+    vx[:, 1, 0], vx[:, 1, 2] = v[:, 2], -v[:, 0]
+    vx[:, 2, 0], vx[:, 2, 1] = -v[:, 1], v[:, 0]
+    k = 1. / (1. + np.where(antiparallel, 1., c))
+    rot = np.eye(3) + vx + np.matmul(vx, vx) * k[:, None, None]
+
+    if np.any(antiparallel):
+        aa = a[antiparallel]
+        axis = np.cross(aa, [1., 0., 0.])
+        degenerate = np.linalg.norm(axis, axis=1) < 1e-6
+        axis[degenerate] = np.cross(aa[degenerate], [0., 1., 0.])
+        axis /= np.linalg.norm(axis, axis=1)[:, None]
+        rot[antiparallel] = 2 * np.einsum('ni,nj->nij', axis, axis) - \
+            np.eye(3)
+
+    return rot
+
+
 def make_polyline(curvedata, clist,
                   radius=0.2, radius_variation=False,
                   use_endpoint_u=True, use_cyclic_u=False):
@@ -594,6 +641,256 @@ def make_polyline(curvedata, clist,
     polyline.use_cyclic_u = use_cyclic_u
 
 
+def make_polylines(curvedata, streamlines,
+                   radius=0.2, radius_variation=False,
+                   use_endpoint_u=True, use_cyclic_u=False):
+    """Create 3D curves for all streamlines in a packed set.
+
+    The coordinates, radii and weights are prepared once for all streamlines
+    in flat buffers; each spline is filled from a view on these buffers
+    with 'foreach_set' instead of per-point RNA access.
+    """
+
+    streamlines = streamlines.pack()
+    npoints = streamlines.npoints
+
+    co = np.ones((npoints, 4), dtype='float32')
+    co[:, :3] = streamlines.points
+
+    radii = streamlines.data.get('radius')
+    if radii is None:
+        radii = np.full(npoints, radius, dtype='float32')
+        if radius_variation:
+            radii += np.random.random(npoints).astype('float32') * radius
+    radii = np.asarray(radii, dtype='float32')
+
+    weights = streamlines.data.get('branchpoint')
+    if weights is not None:
+        weights = np.asarray(weights, dtype='float32')
+
+    splines = curvedata.splines
+    nsplines = len(splines)
+    for start, length in zip(streamlines.offsets, streamlines.lengths):
+        polyline = splines.new('POLY')
+        polyline.points.add(length - 1)
+        stop = start + length
+        polyline.points.foreach_set('co', co[start:stop].ravel())
+        polyline.points.foreach_set('radius', radii[start:stop])
+        if weights is not None:
+            polyline.points.foreach_set('weight', weights[start:stop])
+        polyline.order_u = length - 1
+        polyline.use_endpoint_u = use_endpoint_u
+        polyline.use_cyclic_u = use_cyclic_u
+
+    # set the material indices of all new splines at once
+    if 'structure' in streamlines.data:
+        mat_idxs = np.zeros(len(splines), dtype='int32')
+        splines.foreach_get('material_index', mat_idxs)
+        mat_idxs[nsplines:] = streamlines.per_streamline('structure')
+        splines.foreach_set('material_index', mat_idxs)
+
+
+def curve_to_streamlines(curvedata, with_data=False):
+    """Read the points of all splines of a curve into packed streamlines.
+
+    The coordinates of each spline are read into a view on one flat buffer
+    with 'foreach_get' instead of per-point RNA access. With 'with_data',
+    the point radii and weights and the spline material indices are read
+    into the 'radius', 'branchpoint' and 'structure' columns
+    (the inverse of make_polylines).
+    """
+
+    splines = curvedata.splines
+    lengths = np.zeros(len(splines), dtype='int32')
+    splines.foreach_get('point_count_u', lengths)
+    lengths = lengths.astype('int64')
+    offsets = np.append(0, np.cumsum(lengths)[:-1])[:len(lengths)]
+
+    npoints = lengths.sum()
+    co = np.zeros((npoints, 4), dtype='float32')
+    radii = np.zeros(npoints if with_data else 0, dtype='float32')
+    weights = np.zeros(npoints if with_data else 0, dtype='float32')
+    for spline, start, length in zip(splines, offsets, lengths):
+        stop = start + length
+        spline.points.foreach_get('co', co[start:stop].ravel())
+        if with_data:
+            spline.points.foreach_get('radius', radii[start:stop])
+            spline.points.foreach_get('weight', weights[start:stop])
+
+    data = {}
+    if with_data:
+        mat_idxs = np.zeros(len(splines), dtype='int32')
+        splines.foreach_get('material_index', mat_idxs)
+        data = {'radius': radii,
+                'structure': np.repeat(mat_idxs, lengths).astype('float32'),
+                'branchpoint': weights}
+
+    return nb_sl.Streamlines(np.ascontiguousarray(co[:, :3]),
+                             offsets, lengths, data)
+
+
+def streamlines_to_curve(curvedata, streamlines):
+    """Write packed streamlines back into the splines of a curve.
+
+    The streamlines must match the splines in number and length;
+    coordinates and the 'radius', 'branchpoint' (weight) and 'structure'
+    (material index) columns are written with 'foreach_set'.
+    New splines are added with make_polylines.
+    """
+
+    streamlines = streamlines.pack()
+    splines = curvedata.splines
+
+    lengths = np.zeros(len(splines), dtype='int32')
+    splines.foreach_get('point_count_u', lengths)
+    if not np.array_equal(lengths, streamlines.lengths):
+        raise ValueError("streamlines do not match the splines")
+
+    co = np.ones((streamlines.npoints, 4), dtype='float32')
+    co[:, :3] = streamlines.points
+
+    radii = streamlines.data.get('radius')
+    weights = streamlines.data.get('branchpoint')
+    for spline, start, length in zip(splines, streamlines.offsets,
+                                     streamlines.lengths):
+        stop = start + length
+        spline.points.foreach_set('co', co[start:stop].ravel())
+        if radii is not None:
+            spline.points.foreach_set('radius', np.asarray(
+                radii[start:stop], dtype='float32'))
+        if weights is not None:
+            spline.points.foreach_set('weight', np.asarray(
+                weights[start:stop], dtype='float32'))
+
+    if 'structure' in streamlines.data:
+        mat_idxs = streamlines.per_streamline('structure').astype('int32')
+        splines.foreach_set('material_index', mat_idxs)
+
+
+def spline_signature(curvedata):
+    """Return a cheap signature of the splines of a curve."""
+
+    splines = curvedata.splines
+    lengths = np.zeros(len(splines), dtype='int32')
+    splines.foreach_get('point_count_u', lengths)
+
+    return curvedata.as_pointer(), len(splines), int(lengths.sum())
+
+
+def get_spatial_index(ob):
+    """Return the spatial index of a tract object (in object space).
+
+    The index is built on first use and kept until the splines change
+    (see invalidate_spatial_index).
+    """
+
+    signature = spline_signature(ob.data)
+    try:
+        cached_signature, index = SPATIAL_INDICES[ob.name]
+    except KeyError:
+        cached_signature = None
+
+    if cached_signature != signature:
+        index = nb_sp.SpatialIndex(curve_to_streamlines(ob.data))
+        SPATIAL_INDICES[ob.name] = (signature, index)
+
+    return index
+
+
+def invalidate_spatial_index(name=None):
+    """Discard the spatial index and features of a tract (default: all)."""
+
+    if name is None:
+        SPATIAL_INDICES.clear()
+        STREAMLINE_FEATURES.clear()
+    else:
+        SPATIAL_INDICES.pop(name, None)
+        STREAMLINE_FEATURES.pop(name, None)
+
+
+def get_streamline_features(ob, npoints=12):
+    """Return the streamlines of a tract object resampled to npoints.
+
+    The features are computed on first use for every number of points
+    and kept until the splines change (see invalidate_spatial_index),
+    such that reclustering does not resample the tract again.
+    """
+
+    signature = spline_signature(ob.data)
+    try:
+        cached_signature, features = STREAMLINE_FEATURES[ob.name]
+    except KeyError:
+        cached_signature = None
+
+    if cached_signature != signature:
+        features = {}
+        STREAMLINE_FEATURES[ob.name] = (signature, features)
+
+    if npoints not in features:
+        streamlines = curve_to_streamlines(ob.data)
+        features[npoints] = nb_cl.streamline_features(streamlines, npoints)
+
+    return features[npoints]
+
+
+def set_label_splines(label, idxs):
+    """Store the spline indices of a tract label as an int32 ID-property."""
+
+    idxs = np.asarray(idxs, dtype='int32')
+    if len(idxs):
+        label['spline_index_array'] = idxs
+    elif 'spline_index_array' in label.keys():
+        del label['spline_index_array']
+
+
+def get_label_splines(label):
+    """Return the spline indices of a tract label as an int32 array."""
+
+    idxs = label.get('spline_index_array')
+    if idxs is None:
+        return np.zeros(0, dtype='int32')
+
+    return np.array(idxs, dtype='int32')
+
+
+def vertex_arrays(me):
+    """Read the vertex coordinates and normals of a mesh into arrays."""
+
+    co = np.zeros(len(me.vertices) * 3, dtype='float32')
+    me.vertices.foreach_get('co', co)
+    normal = np.zeros(len(me.vertices) * 3, dtype='float32')
+    me.vertices.foreach_get('normal', normal)
+
+    return co.reshape(-1, 3), normal.reshape(-1, 3)
+
+
+def vertex_group_indices(ob, polygon_vertices_only=False):
+    """Return the sorted vertex indices of each vertex group of an object.
+
+    The group assignments are read in a single pass over the vertices
+    and split per group with a sort. With 'polygon_vertices_only',
+    loose vertices are excluded.
+    """
+
+    me = ob.data
+    pairs = np.array([(g.group, v.index)
+                      for v in me.vertices for g in v.groups],
+                     dtype='int64').reshape(-1, 2)
+
+    if polygon_vertices_only:
+        loops = np.zeros(len(me.loops), dtype='int32')
+        me.loops.foreach_get('vertex_index', loops)
+        in_polygon = np.zeros(len(me.vertices), dtype='bool')
+        in_polygon[loops] = True
+        pairs = pairs[in_polygon[pairs[:, 1]]]
+
+    pairs = pairs[np.lexsort((pairs[:, 1], pairs[:, 0]))]
+    counts = np.bincount(pairs[:, 0], minlength=len(ob.vertex_groups))
+    idxs = np.split(pairs[:, 1], np.cumsum(counts)[:-1])
+
+    return {vg.name: idxs[vg.index] for vg in ob.vertex_groups}
+
+
 def normalize_data(data):
     """Normalize data between 0 and 1."""
 
@@ -606,6 +903,26 @@ def normalize_data(data):
     return data, [datamin, datamax]
 
 
+def histogram_percentiles(data, percentiles, drange=None, nbins=65536):
+    """Return the approximate percentiles of data from a histogram.
+
+    The percentiles are interpolated within the bins of one histogram
+    pass over 'drange' (default: the range of the data),
+    avoiding the sort of np.percentile.
+    """
+
+    if drange is None:
+        drange = [float(np.amin(data)), float(np.amax(data))]
+    if drange[0] == drange[1]:
+        return [drange[0] for _ in percentiles]
+
+    counts, edges = np.histogram(data, bins=nbins, range=drange)
+    cumcounts = np.append(0, np.cumsum(counts))
+    targets = np.asarray(percentiles, dtype='float64') / 100. * cumcounts[-1]
+
+    return [float(v) for v in np.interp(targets, cumcounts, edges)]
+
+
 def validate_texdir(texdir, texformat, overwrite=False, vol_idx=-1):
     """Check whether path is in a valid NeuroBlender volume texture."""
 